@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import copy
+import os
+import re
+import shutil
+import subprocess
+import sys
+from io import BytesIO
+from tempfile import mkdtemp
+from time import perf_counter
+
+from nbas.__main__ import assemble_cubin
+from nbas.cubin import Cubin
+from nbas.decoder import disassemble_native, get_decoders, get_opcode_index
+from nbas.elf import align_offset
+from nbas.grammar import GrammarMatcher, MatchCache, encode_instruction, encode_instruction_walk, get_matcher, \
+    get_orders, grammar_61, grammar_75
+
+
+def load_corpus(asm_path, repeat):
+    cubin = Cubin()
+    cubin.load_asm(asm_path, {})
+    instrs = []
+    for kernel in cubin.kernel_dict.values():
+        cubin.unmap_constant3(kernel)
+        kernel.unmap_reg()
+        kernel.unmap_constant0()
+        kernel.unmap_jump()
+        kernel.unmap_global()
+        instrs += kernel.instrs
+    return cubin.arch, instrs * repeat
+
+
+def match_search(grammar, op, rest):
+    # the original first-match loop over raw rule strings
+    for g in grammar[op]:
+        m = re.search(g['rule'], op + rest)
+        if m:
+            return g, m.groupdict()
+    return None, None
+
+
+def bench_match(asm_path, repeat):
+    arch, instrs = load_corpus(asm_path, repeat)
+    instrs = [(instr['op'], instr['rest']) for instr in instrs]
+    grammar = grammar_61 if arch < 70 else grammar_75
+    grammar_name = '61' if arch < 70 else '75'
+    matcher = GrammarMatcher(grammar)
+    # profile of the corpus itself
+    stats = {}
+    matcher_stats = GrammarMatcher(grammar, stats=stats)
+    for op, rest in instrs:
+        matcher_stats.match(op, rest)
+    matcher_ordered = GrammarMatcher(grammar, orders=get_orders(grammar, grammar_name, stats))
+    cache = MatchCache()
+    matcher_cached = GrammarMatcher(grammar, cache=cache)
+
+    results = {}
+    for name, func in [('re.search loop', lambda op, rest: match_search(grammar, op, rest)),
+                       ('matcher', matcher.match),
+                       ('ordered', matcher_ordered.match),
+                       ('cached', matcher_cached.match)]:
+        begin = perf_counter()
+        results[name] = [func(op, rest) for op, rest in instrs]
+        elapsed = perf_counter() - begin
+        print(f'{name:<16s} {len(instrs) / elapsed:12.0f} instr/s')
+    print(f'Match cache: {cache}')
+
+    for name, result in results.items():
+        if result != results['re.search loop']:
+            print(f'Warning: {name} result mismatch.')
+
+
+def bench_encode(asm_path, repeat):
+    arch, instrs = load_corpus(asm_path, repeat)
+    matcher = get_matcher(arch)
+    matched = [(instr['op'], *matcher.match(instr['op'], instr['rest']), instr) for instr in instrs]
+    matched = [m for m in matched if m[1]]
+
+    results = {}
+    for name, func in [('walk', encode_instruction_walk), ('generated', encode_instruction)]:
+        begin = perf_counter()
+        results[name] = [func(op, gram, captured_dict, instr, arch) for op, gram, captured_dict, instr in matched]
+        elapsed = perf_counter() - begin
+        print(f'{name:<16s} {len(matched) / elapsed:12.0f} instr/s')
+
+    if results['generated'] != results['walk']:
+        print('Warning: generated result mismatch.')
+
+
+def bench_decode(cubin_path, repeat):
+    cubin = Cubin()
+    cubin.load(cubin_path)
+    kernels = list(cubin.kernel_dict.values())
+    count = sum(len(kernel.binary) // 16 for kernel in kernels) * repeat
+
+    begin = perf_counter()
+    get_opcode_index(cubin.arch)
+    print(f'{"decoder tables":<16s} {(perf_counter() - begin) * 1000:9.1f} ms')
+    begin = perf_counter()
+    for _ in range(repeat):
+        for kernel in kernels:
+            disassemble_native(kernel.binary, cubin.arch)
+    elapsed = perf_counter() - begin
+    print(f'{"native":<16s} {count / elapsed:12.0f} instr/s')
+    print(f'Rule decoders: {len(get_decoders(cubin.arch))}')
+
+    # rule identification only, every rule against the opcode index
+    decoders = get_decoders(cubin.arch)
+    index = get_opcode_index(cubin.arch)
+    codes = [int(instr['code'], base=0) for kernel in kernels for instr in disassemble_native(kernel.binary, cubin.arch)]
+    codes *= repeat
+    results = {}
+    for name, func in [('linear', lambda code: [d for d in decoders if not (code ^ d.fixed) & d.fixed_mask]),
+                       ('opcode index', index.lookup)]:
+        begin = perf_counter()
+        results[name] = [func(code) for code in codes]
+        elapsed = perf_counter() - begin
+        print(f'{name:<16s} {len(codes) / elapsed:12.0f} instr/s')
+    if results['opcode index'] != results['linear']:
+        print('Warning: opcode index result mismatch.')
+
+
+def bench_import(arch, repeat):
+    cache_dir = mkdtemp()
+    env = dict(os.environ, NBAS_CACHE_DIR=cache_dir)
+    root = os.path.dirname(os.path.abspath(__file__))
+    scripts = [('python startup', 'pass', False),
+               ('import', 'import nbas.__main__', False),
+               ('flags cold', f'import nbas.__main__; nbas.grammar.get_flags({arch})', True),
+               ('flags warm', f'import nbas.__main__; nbas.grammar.get_flags({arch})', False)]
+    for name, script, cold in scripts:
+        elapsed = 0
+        for _ in range(repeat):
+            if cold:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            begin = perf_counter()
+            subprocess.run([sys.executable, '-c', script], env=env, cwd=root, check=True)
+            elapsed += perf_counter() - begin
+        print(f'{name:<16s} {elapsed / repeat * 1000:9.1f} ms')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def write_sequential(elf, file):
+    # the original writer, header, padding and section data written one after the other
+    offset = file.write(elf.header.pack_header())
+    for sec in elf.sections:
+        begin = align_offset(offset, sec.sh_addralign)
+        if begin > offset:
+            offset += file.write(b'\0' * (begin - offset))
+        offset += file.write(sec.data)
+    begin = align_offset(offset, 8)
+    if begin > offset:
+        offset += file.write(b'\0' * (begin - offset))
+    for sec in elf.sections:
+        offset += file.write(sec.pack_header())
+    for pro in elf.programs:
+        offset += file.write(pro.pack_header())
+
+
+def bench_emit(asm_path, count):
+    cubin = Cubin()
+    assemble_cubin(cubin, asm_path, {}, False)
+    # synthetic cubin, the first kernel cloned count times under new names
+    kernel = next(iter(cubin.kernel_dict.values()))
+    cubin.kernel_dict = {}
+    for i in range(count):
+        clone = copy.copy(kernel)
+        clone.name = kernel.name + b'_' + str(i).encode()
+        cubin.kernel_dict[clone.name] = clone
+
+    for name, func in [('gen_sections', cubin.gen_sections),
+                       ('gen_symbols', cubin.gen_symbols),
+                       ('gen_rels', cubin.gen_rels),
+                       ('gen_nv_info', cubin.gen_nv_info),
+                       ('gen_program', cubin.gen_program)]:
+        begin = perf_counter()
+        func()
+        print(f'{name:<16s} {(perf_counter() - begin) * 1000:9.1f} ms')
+    print(f'Kernels: {count}, Sections: {len(cubin.sections)}, Symbols: {len(cubin.symbols)}')
+
+    results = {}
+    for name, func in [('sequential', lambda file: write_sequential(cubin, file)),
+                       ('pack_into', cubin.write_file)]:
+        file = BytesIO()
+        begin = perf_counter()
+        func(file)
+        elapsed = perf_counter() - begin
+        results[name] = file.getvalue()
+        print(f'{name:<16s} {elapsed * 1000:9.1f} ms {len(results[name]) / elapsed / 2 ** 20:9.1f} MB/s')
+    if results['pack_into'] != results['sequential']:
+        print('Warning: pack_into result mismatch.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nbas benchmarks')
+    subparsers = parser.add_subparsers(dest='cmd', title='benchmarks')
+
+    parser_match = subparsers.add_parser('match', help='instructions matched per second')
+    parser_match.add_argument('asm', help='disassembled asm corpus', metavar='ASM')
+    parser_match.add_argument('-r', '--repeat', metavar='N', type=int, default=100, help='repeat the corpus N times')
+
+    parser_encode = subparsers.add_parser('encode', help='matched instructions encoded per second')
+    parser_encode.add_argument('asm', help='disassembled asm corpus', metavar='ASM')
+    parser_encode.add_argument('-r', '--repeat', metavar='N', type=int, default=100, help='repeat the corpus N times')
+
+    parser_decode = subparsers.add_parser('decode', help='instructions decoded per second by the native decoder')
+    parser_decode.add_argument('cubin', help='cubin to decode', metavar='CUBIN')
+    parser_decode.add_argument('-r', '--repeat', metavar='N', type=int, default=10, help='decode the kernels N times')
+
+    parser_import = subparsers.add_parser('import', help='process startup time, with cold and warm table cache')
+    parser_import.add_argument('-a', '--arch', metavar='ARCH', type=int, default=86, help='flags of ARCH')
+    parser_import.add_argument('-r', '--repeat', metavar='N', type=int, default=20, help='run N processes')
+
+    parser_emit = subparsers.add_parser('emit', help='cubin generation time of a synthetic cubin')
+    parser_emit.add_argument('asm', help='asm to assemble, its first kernel is cloned', metavar='ASM')
+    parser_emit.add_argument('-n', '--count', metavar='N', type=int, default=10000, help='N kernels')
+
+    args = parser.parse_args()
+    if args.cmd == 'match':
+        bench_match(args.asm, args.repeat)
+    elif args.cmd == 'encode':
+        bench_encode(args.asm, args.repeat)
+    elif args.cmd == 'decode':
+        bench_decode(args.cubin, args.repeat)
+    elif args.cmd == 'import':
+        bench_import(args.arch, args.repeat)
+    elif args.cmd == 'emit':
+        bench_emit(args.asm, args.count)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,82 @@
 
 
 import argparse
+import mmap
+import os
+import sys
+from contextlib import nullcontext, redirect_stdout
+from io import BytesIO, StringIO
 
 from .cubin import Cubin, strip_space, strip_comment
+from .grammar import match_cache, rule_profile
 from .kernel import Kernel
-from .tool import detect
-
-
-def list_cubin(cubin_path, kernel_name, global_only):
+from .tool import das_cache, detect, nvdisasm_archive
+
+
+def init_fatbin_worker(cache, profile_path, record_profile):
+    das_cache.enabled = cache
+    use_worker_rule_profile(profile_path, record_profile)
+
+
+def fatbin_worker(args):
+    func, payload, kwargs = args
+    with redirect_stdout(StringIO()) as output:
+        func(cubin_path='-', data=payload, **kwargs)
+    return output.getvalue(), das_cache.pop(), rule_profile.pop()
+
+
+def worker_data(data):
+    """
+    Content of the input for worker processes, None if they can map the file again. Stdin and pipes are read once.
+    """
+    return None if isinstance(data, mmap.mmap) else data
+
+
+def for_each_cubin(func, fatbin, archs, jobs, entry_kwargs, cache=True, profile_path='', record_profile=False):
+    """
+    Run func (list_cubin, disassemble or test_cubin) over the cubins of fatbin for archs, one worker process per
+    cubin, and print their output in the order of the entries.
+    :param entry_kwargs: entry -> arguments of func, without the rule profile set up by the workers
+    """
+    entries = fatbin.cubins(archs)
+    if not entries:
+        print(f'No cubin for {", ".join(f"sm_{arch}" for arch in archs)} in {fatbin.path}.' if archs
+              else f'No cubin in {fatbin.path}.')
+        return
+    # each worker gets the decompressed cubin of its entry only
+    tasks = [(func, entry.payload(fatbin.data), entry_kwargs(entry)) for entry in entries]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(min(jobs, len(tasks)), initializer=init_fatbin_worker,
+                             initargs=(das_cache.enabled, profile_path, record_profile)) as executor:
+        for entry, (output, cache_stats_, stats) in zip(entries, executor.map(fatbin_worker, tasks)):
+            das_cache.merge(cache_stats_)
+            rule_profile.merge(stats)
+            print(f'# Fatbin entry {entry.index}: sm_{entry.arch}')
+            print(output, end='')
+
+
+def entry_path(path, entry):
+    """
+    out.s -> out.3.sm_75.s for fatbin entry 3, stdout stays stdout.
+    """
+    if not path or path == '-':
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{entry.index}.sm_{entry.arch}{ext}'
+
+
+def list_cubin(cubin_path, kernel_name, global_only, data=None, archs=(), jobs=1):
+    from .fatbin import Fatbin
+    fatbin = Fatbin()
+    fatbin.load(cubin_path, data)
+    if not fatbin.bare_cubin:
+        for entry in fatbin.entries:
+            print(entry)
+        for_each_cubin(list_cubin, fatbin, archs, jobs,
+                       lambda entry: dict(kernel_name=kernel_name, global_only=global_only))
+        return
     cubin = Cubin()
-    cubin.load(cubin_path, global_only)
+    cubin.load(cubin_path, global_only, fatbin.data)
     print(cubin.header.print())
 
     if kernel_name:
@@ -39,9 +106,75 @@ def list_cubin(cubin_path, kernel_name, global_only):
         print(kernel.print_meta())
 
 
-def disassemble(cubin_path, kernel_names, asm_path, strip, global_only, no_line_info=False):
+# cubin (and the reassembled cubin of test) loaded once by each worker process of -j
+worker_state = {}
+
+
+def chunk_size(kernels, jobs):
+    return max(1, len(kernels) // (jobs * 4))
+
+
+def disassemble_kernel(cubin, kernel, no_line_info=False):
+    # if Symbol.STB_STR[kernel.linkage] != 'GLOBAL':
+    #     continue
+    # kernel.schedule()
+    # kernel.sort_banks()
+    cubin.map_constant3(kernel)
+    kernel.map_global()
+    kernel.map_jump()
+    kernel.map_constant0()
+    kernel.mark_const2()
+    return '\n' + kernel.print(no_line_info)
+
+
+def init_disassemble_worker(cubin_path, global_only, cache, data=None):
+    das_cache.enabled = cache
+    cubin = Cubin()
+    cubin.load(cubin_path, global_only, data)
+    worker_state['cubin'] = cubin
+
+
+def disassemble_worker(args):
+    names, decoder, no_line_info, sass_dict = args
+    cubin = worker_state['cubin']
+    kernels = [cubin.kernel_dict[name] for name in names]
+    cubin.disassemble(kernels, decoder, sass_dict)
+    results = [(disassemble_kernel(cubin, kernel, no_line_info), kernel.consts, kernel.globals) for kernel in kernels]
+    return results, das_cache.pop(), cubin.pop_dedup()
+
+
+def group_tasks(kernels, sass_dict):
+    """
+    Kernels with the same binary go to the same worker, which decodes them once.
+    :return: [(group, kernel names, sass of the first kernel)]
+    """
+    tasks = []
+    for group in Cubin.group_kernels(kernels):
+        name = group[0].name
+        tasks.append((group, [kernel.name for kernel in group], {name: sass_dict[name]} if name in sass_dict else {}))
+    return tasks
+
+
+def disassemble(cubin_path, kernel_names, asm_path, strip, global_only, no_line_info=False, decoder='nvdisasm',
+                jobs=1, cache=True, cache_stats=False, data=None, archs=()):
+    """
+    :param data: content of cubin_path, instead of reading it
+    :param archs: cubins of a fatbin to disassemble, one asm each (out.s -> out.3.sm_75.s for entry 3)
+    """
+    das_cache.enabled = cache
+    from .fatbin import Fatbin
+    fatbin = Fatbin()
+    fatbin.load(cubin_path, data)
+    if not fatbin.bare_cubin:
+        for_each_cubin(disassemble, fatbin, archs, jobs,
+                       lambda entry: dict(kernel_names=kernel_names, asm_path=entry_path(asm_path, entry), strip=strip,
+                                          global_only=global_only, no_line_info=no_line_info, decoder=decoder,
+                                          cache=cache), cache)
+        if cache_stats:
+            print(f'Disassembly cache: {das_cache}')
+        return
     cubin = Cubin()
-    cubin.load(cubin_path, global_only)
+    cubin.load(cubin_path, global_only, fatbin.data)
     # 输出各种元信息
     header_asm = cubin.header.print() + '\n'
     global_asm = ''
@@ -63,20 +196,30 @@ def disassemble(cubin_path, kernel_names, asm_path, strip, global_only, no_line_
 
     consts = set()
     globals_ = set()
-    for kernel in kernels:
-        # if Symbol.STB_STR[kernel.linkage] != 'GLOBAL':
-        #     continue
-        kernel.disassemble()
-        # kernel.schedule()
-        # kernel.sort_banks()
-        cubin.map_constant3(kernel)
-        kernel.map_global()
-        kernel.map_jump()
-        kernel.map_constant0()
-        kernel.mark_const2()
-        kernel_asm += '\n' + kernel.print(no_line_info)
-        consts = consts.union(kernel.consts)
-        globals_ = globals_.union(kernel.globals)
+    if jobs > 1 and len(kernels) > 1:
+        # workers load the cubin themselves, results come back in the order of kernels
+        tasks = group_tasks(kernels, cubin.disassemble_sass(kernels, decoder))
+        asm_dict = {}
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs, initializer=init_disassemble_worker,
+                                 initargs=(cubin_path, global_only, cache,
+                                           worker_data(cubin.data))) as executor:
+            for (group, _, _), (results, stats, dedup) in zip(tasks, executor.map(
+                    disassemble_worker, [(names, decoder, no_line_info, sass_dict) for _, names, sass_dict in tasks],
+                    chunksize=chunk_size(tasks, jobs))):
+                das_cache.merge(stats)
+                cubin.merge_dedup(dedup)
+                for kernel, (asm, kernel_consts, kernel_globals) in zip(group, results):
+                    asm_dict[kernel.name] = asm
+                    consts = consts.union(kernel_consts)
+                    globals_ = globals_.union(kernel_globals)
+        kernel_asm = ''.join(asm_dict[kernel.name] for kernel in kernels)
+    else:
+        cubin.disassemble(kernels, decoder)
+        for kernel in kernels:
+            kernel_asm += disassemble_kernel(cubin, kernel, no_line_info)
+            consts = consts.union(kernel.consts)
+            globals_ = globals_.union(kernel.globals)
 
     for global_ in cubin.global_dict.values():
         if global_.name in globals_:
@@ -93,25 +236,22 @@ def disassemble(cubin_path, kernel_names, asm_path, strip, global_only, no_line_
     if strip:
         asm = strip_comment(asm)
 
-    if asm_path:
+    if asm_path and asm_path != '-':
         with open(asm_path, 'w') as f:
             f.write(asm)
     else:
         print(asm, end='')
+    # not mixed into the asm on stdout unless asked for
+    if (cubin.dedup_kernels and asm_path and asm_path != '-') or cache_stats:
+        print(cubin.print_dedup())
+    if cache_stats:
+        print(f'Disassembly cache: {das_cache}')
 
 
 def decompile_ptx(asm_path, ptx_path, define_list):
     cubin = Cubin()
 
-    define_dict = {}
-    for define in define_list:
-        if not define:
-            continue
-        d = define.split('=')
-        if len(d) < 2:
-            exec(f'{define} = True', define_dict)
-        else:
-            exec(f'{define}', define_dict)
+    define_dict = parse_defines(define_list)
 
     cubin.load_asm(asm_path, define_dict)
 
@@ -138,18 +278,14 @@ def decompile_ptx(asm_path, ptx_path, define_list):
 
     ptx = header_ptx + global_ptx + constant_ptx + kernel_ptx
 
-    if ptx_path:
+    if ptx_path and ptx_path != '-':
         with open(ptx_path, 'w') as f:
             f.write(ptx)
     else:
         print(ptx, end='')
 
 
-def assemble(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, strip):
-    if not out_cubin_path:
-        out_cubin_path = 'out.cubin'
-    cubin = Cubin()
-
+def parse_defines(define_list):
     define_dict = {}
     for define in define_list:
         if not define:
@@ -159,8 +295,32 @@ def assemble(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, st
             exec(f'{define} = True', define_dict)
         else:
             exec(f'{define}', define_dict)
+    return define_dict
+
+
+def use_rule_profile(profile_path, record_profile_path):
+    if record_profile_path:
+        rule_profile.record = True
+        rule_profile.load(record_profile_path)
+    elif profile_path:
+        rule_profile.load(profile_path)
+
+
+def use_worker_rule_profile(profile_path, record_profile):
+    """
+    Rule profile of a worker process, set before the worker matches anything. A recording worker counts from zero,
+    rule_profile.pop returns only its counts, merged into the profile loaded by the main process.
+    """
+    if record_profile:
+        rule_profile.record = True
+        # drop the counts loaded by (and forked from) the main process, in place for the matchers already built
+        rule_profile.pop()
+    else:
+        use_rule_profile(profile_path, '')
 
-    cubin.load_asm(asm_path, define_dict)
+
+def assemble_cubin(cubin, asm_path, define_dict, sort_banks, asm=None):
+    cubin.load_asm(asm_path, define_dict, asm)
 
     for kernel in cubin.kernel_dict.values():
         # Unmap global, const0, const3
@@ -174,6 +334,8 @@ def assemble(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, st
             kernel.sort_banks()
         kernel.assemble()
 
+
+def gen_cubin(cubin):
     # 生成elf数据
     cubin.gen_sections()
     cubin.gen_symbols()
@@ -181,40 +343,149 @@ def assemble(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, st
     cubin.gen_nv_info()
     cubin.gen_program()
 
-    cubin.write(out_cubin_path)
 
-    if out_asm_path:
-        header_asm = cubin.header.print() + '\n'
-        global_asm = ''
-        constant_asm = ''
-        kernel_asm = ''
-        for kernel in cubin.kernel_dict.values():
-            cubin.map_constant3(kernel)
-            kernel.map_global()
-            kernel.map_constant0()
-            kernel.map_jump(rel=True)
-            kernel.mark_const2()
-            kernel_asm += '\n' + kernel.print()
-        for global_ in cubin.global_dict.values():
-            global_asm += global_.print() + '\n'
-        for global_ in cubin.global_init_dict.values():
-            global_asm += global_.print() + '\n'
-        for constant in cubin.constant_dict.values():
-            constant_asm += constant.print() + '\n'
-        asm = header_asm + global_asm + constant_asm + kernel_asm
+def print_debug_asm(cubin, strip):
+    """
+    asm of the assembled cubin, for as -d.
+    """
+    header_asm = cubin.header.print() + '\n'
+    global_asm = ''
+    constant_asm = ''
+    kernel_asm = ''
+    for kernel in cubin.kernel_dict.values():
+        cubin.map_constant3(kernel)
+        kernel.map_global()
+        kernel.map_constant0()
+        kernel.map_jump(rel=True)
+        kernel.mark_const2()
+        kernel_asm += '\n' + kernel.print()
+    for global_ in cubin.global_dict.values():
+        global_asm += global_.print() + '\n'
+    for global_ in cubin.global_init_dict.values():
+        global_asm += global_.print() + '\n'
+    for constant in cubin.constant_dict.values():
+        constant_asm += constant.print() + '\n'
+    asm = header_asm + global_asm + constant_asm + kernel_asm
+
+    if strip:
+        asm = strip_comment(asm)
+    return asm
 
-        if strip:
-            asm = strip_comment(asm)
 
-        with open(out_asm_path, 'w') as f:
-            f.write(asm)
+def write_text(path, text):
+    if path == '-':
+        print(text, end='')
+    else:
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+def arch_path(path, arch):
+    """
+    out.cubin -> out.sm_75.cubin
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.sm_{arch}{ext}'
 
 
-def test_cubin(cubin_path, kernel_names, global_only, check=False):
+def init_assemble_worker(match_cache_path, profile_path, record_profile):
+    if match_cache_path:
+        match_cache.load(match_cache_path)
+    use_worker_rule_profile(profile_path, record_profile)
+
+
+def assemble_worker(args):
+    asm, asm_path, define_list, arch, sort_banks, debug, strip = args
+    define_dict = parse_defines(define_list)
+    define_dict['arch'] = arch
     cubin = Cubin()
-    cubin_new = Cubin()
+    with redirect_stdout(StringIO()) as output:
+        assemble_cubin(cubin, asm_path, define_dict, sort_banks, asm)
+        if cubin.arch != arch:
+            raise Exception(f'Assembling for sm_{arch}, but the asm is .sm_{cubin.arch}, write .sm_{{arch}}.')
+        gen_cubin(cubin)
+    file = BytesIO()
+    cubin.write_file(file)
+    debug_asm = print_debug_asm(cubin, strip) if debug else ''
+    return file.getvalue(), debug_asm, output.getvalue(), rule_profile.pop(), match_cache.dump()
+
+
+def assemble_archs(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, strip, archs,
+                   match_cache_path='', profile_path='', record_profile_path=''):
+    """
+    Assemble asm for each of archs in parallel, with the arch in the define arch (for .sm_{arch}). The asm is read and
+    its asm files included once. Writes out.sm_75.cubin... and all of them in the fatbin out.fatbin (- for stdout,
+    without the cubins).
+    """
+    use_rule_profile(profile_path, record_profile_path)
+    asm = Cubin.read_asm(asm_path)
+    from .fatbin import Fatbin
+    fatbin = Fatbin()
+    tasks = [(asm, asm_path, define_list, arch, sort_banks, bool(out_asm_path), strip) for arch in archs]
+    # with the fatbin on stdout, progress prints go to stderr
+    with redirect_stdout(sys.stderr) if out_cubin_path == '-' else nullcontext():
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(len(archs), os.cpu_count() or 1), initializer=init_assemble_worker,
+                                 initargs=(match_cache_path, profile_path, bool(record_profile_path))) as executor:
+            for arch, (binary, debug_asm, output, stats, entries) in zip(archs, executor.map(assemble_worker, tasks)):
+                print(output, end='')
+                rule_profile.merge(stats)
+                match_cache.merge(entries)
+                fatbin.add_cubin(binary, arch)
+                if out_cubin_path != '-':
+                    with open(arch_path(out_cubin_path, arch), 'wb') as f:
+                        f.write(binary)
+                if out_asm_path:
+                    write_text(out_asm_path if out_asm_path == '-' else arch_path(out_asm_path, arch), debug_asm)
+
+        if match_cache_path:
+            match_cache.save(match_cache_path)
+            print(f'Match cache: {match_cache}')
+        if record_profile_path:
+            rule_profile.save(record_profile_path)
+
+    fatbin.write(out_cubin_path if out_cubin_path == '-' else os.path.splitext(out_cubin_path)[0] + '.fatbin')
+
+
+def assemble(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, strip, match_cache_path='',
+             profile_path='', record_profile_path='', archs=()):
+    """
+    :param archs: assemble for each arch with assemble_archs
+    """
+    if not out_cubin_path:
+        out_cubin_path = 'out.cubin'
+    if archs:
+        assemble_archs(asm_path, out_cubin_path, define_list, out_asm_path, sort_banks, strip, archs,
+                       match_cache_path, profile_path, record_profile_path)
+        return
+    cubin = Cubin()
+    # with the cubin on stdout, progress prints go to stderr
+    with redirect_stdout(sys.stderr) if out_cubin_path == '-' else nullcontext():
+        if match_cache_path:
+            match_cache.load(match_cache_path)
+        use_rule_profile(profile_path, record_profile_path)
+
+        assemble_cubin(cubin, asm_path, parse_defines(define_list), sort_banks)
+
+        if match_cache_path:
+            match_cache.save(match_cache_path)
+            print(f'Match cache: {match_cache}')
+        if record_profile_path:
+            rule_profile.save(record_profile_path)
 
-    cubin.load(cubin_path, global_only)
+        gen_cubin(cubin)
+
+    cubin.write(out_cubin_path)
+
+    if out_asm_path:
+        write_text(out_asm_path, print_debug_asm(cubin, strip))
+
+
+def load_test_cubin(cubin):
+    """
+    New cubin with the header and data of cubin, to reassemble its kernels into.
+    """
+    cubin_new = Cubin()
 
     # header
     header_asm = cubin.header.print()
@@ -233,6 +504,95 @@ def test_cubin(cubin_path, kernel_names, global_only, check=False):
         data_asm += constant.print() + '\n'
     data_asm = strip_space(data_asm)
     cubin_new.load_asm_data(data_asm)
+    return cubin_new
+
+
+def test_kernel(cubin_new, kernel, check=False):
+    """
+    Reassemble the disassembled kernel into cubin_new.
+    :return: True if the binary is the same
+    """
+    # disable if align mismatch
+    # cubin.map_constant3(kernel)
+    # kernel.map_global()
+    # kernel.map_constant0()
+
+    kernel.map_jump()
+
+    # kernel
+    kernel_new = Kernel(name=kernel.name, arch=cubin_new.arch)
+    cubin_new.kernel_dict[kernel.name] = kernel_new
+    if kernel.constant2:
+        data_asm = kernel.constant2.print()
+        data_asm = strip_space(data_asm)
+        cubin_new.load_asm_data(data_asm)
+
+        # check const2
+        # if kernel_new.constant2 != kernel.constant2:
+        #     print('constant2 failed:')
+
+    asm = kernel.print_meta() + kernel.print_asm()
+    asm = strip_space(asm)
+    kernel_new.load_asm(asm)
+
+    kernel_new.unmap_jump()
+
+    # disable if align mismatch
+    # kernel_new.unmap_constant0()
+    # kernel_new.unmap_global()
+    # cubin_new.unmap_constant3(kernel_new)
+    if check:
+        kernel.check_reg_bank()
+    binary = kernel_new.assemble(kernel.binary)
+    return bool(binary)
+
+
+def init_test_worker(cubin_path, global_only, profile_path, record_profile_path, cache, data=None):
+    das_cache.enabled = cache
+    use_worker_rule_profile(profile_path, bool(record_profile_path))
+    cubin = Cubin()
+    cubin.load(cubin_path, global_only, data)
+    worker_state['cubin'] = cubin
+    worker_state['cubin_new'] = load_test_cubin(cubin)
+
+
+def test_worker(args):
+    names, decoder, check, sass_dict = args
+    cubin = worker_state['cubin']
+    kernels = [cubin.kernel_dict[name] for name in names]
+    cubin.disassemble(kernels, decoder, sass_dict)
+    cubin_new = worker_state['cubin_new']
+    results = [(test_kernel(cubin_new, kernel, check), cubin_new.kernel_dict[kernel.name]) for kernel in kernels]
+    return results, rule_profile.pop(), das_cache.pop(), cubin.pop_dedup()
+
+
+def test_cubin(cubin_path, kernel_names, global_only, check=False, profile_path='', record_profile_path='',
+               decoder='nvdisasm', jobs=1, cache=True, cache_stats=False, data=None, archs=()):
+    """
+    :param data: content of cubin_path, instead of reading it
+    :param archs: cubins of a fatbin to test
+    """
+    das_cache.enabled = cache
+    cubin = Cubin()
+    use_rule_profile(profile_path, record_profile_path)
+
+    from .fatbin import Fatbin
+    fatbin = Fatbin()
+    fatbin.load(cubin_path, data)
+    if not fatbin.bare_cubin:
+        # workers count rule matches from zero, merged here and saved once
+        for_each_cubin(test_cubin, fatbin, archs, jobs,
+                       lambda entry: dict(kernel_names=kernel_names, global_only=global_only, check=check,
+                                          decoder=decoder, cache=cache),
+                       cache, profile_path, bool(record_profile_path))
+        if record_profile_path:
+            rule_profile.save(record_profile_path)
+        if cache_stats:
+            print(f'Disassembly cache: {das_cache}')
+        return
+
+    cubin.load(cubin_path, global_only, fatbin.data)
+    cubin_new = load_test_cubin(cubin)
 
     # check const3, global
     # for data_dict, data_dict_new in zip([cubin.global_dict, cubin.global_init_dict, cubin.constant_dict],
@@ -250,49 +610,41 @@ def test_cubin(cubin_path, kernel_names, global_only, check=False):
                 print(f'{kernel_name.decode()} nor Found.')
                 return 0
     else:
-        kernels = cubin.kernel_dict.values()
-
-    for kernel in kernels:
-        print(f'Kernel:{kernel.name.decode()}... ', end='')
-        kernel.disassemble()
-
-        # disable if align mismatch
-        # cubin.map_constant3(kernel)
-        # kernel.map_global()
-        # kernel.map_constant0()
+        kernels = list(cubin.kernel_dict.values())
 
-        kernel.map_jump()
+    if jobs > 1 and len(kernels) > 1:
+        tasks = group_tasks(kernels, cubin.disassemble_sass(kernels, decoder))
+        passed_dict = {}
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs, initializer=init_test_worker,
+                                 initargs=(cubin_path, global_only, profile_path, record_profile_path,
+                                           cache, worker_data(cubin.data))) as executor:
+            for (group, _, _), (results, stats, cache_stats_, dedup) in zip(tasks, executor.map(
+                    test_worker, [(names, decoder, check, sass_dict) for _, names, sass_dict in tasks],
+                    chunksize=chunk_size(tasks, jobs))):
+                rule_profile.merge(stats)
+                das_cache.merge(cache_stats_)
+                cubin.merge_dedup(dedup)
+                for kernel, (passed, kernel_new) in zip(group, results):
+                    passed_dict[kernel.name] = passed, kernel_new
+        for kernel in kernels:
+            passed, cubin_new.kernel_dict[kernel.name] = passed_dict[kernel.name]
+            print(f'Kernel:{kernel.name.decode()}... Test {"Pass" if passed else "failed"}.')
+    else:
+        cubin.disassemble(kernels, decoder)
+        for kernel in kernels:
+            print(f'Kernel:{kernel.name.decode()}... ', end='')
+            if test_kernel(cubin_new, kernel, check):
+                print(f'Test Pass.')
+            else:
+                print(f'Test failed.')
 
-        # kernel
-        kernel_new = Kernel(name=kernel.name, arch=cubin_new.arch)
-        cubin_new.kernel_dict[kernel.name] = kernel_new
-        if kernel.constant2:
-            data_asm = kernel.constant2.print()
-            data_asm = strip_space(data_asm)
-            cubin_new.load_asm_data(data_asm)
-
-            # check const2
-            # if kernel_new.constant2 != kernel.constant2:
-            #     print('constant2 failed:')
-
-        asm = kernel.print_meta() + kernel.print_asm()
-        asm = strip_space(asm)
-        kernel_new.load_asm(asm)
-
-        kernel_new.unmap_jump()
-
-        # disable if align mismatch
-        # kernel_new.unmap_constant0()
-        # kernel_new.unmap_global()
-        # cubin_new.unmap_constant3(kernel_new)
-        if check:
-            kernel.check_reg_bank()
-        binary = kernel_new.assemble(kernel.binary)
-
-        if binary:
-            print(f'Test Pass.')
-        else:
-            print(f'Test failed.')
+    if record_profile_path:
+        rule_profile.save(record_profile_path)
+    if cubin.dedup_kernels:
+        print(cubin.print_dedup())
+    if cache_stats:
+        print(f'Disassembly cache: {das_cache}')
 
     # 生成elf数据
     cubin_new.gen_sections()
@@ -317,71 +669,153 @@ def main():
     description = 'Assembler and Decompiler for NVIDIA (Maxwell Pascal Volta Turing Ampere) GPUs.'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-V', '--version', action='store_true', help='Print version information on this tool.')
+    parser.add_argument('--record_nvdisasm', metavar='ARCHIVE', type=str, default='',
+                        help='serve nvdisasm runs recorded in ARCHIVE, run and record the others')
+    parser.add_argument('--replay_nvdisasm', metavar='ARCHIVE', type=str, default='',
+                        help='serve nvdisasm runs from ARCHIVE only, without nvdisasm')
     subparsers = parser.add_subparsers(dest='cmd', title='subcommands')
 
     parser_list = subparsers.add_parser('list', help='list cubin info')
-    parser_list.add_argument('cubin', help='input cubin', metavar='CUBIN')
+    parser_list.add_argument('cubin', help='input cubin, fatbin or executable with .nv_fatbin, - for stdin',
+                             metavar='CUBIN')
     parser_list.add_argument('-k', '--kernel', metavar='KERNEL', type=str, default='', help='kernel name')
     parser_list.add_argument('-g', '--global_only', action='store_true', help='ignore non global FUNC')
+    parser_list.add_argument('-a', '--arch', metavar='ARCH', nargs='+', type=int, default=(),
+                             help='cubins of a fatbin for ARCH, all by default')
+    parser_list.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='list cubins in N processes')
 
     parser_das = subparsers.add_parser('das', help='disassemble cubin')
-    parser_das.add_argument('cubin', help='input cubin', metavar='CUBIN')
+    parser_das.add_argument('cubin', help='input cubin, fatbin or executable with .nv_fatbin, - for stdin',
+                            metavar='CUBIN')
     parser_das.add_argument('-k', '--kernels', metavar='KERNELS', nargs='+', type=str, default='', help='kernel names')
-    parser_das.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='', help='output asm file path')
+    parser_das.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='',
+                            help='output asm file path, - for stdout')
     parser_das.add_argument('-s', '--strip', action='store_true', help='strip comment')
     parser_das.add_argument('-n', '--no_line_info', action='store_true', help='strip line info')
     parser_das.add_argument('-g', '--global_only', action='store_true', help='ignore non global FUNC')
+    parser_das.add_argument('--decoder', choices=['nvdisasm', 'native', 'check'], default='nvdisasm',
+                            help='nvdisasm, native (grammar tables, no nvdisasm needed) or check (nvdisasm, '
+                                 'cross-checked with native)')
+    parser_das.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                            help='disassemble kernels in N processes')
+    parser_das.add_argument('--no_cache', action='store_true',
+                            help='do not use the disassembly cache under NBAS_CACHE_DIR/das')
+    parser_das.add_argument('--cache_stats', action='store_true', help='print disassembly cache hits and misses')
+    parser_das.add_argument('-a', '--arch', metavar='ARCH', nargs='+', type=int, default=(),
+                            help='cubins of a fatbin for ARCH, all by default')
 
     parser_as = subparsers.add_parser('as', help='assemble asm')
-    parser_as.add_argument('asm', help='input asm', metavar='ASM')
+    parser_as.add_argument('asm', help='input asm, - for stdin', metavar='ASM')
     # parser_as.add_argument('-m', '--merge', metavar='CUBIN', type=str,
     #                        help='merge into CUBIN, overwrite same symbols, write to OUTPUT')
-    parser_as.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='', help='output cubin path')
+    parser_as.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='',
+                           help='output cubin path, - for stdout')
     parser_as.add_argument('-D', '--define', metavar='DEFINE', nargs='+', type=str, default='',
                            help='define variable for embedded python code')
-    parser_as.add_argument('-d', '--debug', metavar='OUTPUT_ASM', type=str, default='', help='output asm for debug')
+    parser_as.add_argument('-d', '--debug', metavar='OUTPUT_ASM', type=str, default='',
+                           help='output asm for debug, - for stdout')
     parser_as.add_argument('-b', '--bank', action='store_true', help='sort banks')
     parser_as.add_argument('-s', '--strip', action='store_true', help='strip comment')
+    parser_as.add_argument('-c', '--match_cache', metavar='CACHE', type=str, default='',
+                           help='load and save instruction match cache from CACHE')
+    parser_as.add_argument('-p', '--profile', metavar='PROFILE', type=str, default='',
+                           help='try grammar rules in the order of PROFILE match counts')
+    parser_as.add_argument('--record_profile', metavar='PROFILE', type=str, default='',
+                           help='add grammar rule match counts to PROFILE')
+    parser_as.add_argument('-a', '--arch', metavar='ARCHS', type=str, default='',
+                           help='assemble for each of ARCHS (75,80,86) in parallel, with the define arch for '
+                                '.sm_{arch}, write OUTPUT.sm_75.cubin... and OUTPUT.fatbin with all of them')
 
     parser_pdas = subparsers.add_parser('dcc', help='decompile asm to ptx')
-    parser_pdas.add_argument('asm', help='input asm', metavar='ASM')
+    parser_pdas.add_argument('asm', help='input asm, - for stdin', metavar='ASM')
     parser_pdas.add_argument('-D', '--define', metavar='DEFINE', nargs='+', type=str, default='',
                              help='define variable for embedded python code')
-    parser_pdas.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='', help='output ptx file path')
+    parser_pdas.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='',
+                             help='output ptx file path, - for stdout')
 
     parser_test = subparsers.add_parser('test', help='test assembler by disassemble and then assemble')
-    parser_test.add_argument('cubin', help='input cubin', metavar='CUBIN')
+    parser_test.add_argument('cubin', help='input cubin, fatbin or executable with .nv_fatbin, - for stdin',
+                             metavar='CUBIN')
     parser_test.add_argument('-c', '--check', action='store_true', help='Detect register bank conflicts')
     parser_test.add_argument('-k', '--kernels', metavar='KERNELS', nargs='+', type=str, default='', help='kernel names')
     parser_test.add_argument('-g', '--global_only', action='store_true', help='ignore non global FUNC')
+    parser_test.add_argument('-p', '--profile', metavar='PROFILE', type=str, default='',
+                             help='try grammar rules in the order of PROFILE match counts')
+    parser_test.add_argument('--record_profile', metavar='PROFILE', type=str, default='',
+                             help='add grammar rule match counts to PROFILE')
+    parser_test.add_argument('--decoder', choices=['nvdisasm', 'native', 'check'], default='nvdisasm',
+                             help='nvdisasm, native (grammar tables, no nvdisasm needed) or check (nvdisasm, '
+                                  'cross-checked with native)')
+    parser_test.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='test kernels in N processes')
+    parser_test.add_argument('--no_cache', action='store_true',
+                             help='do not use the disassembly cache under NBAS_CACHE_DIR/das')
+    parser_test.add_argument('--cache_stats', action='store_true', help='print disassembly cache hits and misses')
+    parser_test.add_argument('-a', '--arch', metavar='ARCH', nargs='+', type=int, default=(),
+                             help='cubins of a fatbin for ARCH, all by default')
 
     parser_det = subparsers.add_parser('det', help='detect machine code bits')
     parser_det.add_argument('code', help='input code', metavar='CODE')
     parser_det.add_argument('-a', '--arch', help='code arch', metavar='ARCH', type=int, default=61)
     parser_det.add_argument('-r', '--range', nargs=2, metavar=('BEGIN', 'END'), type=int,
                             help='detect machine code by flip [BEGIN,END] bit')
+    parser_det.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                            help='disassemble the variants in N processes')
+    parser_discover = subparsers.add_parser('discover', help='sweep the bits of instructions into candidate rules')
+    parser_discover.add_argument('codes', help='seed codes', metavar='CODE', nargs='*')
+    parser_discover.add_argument('-a', '--arch', help='code arch', metavar='ARCH', type=int, default=75)
+    parser_discover.add_argument('-c', '--cubin', metavar='CUBIN', type=str, default='',
+                                 help='also take one seed per op and operand kinds from the kernels of CUBIN')
+    parser_discover.add_argument('--all', action='store_true', help='seed ops that already have grammar rules too')
+    parser_discover.add_argument('-d', '--db', metavar='DB', type=str, default='discover.sqlite',
+                                 help='SQLite database of disassembled codes and discovered fields')
+    parser_discover.add_argument('-r', '--replay', action='store_true',
+                                 help='only use the codes recorded in DB, without nvdisasm')
+    parser_discover.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                                 help='disassemble the variants in N processes')
+    parser_discover.add_argument('-o', '--output', metavar='OUTPUT', type=str, default='',
+                                 help='write the candidate rules to OUTPUT')
+    parser_idx = subparsers.add_parser('idx', help='check the opcode index for overlapping grammar rule encodings')
+    parser_idx.add_argument('-a', '--arch', help='grammar arch', metavar='ARCH', type=int, default=61)
+
     args = parser.parse_args()
+    if args.record_nvdisasm:
+        nvdisasm_archive.open(args.record_nvdisasm, 'record')
+    elif args.replay_nvdisasm:
+        nvdisasm_archive.open(args.replay_nvdisasm, 'replay')
 
     if args.version:
         print(description)
         print('version 11.6.2')
     elif args.cmd == 'list':
-        list_cubin(cubin_path=args.cubin, kernel_name=args.kernel.encode(), global_only=args.global_only)
+        list_cubin(cubin_path=args.cubin, kernel_name=args.kernel.encode(), global_only=args.global_only,
+                   archs=args.arch, jobs=args.jobs)
     elif args.cmd == 'das':
         disassemble(cubin_path=args.cubin, kernel_names=args.kernels, asm_path=args.output, strip=args.strip,
-                    global_only=args.global_only, no_line_info=args.no_line_info)
+                    global_only=args.global_only, no_line_info=args.no_line_info, decoder=args.decoder,
+                    jobs=args.jobs, cache=not args.no_cache, cache_stats=args.cache_stats, archs=args.arch)
     elif args.cmd == 'as':
         assemble(asm_path=args.asm, out_cubin_path=args.output, define_list=args.define, out_asm_path=args.debug,
-                 sort_banks=args.bank, strip=args.strip)
+                 sort_banks=args.bank, strip=args.strip, match_cache_path=args.match_cache,
+                 profile_path=args.profile, record_profile_path=args.record_profile,
+                 archs=[int(arch) for arch in args.arch.split(',')] if args.arch else ())
     elif args.cmd == 'dcc':
         decompile_ptx(asm_path=args.asm, ptx_path=args.output, define_list=args.define)
     elif args.cmd == 'test':
-        test_cubin(cubin_path=args.cubin, kernel_names=args.kernels, global_only=args.global_only, check=args.check)
+        test_cubin(cubin_path=args.cubin, kernel_names=args.kernels, global_only=args.global_only, check=args.check,
+                   profile_path=args.profile, record_profile_path=args.record_profile, decoder=args.decoder,
+                   jobs=args.jobs, cache=not args.no_cache, cache_stats=args.cache_stats, archs=args.arch)
     elif args.cmd == 'det':
         code = args.code
         begin, end = args.range
         arch = args.arch
-        detect(int(code, base=0), begin, end, arch)
+        detect(int(code, base=0), begin, end, arch, args.jobs)
+    elif args.cmd == 'discover':
+        from .discover import discover
+        discover([int(code, base=0) for code in args.codes], args.arch, args.db, cubin_path=args.cubin,
+                 jobs=args.jobs, replay=args.replay, all_ops=args.all, output=args.output)
+    elif args.cmd == 'idx':
+        from .decoder import check_opcode_index
+        check_opcode_index(args.arch)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,40 @@
+from time import perf_counter
+
 from .kernel import *
 
 out_ = ''
 
 
+class KernelDict(dict):
+    """
+    kernel_dict of a loaded cubin, name -> Kernel. A kernel is built by load_kernel from its FUNC symbol when it is
+    first accessed, listing or disassembling one kernel does not read the others.
+    """
+
+    def __init__(self, load_kernel):
+        super().__init__()
+        self.load_kernel = load_kernel
+
+    def add(self, symbol):
+        super().__setitem__(symbol.name, symbol)
+
+    def __getitem__(self, name):
+        kernel = super().__getitem__(name)
+        if isinstance(kernel, Symbol):
+            kernel = self.load_kernel(kernel)
+            super().__setitem__(name, kernel)
+        return kernel
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
 class Cubin(ELF):
     EIATTR = {
         'FRAME_SIZE': b'\x04\x11',
@@ -10,6 +42,13 @@ class Cubin(ELF):
         'MAX_STACK_SIZE': b'\x04\x23',
         'REGCOUNT': b'\x04\x2f',
     }
+    # kernel attribute of each EIATTR of .nv.info
+    EIATTR_ATTR = {
+        EIATTR['FRAME_SIZE']: 'frame_size',
+        EIATTR['MIN_STACK_SIZE']: 'min_stack_size',
+        EIATTR['MAX_STACK_SIZE']: 'max_stack_size',
+        EIATTR['REGCOUNT']: 'reg_count',
+    }
 
     def __init__(self, iterable=(), **kwargs):
         super().__init__(iterable, **kwargs)
@@ -25,6 +64,13 @@ class Cubin(ELF):
         self.global_init_section = None
 
         self.ptx = []
+        # read with the first kernel built by load_kernel
+        self.stack_info = None
+        self.line_info_dict = None
+
+        # kernels with the binary of an already disassembled kernel, and the decoding time saved
+        self.dedup_kernels = 0
+        self.dedup_time = 0.0
 
         self.arch = 61
 
@@ -35,123 +81,18 @@ class Cubin(ELF):
         msg += f', kernels:{[n.decode() for n in self.kernel_dict.keys()]}'
         return msg
 
-    def load(self, path, global_only=False):
-        super().load(path)
+    def load(self, path, global_only=False, data=None):
+        super().load(path, data)
 
         self.arch = self.header.arch
-        # For the Global functions, extract kernel meta data
+        # For the Global functions, kernels are built on first access, see load_kernel
+        self.kernel_dict = KernelDict(self.load_kernel)
         for symbol in self.symbols:
-            section = self.sections[symbol.st_shndx]
-
             # Look for symbols tagged FUNC
             if symbol.type == Symbol.STT_VAL['FUNC'] and (symbol.bind == Symbol.STB_VAL['GLOBAL'] or (not global_only)):
-                # create kernel dict
-                kernel = Kernel()
-                kernel.section = section
-                kernel.binary = kernel.section.data
-                kernel.name = symbol.name
-                kernel.arch = self.arch
-                kernel.cubin = self
-                kernel.symbol_idx = symbol.index
-                self.kernel_dict[symbol.name] = kernel
-
-                # Extract local/global/weak binding info
-                kernel.linkage = symbol.bind
-
-                # Extract the max barrier resource identifier used and add 1. Should be 0-16.
-                # If a register is used as a barrier resource id, then this value is the max of 16.
-                kernel.bar_count = (kernel.section.sh_flags & 0x01f00000) >> 20
-
-                # Extract the number of allocated registers for this kernel.
-                kernel.reg_count = (kernel.section.sh_info & 0xff000000) >> 24
-
-                # Extract the size of shared memory this kernel uses.
-                shared_sec_name = b'.nv.shared.' + symbol.name
-                if shared_sec_name in self.section_dict:
-                    kernel.shared_section = self.section_dict[shared_sec_name]
-                    kernel.shared_size = kernel.shared_section.sh_size
-
-                # Attach constant0 section
-                constant0_sec_name = b'.nv.constant0.' + symbol.name
-                if constant0_sec_name in self.section_dict:
-                    kernel.constant0_section = self.section_dict[constant0_sec_name]
-                    kernel.constant0_size = kernel.constant0_section.sh_size
-
-                # Attach constant2 section
-                constant2_sec_name = b'.nv.constant2.' + symbol.name
-                if constant2_sec_name in self.section_dict:
-                    kernel.constant2_section = self.section_dict[constant2_sec_name]
-                    # kernel.constant2 = kernel.constant2_section.sh_size
-                    kernel.constant2 = Data(name=kernel.name,
-                                            type='constant2',
-                                            align=kernel.constant2_section.sh_addralign,
-                                            offset=0,
-                                            size=kernel.constant2_section.sh_size,
-                                            binary=kernel.constant2_section.data)
-
-                # Attach relocation section
-                rel_sec_name = b'.rel.text.' + symbol.name
-                if rel_sec_name in self.section_dict:
-                    kernel.rel_section = self.section_dict[rel_sec_name]
-                    kernel.rels = []
-                    offset = 0
-                    while offset < kernel.rel_section.sh_size:
-                        rel = Relocation()
-                        rel.unpack_binary(kernel.rel_section.data[offset:offset + kernel.rel_section.sh_entsize])
-                        rel.sym_name = self.symbols[rel.sym].name
-                        kernel.rels.append(rel)
-                        offset += kernel.rel_section.sh_entsize
-
-                # Attach relocation add section
-                rela_sec_name = b'.rela.text.' + symbol.name
-                if rela_sec_name in self.section_dict:
-                    kernel.rela_section = self.section_dict[rela_sec_name]
-                    kernel.relas = []
-                    offset = 0
-                    while offset < kernel.rela_section.sh_size:
-                        rela = RelocationAdd()
-                        rela.unpack_binary(kernel.rela_section.data[offset:offset + kernel.rela_section.sh_entsize])
-                        rela.sym_name = self.symbols[rela.sym].name
-                        kernel.relas.append(rela)
-                        offset += kernel.rela_section.sh_entsize
-
-                # Extract the kernel meta data.
-                info_sec_name = b'.nv.info.' + symbol.name
-                if info_sec_name in self.section_dict:
-                    kernel.load_info(self.section_dict[info_sec_name])
-
-        # 解析 .nv.info 其中包含每个kernel的FRAME_SIZE, MIN_STACK_SIZE, MAX_STACK_SIZE, REGCOUNT
-        info_section: Section = self.section_dict[b'.nv.info']
-        self.info_section = info_section
-        offset = 0
-        while offset < info_section.sh_size:
-            code, size = unpack('2sH', info_section.data[offset:offset + 4])
-            offset += 4
-            if code == self.EIATTR['FRAME_SIZE']:
-                kernel_idx, frame_size = unpack('II', info_section.data[offset:offset + size])
-                kernel_name = self.symbols[kernel_idx].name
-                if kernel_name in self.kernel_dict:
-                    self.kernel_dict[kernel_name].frame_size = frame_size
-            elif code == self.EIATTR['MIN_STACK_SIZE']:
-                kernel_idx, min_stack_size = unpack('II', info_section.data[offset:offset + size])
-                kernel_name = self.symbols[kernel_idx].name
-                if kernel_name in self.kernel_dict:
-                    self.kernel_dict[kernel_name].min_stack_size = min_stack_size
-            elif code == self.EIATTR['MAX_STACK_SIZE']:
-                kernel_idx, max_stack_size = unpack('II', info_section.data[offset:offset + size])
-                kernel_name = self.symbols[kernel_idx].name
-                if kernel_name in self.kernel_dict:
-                    self.kernel_dict[kernel_name].max_stack_size = max_stack_size
-            elif code == self.EIATTR['REGCOUNT']:
-                kernel_idx, reg_count = unpack('II', info_section.data[offset:offset + size])
-                # 使用 sh_info 获取 reg_count，这里也可以
-                if self.kernel_dict[self.symbols[kernel_idx].name].reg_count != reg_count:
-                    print(f'Warning: reg_count not match: '
-                          f'{self.kernel_dict[self.symbols[kernel_idx].name].reg_count} != {reg_count}')
-            else:
-                print(f'Warning: unknow nv.info '
-                      f'code: {code.hex()}, size: {size}, data: {info_section.data[offset:offset + size].hex()}.')
-            offset += size
+                self.kernel_dict.add(symbol)
+
+        self.info_section = self.section_dict[b'.nv.info']
 
         # 解析 .nv.constant3
         if b'.nv.constant3' in self.section_dict:
@@ -171,13 +112,235 @@ class Cubin(ELF):
             self.global_init_section = global_init_section
             self.global_init_dict = self.load_data(global_init_section, 'global')
 
-        if (ptx_section_name := b'.nv_debug_ptx_txt') in self.section_dict:
-            ptx = self.section_dict[ptx_section_name].data.decode().split('\x00')
-            self.ptx = ptx
+    def load_kernel(self, symbol):
+        """
+        Build the kernel of a FUNC symbol: its sections, relocations and EIATTR metadata.
+        """
+        section = self.sections[symbol.st_shndx]
+
+        # create kernel dict
+        kernel = Kernel()
+        kernel.section = section
+        kernel.binary = kernel.section.data
+        kernel.name = symbol.name
+        kernel.arch = self.arch
+        kernel.cubin = self
+        kernel.symbol_idx = symbol.index
+
+        # Extract local/global/weak binding info
+        kernel.linkage = symbol.bind
+
+        # Extract the max barrier resource identifier used and add 1. Should be 0-16.
+        # If a register is used as a barrier resource id, then this value is the max of 16.
+        kernel.bar_count = (kernel.section.sh_flags & 0x01f00000) >> 20
+
+        # Extract the number of allocated registers for this kernel.
+        kernel.reg_count = (kernel.section.sh_info & 0xff000000) >> 24
+
+        # Extract the size of shared memory this kernel uses.
+        shared_sec_name = b'.nv.shared.' + symbol.name
+        if shared_sec_name in self.section_dict:
+            kernel.shared_section = self.section_dict[shared_sec_name]
+            kernel.shared_size = kernel.shared_section.sh_size
+
+        # Attach constant0 section
+        constant0_sec_name = b'.nv.constant0.' + symbol.name
+        if constant0_sec_name in self.section_dict:
+            kernel.constant0_section = self.section_dict[constant0_sec_name]
+            kernel.constant0_size = kernel.constant0_section.sh_size
+
+        # Attach constant2 section
+        constant2_sec_name = b'.nv.constant2.' + symbol.name
+        if constant2_sec_name in self.section_dict:
+            kernel.constant2_section = self.section_dict[constant2_sec_name]
+            # kernel.constant2 = kernel.constant2_section.sh_size
+            kernel.constant2 = Data(name=kernel.name,
+                                    type='constant2',
+                                    align=kernel.constant2_section.sh_addralign,
+                                    offset=0,
+                                    size=kernel.constant2_section.sh_size,
+                                    binary=kernel.constant2_section.data)
+
+        # Attach relocation section
+        rel_sec_name = b'.rel.text.' + symbol.name
+        if rel_sec_name in self.section_dict:
+            kernel.rel_section = self.section_dict[rel_sec_name]
+            kernel.rels = []
+            offset = 0
+            while offset < kernel.rel_section.sh_size:
+                rel = Relocation()
+                rel.unpack_binary(kernel.rel_section.data[offset:offset + kernel.rel_section.sh_entsize])
+                rel.sym_name = self.symbols[rel.sym].name
+                kernel.rels.append(rel)
+                offset += kernel.rel_section.sh_entsize
+
+        # Attach relocation add section
+        rela_sec_name = b'.rela.text.' + symbol.name
+        if rela_sec_name in self.section_dict:
+            kernel.rela_section = self.section_dict[rela_sec_name]
+            kernel.relas = []
+            offset = 0
+            while offset < kernel.rela_section.sh_size:
+                rela = RelocationAdd()
+                rela.unpack_binary(kernel.rela_section.data[offset:offset + kernel.rela_section.sh_entsize])
+                rela.sym_name = self.symbols[rela.sym].name
+                kernel.relas.append(rela)
+                offset += kernel.rela_section.sh_entsize
+
+        # Extract the kernel meta data.
+        info_sec_name = b'.nv.info.' + symbol.name
+        if info_sec_name in self.section_dict:
+            kernel.load_info(self.section_dict[info_sec_name])
+
+        # .nv.info and the line info cover all kernels, they are read with the first kernel
+        if self.stack_info is None:
+            self.stack_info = self.load_stack_info()
+        for attr, value in self.stack_info.get(symbol.name, {}).items():
+            if attr == 'reg_count':
+                # 使用 sh_info 获取 reg_count，这里也可以
+                if kernel.reg_count != value:
+                    print(f'Warning: reg_count not match: {kernel.reg_count} != {value}')
+            else:
+                setattr(kernel, attr, value)
+        if self.line_info_dict is None:
+            self.line_info_dict = self.load_line_info()
+        kernel.line_info = self.line_info_dict.get(symbol.name, {})
+        return kernel
+
+    def load_stack_info(self):
+        """
+        解析 .nv.info 其中包含每个kernel的FRAME_SIZE, MIN_STACK_SIZE, MAX_STACK_SIZE, REGCOUNT
+        :return: {kernel name: {kernel attribute: value}}
+        """
+        info_section = self.info_section
+        stack_info = {}
+        offset = 0
+        while offset < info_section.sh_size:
+            code, size = unpack('2sH', info_section.data[offset:offset + 4])
+            offset += 4
+            if code in self.EIATTR_ATTR:
+                kernel_idx, value = unpack('II', info_section.data[offset:offset + size])
+                stack_info.setdefault(self.symbols[kernel_idx].name, {})[self.EIATTR_ATTR[code]] = value
+            else:
+                print(f'Warning: unknow nv.info '
+                      f'code: {code.hex()}, size: {size}, data: {info_section.data[offset:offset + size].hex()}.')
+            offset += size
+        return stack_info
+
+    def load_line_info(self):
+        """
+        :return: {kernel name: {address: line number from 0}}, empty without .nv_debug_ptx_txt
+        """
+        if (ptx_section_name := b'.nv_debug_ptx_txt') not in self.section_dict:
+            return {}
+        ptx = str(self.section_dict[ptx_section_name].data, 'utf-8').split('\x00')
+        self.ptx = ptx
+
+        line_info_dict = self.load_debug_line_info()
+        if line_info_dict is None:
+            line_info_dict = load_ptx_line_info(self.path, self.data)
+        return line_info_dict
+
+    def load_debug_line_info(self):
+        """
+        PTX line of the SASS addresses of each kernel, read from .nv_debug_line_sass, without running nvdisasm -gp.
+        :return: {kernel name: {address: line number from 0}}, None if the section cannot be used
+        """
+        if (line_section_name := b'.nv_debug_line_sass') not in self.section_dict:
+            return None
+        data = self.section_dict[line_section_name].data
+        # DW_LNE_set_address operands are relocated to the kernel text sections
+        bases = {}
+        for rel_section_name in [b'.rel' + line_section_name, b'.rela' + line_section_name]:
+            if rel_section_name not in self.section_dict:
+                continue
+            rel_section = self.section_dict[rel_section_name]
+            for offset in range(0, rel_section.sh_size, rel_section.sh_entsize):
+                entry = rel_section.data[offset:offset + rel_section.sh_entsize]
+                r_offset, r_info = unpack('<QQ', entry[:16])
+                addend = unpack('<q', entry[16:24])[0] if len(entry) >= 24 else 0
+                symbol = self.symbols[r_info >> 32]
+                section_name = self.sections[symbol.st_shndx].name
+                if section_name.startswith(b'.text.'):
+                    bases[r_offset] = (section_name[len(b'.text.'):], symbol.st_value + addend,
+                                       self.sections[symbol.st_shndx].sh_size)
+        try:
+            rows = decode_debug_line(data)
+        except (IndexError, StructError, Warning) as e:
+            print(f'Warning: cannot decode {line_section_name.decode()} ({e}), use nvdisasm -gp.')
+            return None
+
+        kernels = {}
+        for base, address, line in rows:
+            if base not in bases:
+                print(f'Warning: {line_section_name.decode()} address without relocation, use nvdisasm -gp.')
+                return None
+            kernel_name, base_address, size = bases[base]
+            # the row closing a sequence may point past the last instruction
+            if base_address + address < size:
+                # 行号改为从零开始
+                kernels.setdefault(kernel_name, {})[base_address + address] = line - 1
+        return kernels
+
+    def disassemble_sass(self, kernels, decoder='nvdisasm'):
+        """
+        nvdisasm output of kernels from a single run over the whole cubin, empty if the kernels disassemble alone.
+        Kernels found in das_cache are not counted, nvdisasm does not run if all of them are.
+        :return: {kernel name: sass lines}
+        """
+        if decoder == 'nvdisasm' and das_cache.enabled:
+            kernels = [kernel for kernel in kernels
+                       if not das_cache.contains(das_cache.key(kernel.binary, kernel.arch, decoder))]
+        if decoder != 'native' and len(kernels) > 1:
+            return disassemble_nv_cubin(self.path, self.arch, self.data)
+        return {}
+
+    def disassemble(self, kernels, decoder='nvdisasm', sass_dict=None):
+        """
+        Disassemble kernels, running nvdisasm once over the whole cubin instead of once per kernel.
+        Kernels with the same binary are decoded once, the others copy its instrs.
+        :param sass_dict: from disassemble_sass, when it already ran
+        """
+        if sass_dict is None:
+            sass_dict = self.disassemble_sass(kernels, decoder)
+        decoded = {}
+        for kernel in kernels:
+            if kernel.binary in decoded:
+                instrs, elapsed = decoded[kernel.binary]
+                kernel.disassemble(decoder, instrs=instrs)
+                self.dedup_kernels += 1
+                self.dedup_time += elapsed
+            else:
+                begin = perf_counter()
+                instrs = kernel.disassemble(decoder, sass_dict.get(kernel.name))
+                decoded[kernel.binary] = instrs, perf_counter() - begin
 
-            line_info_dict = load_ptx_line_info(self.path)
-            for kernel_name, line_info in line_info_dict.items():
-                self.kernel_dict[kernel_name].line_info = line_info
+    @staticmethod
+    def group_kernels(kernels):
+        """
+        Kernels grouped by binary, each group disassembled once.
+        :return: [[kernel, ...], ...] in the order of the first kernel of each group
+        """
+        groups = {}
+        for kernel in kernels:
+            groups.setdefault(kernel.binary, []).append(kernel)
+        return list(groups.values())
+
+    def print_dedup(self):
+        return f'Deduplicated kernels: {self.dedup_kernels}, saved {self.dedup_time:.3f}s'
+
+    def pop_dedup(self):
+        """
+        Counts since the last pop, to merge into the cubin of another process.
+        """
+        stats = self.dedup_kernels, self.dedup_time
+        self.dedup_kernels = 0
+        self.dedup_time = 0.0
+        return stats
+
+    def merge_dedup(self, stats):
+        self.dedup_kernels += stats[0]
+        self.dedup_time += stats[1]
 
     @staticmethod
     def load_data(section, type_):
@@ -343,7 +506,8 @@ class Cubin(ELF):
         # shstrtab
         shstrtab = Section()
         self.shstrtab = shstrtab
-        shstrtab.data = b'\0'
+        # string tables grow by add_sh_str and add_sym_str
+        shstrtab.data = bytearray(b'\0')
         shstrtab.name = b'.shstrtab'
         shstrtab.sh_addralign = 1
         shstrtab.sh_name = self.add_sh_str(shstrtab.name)
@@ -353,7 +517,7 @@ class Cubin(ELF):
         # strtab, symtab
         strtab = Section()
         self.strtab = strtab
-        strtab.data = b'\0'
+        strtab.data = bytearray(b'\0')
         strtab.name = b'.strtab'
         strtab.sh_addralign = 1
         strtab.sh_name = self.add_sh_str(strtab.name)
@@ -388,6 +552,7 @@ class Cubin(ELF):
             section.sh_flags = Section.SHF_VAL['A']
             section.sh_name = self.add_sh_str(section.name)
             section.sh_type = Section.SHT_VAL['PROGBITS']
+            section.data = bytearray()
             self.constant_section = section
 
         # global
@@ -404,6 +569,7 @@ class Cubin(ELF):
             section.sh_flags = Section.SHF_VAL['A'] | Section.SHF_VAL['W']
             section.sh_name = self.add_sh_str(section.name)
             section.sh_type = Section.SHT_VAL['PROGBITS']
+            section.data = bytearray()
             self.global_init_section = section
 
         # kernel sections
@@ -560,8 +726,9 @@ class Cubin(ELF):
             section.symbols.append(symbol)
             self.symbols.append(symbol)
 
+        self.symtab.data = bytearray(len(self.symbols) * self.symtab.sh_entsize)
         for i, symbol in enumerate(self.symbols):
-            self.symtab.data += symbol.pack_entry()
+            symbol.pack_entry(self.symtab.data, i * self.symtab.sh_entsize)
             symbol.index = i
             self.symbol_dict[symbol.name] = symbol
         self.symtab.sh_size = len(self.symtab.data)
@@ -571,18 +738,18 @@ class Cubin(ELF):
             kernel.gen_rels(self.symbol_dict)
 
     def gen_nv_info(self):
-        data = b''
+        # 4 EIATTRs of 12 bytes per kernel
+        data = bytearray(len(self.kernel_dict) * 48)
+        offset = 0
         for kernel in self.kernel_dict.values():
             kernel.store_info()
             size = 8
-            code = self.EIATTR['REGCOUNT']
-            data += pack('<2sHII', code, size, kernel.symbol_idx, kernel.reg_count)
-            code = self.EIATTR['MAX_STACK_SIZE']
-            data += pack('<2sHII', code, size, kernel.symbol_idx, kernel.max_stack_size)
-            code = self.EIATTR['MIN_STACK_SIZE']
-            data += pack('<2sHII', code, size, kernel.symbol_idx, kernel.min_stack_size)
-            code = self.EIATTR['FRAME_SIZE']
-            data += pack('<2sHII', code, size, kernel.symbol_idx, kernel.frame_size)
+            for code, value in [(self.EIATTR['REGCOUNT'], kernel.reg_count),
+                                (self.EIATTR['MAX_STACK_SIZE'], kernel.max_stack_size),
+                                (self.EIATTR['MIN_STACK_SIZE'], kernel.min_stack_size),
+                                (self.EIATTR['FRAME_SIZE'], kernel.frame_size)]:
+                pack_into('<2sHII', data, offset, code, size, kernel.symbol_idx, value)
+                offset += 12
         self.info_section.data = data
         self.info_section.sh_size = len(data)
 
@@ -648,12 +815,35 @@ class Cubin(ELF):
         p2.p_type = Program.SHT_VAL['LOAD']
         self.programs.append(p2)
 
-    def load_asm(self, asm_path, define_dict):
-        with open(asm_path, 'r') as f:
-            asm = f.read()
+    @staticmethod
+    def read_asm(asm_path):
+        """
+        Read asm and include its asm files, the part of load_asm that does not depend on the defines.
+        :param asm_path: asm file, - for stdin (included files are then relative to the working directory)
+        """
+        if asm_path == '-':
+            asm = sys.stdin.read()
+        else:
+            with open(asm_path, 'r') as f:
+                asm = f.read()
 
         asm = re.sub(r'//.*', '', asm)
 
+        # included .py files and embedded python code are left to load_asm
+        while True:
+            included = process_include(asm, asm_path, {}, python=False)
+            if included == asm:
+                return asm
+            asm = included
+
+    def load_asm(self, asm_path, define_dict, asm=None):
+        """
+        :param asm_path: asm file, - for stdin (included files are then relative to the working directory)
+        :param asm: asm_path already read by read_asm
+        """
+        if asm is None:
+            asm = self.read_asm(asm_path)
+
         while re.search(INCLUDE_RE, asm) or re.search(PYTHON_RE, asm):
             # include nested files
             asm = process_include(asm, asm_path, define_dict)
@@ -0,0 +1,679 @@
+from struct import unpack_from
+
+from .grammar import *
+
+
+def fmt_r(value, mask):
+    return 'RZ' if value == 0xff else f'R{value}'
+
+
+def fmt_ur(value, mask):
+    return 'URZ' if value == 0x3f else f'UR{value}'
+
+
+def fmt_p(value, mask):
+    return 'PT' if value == 7 else f'P{value}'
+
+
+def fmt_up(value, mask):
+    return 'UPT' if value == 7 else f'UP{value}'
+
+
+def fmt_pq(value, mask):
+    # p64q stores the predicate inverted
+    return fmt_p(value ^ 7, mask)
+
+
+def fmt_b(value, mask):
+    return f'B{value}'
+
+
+def fmt_u(value, mask):
+    return hex(value)
+
+
+def fmt_i(value, mask):
+    # two's complement over the width of the field
+    width = mask.bit_length()
+    if value >> (width - 1):
+        return f'-{(1 << width) - value:#x}'
+    return hex(value)
+
+
+def fmt_c(value, mask):
+    return hex(value << 2)
+
+
+def fmt_i64w3s5w5(value, mask):
+    return hex(value & 0x7 | (value >> 5) & 0xf8)
+
+
+def fmt_ra(value, mask):
+    # r8a flips the RZ of the rule code, R0 reads as 0xff
+    return fmt_r(value ^ 0xff, mask)
+
+
+def fmt_i20(value, mask):
+    # 19 bits and the sign at bit 56, set by the neg flag
+    if value >> 36:
+        return f'-{0x80000 - (value & 0x7ffff):#x}'
+    return hex(value)
+
+
+# (shift, mask, format) of each operand bit field, the inverse of operands
+operand_fields = {
+    # Pascal
+    'i8w8': (8, 0xf, fmt_u),
+    'i20': (20, 0x100007ffff, fmt_i20),
+    'i20w6': (20, 0x3f, fmt_u),
+    'i20w8': (20, 0xff, fmt_u),
+    'i20w12': (20, 0xfff, fmt_i),
+    'i20w24': (20, 0xffffff, fmt_i),
+    'i20w32': (20, 0xffffffff, fmt_i),
+    'i28w8': (28, 0xff, fmt_u),
+    'i28w5': (28, 0x1f, fmt_u),
+    'i28w20': (28, 0xfffff, fmt_i),
+    'i30w22': (28, 0xffffff, fmt_i),
+    'i34w13': (34, 0x1fff, fmt_u),
+    'i39w5': (39, 0x1f, fmt_u),
+    'i48w8': (48, 0xff, fmt_u),
+    'i51w5': (51, 0x1f, fmt_u),
+    'c20': (20, 0x3fff, fmt_c),
+    'c34': (34, 0x1f, fmt_u),
+    'c36': (36, 0x1f, fmt_u),
+    'r0': (0, 0xff, fmt_r),
+    'r8': (8, 0xff, fmt_r),
+    'r8a': (8, 0xff, fmt_ra),
+    'r20': (20, 0xff, fmt_r),
+    'r39': (39, 0xff, fmt_r),
+    'r39a': (39, 0xff, fmt_r),
+    'p0': (0, 0x7, fmt_p),
+    'p3': (3, 0x7, fmt_p),
+    'p12': (12, 0x7, fmt_p),
+    'p29': (29, 0x7, fmt_p),
+    'p39': (39, 0x7, fmt_p),
+    'p45': (45, 0x7, fmt_p),
+    'p48': (48, 0x7, fmt_p),
+    'p48q': (48, 0x7, fmt_pq),
+    'p58': (58, 0x7, fmt_p),
+    # Turing
+    'i16w8': (16, 0xff, fmt_u),
+    'i32': (32, 0xffffffff, fmt_i),
+    'i32a4': (32, 0x3fffffffffffc, fmt_i),
+    'i32w32': (32, 0xffffffff, fmt_i),
+    'i38w6': (38, 0x3f, fmt_u),
+    'i38w16': (38, 0xffff, fmt_i),
+    'i40w13': (40, 0x1fff, fmt_u),
+    'i40w24': (40, 0xffffff, fmt_i),
+    'i53w5': (53, 0x1f, fmt_u),
+    'i54w4': (54, 0xf, fmt_u),
+    'i64w3s5w5': (64, 0x1fff, fmt_i64w3s5w5),
+    'i72w4': (72, 0xf, fmt_u),
+    'i75w5': (75, 0x1f, fmt_u),
+    'i72w8': (72, 0xff, fmt_u),
+    'c40': (40, 0x3fff, fmt_c),
+    'c54': (54, 0x1f, fmt_u),
+    'b16': (16, 0xf, fmt_b),
+    'r16': (16, 0xff, fmt_r),
+    'r24': (24, 0xff, fmt_r),
+    'r32': (32, 0xff, fmt_r),
+    'r64': (64, 0xff, fmt_r),
+    'ur16': (16, 0x3f, fmt_ur),
+    'ur24': (24, 0x3f, fmt_ur),
+    'ur32': (32, 0x3f, fmt_ur),
+    'ur64': (64, 0x3f, fmt_ur),
+    'p64q': (64, 0x7, fmt_pq),
+    'p68': (68, 0x7, fmt_p),
+    'p77': (77, 0x7, fmt_p),
+    'p81': (81, 0x7, fmt_p),
+    'p84': (84, 0x7, fmt_p),
+    'p87': (87, 0x7, fmt_p),
+    'up68': (68, 0x7, fmt_up),
+    'up77': (77, 0x7, fmt_up),
+    'up81': (81, 0x7, fmt_up),
+    'up84': (84, 0x7, fmt_up),
+    'up87': (87, 0x7, fmt_up),
+}
+
+CODE_MASK = (1 << 105) - 1
+CODE_MASK_61 = (1 << 64) - 1
+CTRL_EX_OPS = ['LD', 'LDG', 'ST', 'STG', 'ATOM', 'ATOMG', 'RED']
+
+
+def ctrl_ex_mask(op, arch):
+    # the sm_8x schedule bits written by encode_ctrl_ex
+    if 80 <= arch < 90 and op in CTRL_EX_OPS:
+        return 0x3f << (32 if op in ['LD', 'LDG'] else 64)
+    return 0
+
+
+def node_names(nodes):
+    # names of the groups in nodes
+    names = set()
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node[0] == 'group':
+            if node[1]:
+                names.add(node[1])
+            stack += node[2]
+        elif node[0] == 'branch':
+            for branch in node[1]:
+                stack += branch
+        elif node[0] == 'repeat':
+            stack += node[3]
+    return names
+
+
+def pattern_nodes(pattern, group_names):
+    """
+    Convert a parsed rule into the nodes rendered by RuleDecoder:
+    ('text', str), ('group', name, nodes, can be empty), ('branch', [nodes]) and
+    ('repeat', min, max, nodes, names of the groups inside, kind of an unnamed literal repeat).
+    """
+    nodes = []
+    for op, av in pattern:
+        if op is sre_constants.LITERAL:
+            nodes.append(('text', chr(av)))
+        elif op in (sre_constants.IN, sre_constants.ANY, sre_constants.NOT_LITERAL):
+            chars = sig_charset(op, av)
+            nodes.append(('text', ' ' if ' ' in chars else min(chars)))
+        elif op is sre_constants.SUBPATTERN:
+            sub_pattern = av[-1]
+            nodes.append(('group', group_names.get(av[0]), pattern_nodes(sub_pattern, group_names),
+                          sub_pattern.getwidth()[0] == 0))
+        elif op is sre_constants.BRANCH:
+            nodes.append(('branch', [pattern_nodes(branch, group_names) for branch in av[1]]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_, max_, sub_pattern = av
+            sub_nodes = pattern_nodes(sub_pattern, group_names)
+            names = node_names(sub_nodes)
+            text = ''.join(node[1] for node in sub_nodes if node[0] == 'text')
+            kind = text if len(sub_nodes) == 1 and sub_nodes[0][0] == 'text' else ''
+            nodes.append(('repeat', min_, max_, sub_nodes, names, kind))
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            pass
+        else:
+            raise Exception(f'Unsupported rule pattern {op}')
+    return nodes
+
+
+def group_source(rule, name):
+    # the regex of group name in rule
+    begin = rule.index(f'(?P<{name}>') + len(f'(?P<{name}>')
+    depth = 1
+    i = begin
+    in_class = False
+    while depth:
+        c = rule[i]
+        if c == '\\':
+            i += 1
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        i += 1
+    return rule[begin:i - 1]
+
+
+class RuleDecoder:
+    """
+    Inverse of one grammar rule: fixed opcode bits, and the text of its flag, operand and reuse groups read back
+    from a code. Every rendered text is re-assembled and kept only if it gives the same code.
+    """
+    max_budget = 3
+    max_tries = 256
+
+    def __init__(self, op, gram, arch):
+        self.op = op
+        self.gram = gram
+        self.arch = arch
+        self.flag = get_flags(arch).get(op, {})
+        group_index = re.compile(gram['rule']).groupindex
+        self.names = list(group_index)
+        self.nodes = pattern_nodes(sre_parse.parse(gram['rule']), {v: k for k, v in group_index.items()})
+        if arch < 70:
+            self.code_mask = CODE_MASK_61
+            self.jump_operand, self.jump_next, self.rel_jump_op = 'i20w24', 0x8, rel_jump_op_61
+        else:
+            self.code_mask = CODE_MASK
+            self.jump_operand, self.jump_next, self.rel_jump_op = 'i32a4', 0x10, rel_jump_op_75
+        # SSY, CAL and PBK keep the predicate bits of their rule code
+        self.no_pred = 'noPred' in self.names
+
+        variable = ctrl_ex_mask(op, arch)
+        if not self.no_pred:
+            variable |= 0xf << (16 if arch < 70 else 12)
+        self.fields = {}
+        self.group_patterns = {}
+        for name in self.names:
+            if name in self.flag:
+                self.group_patterns[name] = re.compile(group_source(gram['rule'], name))
+            field = 0
+            if name in operand_fields:
+                shift, mask, fmt = operand_fields[name]
+                field |= mask << shift
+                # bits set by the operand whatever its value, like the immediate bit of i20w8
+                try:
+                    field |= operands[name](fmt(0, mask))
+                except Exception:
+                    pass
+            for value in self.flag.get(name, {}).values():
+                field |= value
+            self.fields[name] = field
+            variable |= field
+        self.fixed_mask = self.code_mask & ~variable
+        self.fixed = gram['code'] & self.fixed_mask
+
+        # an operand field ends where the next operand of the rule begins, like the offset before the bank of LDC
+        self.operand_fields = {}
+        for name in self.names:
+            if name in operand_fields:
+                shift, mask, fmt = operand_fields[name]
+                for other in self.names:
+                    if other in operand_fields and operand_fields[other][0] > shift:
+                        other_shift, other_mask, _ = operand_fields[other]
+                        mask &= ~(other_mask << other_shift >> shift)
+                self.operand_fields[name] = shift, mask, fmt
+
+    def group_values(self, code, addr, reuse):
+        """
+        :return: {group name: candidate texts in order of preference, None for absent and True for any text of
+                 the group}, groups without bits of their own are left out
+        """
+        residual = (code ^ self.gram['code']) & self.code_mask & ~ctrl_ex_mask(self.op, self.arch)
+        values = {}
+        for name in self.names:
+            flag = self.flag.get(name)
+            bits = residual & self.fields[name]
+            if name in ('reuse1', 'reuse2', 'reuse3'):
+                values[name] = ['.reuse' if reuse & (1 << int(name[-1]) - 1) else None]
+            elif name in self.operand_fields:
+                shift, mask, fmt = self.operand_fields[name]
+                text = fmt((residual >> shift) & mask, mask)
+                absent = flag.get('DEFAULT', 0) if flag else 0
+                try:
+                    present = operands[name](text)
+                except Exception:
+                    values[name] = [None]
+                    continue
+                if flag:
+                    present ^= flag.get(text, flag.get('ALL', 0))
+                if name == self.jump_operand and self.op in self.rel_jump_op:
+                    # printed as the absolute target, relative to the next instruction
+                    text = (text, hex(addr + self.jump_next + int(text, base=0)))
+                if present == absent or bits == absent != present:
+                    values[name] = [None, text]
+                else:
+                    values[name] = [text, None]
+            elif flag:
+                absent = flag.get('DEFAULT', 0)
+                # some rules leave the leading . of the flag out of the group
+                pattern = self.group_patterns[name]
+                options = [(k if pattern.fullmatch(k) else k[1:], v) for k, v in flag.items()
+                           if k not in ('DEFAULT', 'ALL') and (pattern.fullmatch(k) or pattern.fullmatch(k[1:]))]
+                exact = [k for k, v in options if v == bits]
+                subset = sorted([(k, v) for k, v in options if v and v & ~bits == 0 and k not in exact],
+                                key=lambda x: -bin(x[1]).count('1'))
+                # flags encoding as nothing at all are left out, like nvdisasm does
+                if absent == bits:
+                    values[name] = [None] + exact + [k for k, _ in subset]
+                else:
+                    values[name] = exact + [k for k, _ in subset] + [None]
+                if 'ALL' in flag:
+                    # any text of the group, True renders it from its own pattern
+                    if flag['ALL'] and bits & flag['ALL'] == flag['ALL']:
+                        values[name].insert(0, True)
+                    else:
+                        values[name].append(True)
+        # a ! also set by the DEFAULT of its predicate, like the !PT that IADD3 and IMAD leave out, is absent too
+        defaults = 0
+        for name in self.operand_fields:
+            if values.get(name, [None])[0] is None:
+                defaults |= self.flag.get(name, {}).get('DEFAULT', 0)
+        for name, texts in values.items():
+            bits = residual & self.fields[name]
+            if name not in self.operand_fields and isinstance(texts[0], str) and None in texts and bits \
+                    and bits & ~defaults == 0 and 'DEFAULT' not in self.flag.get(name, {}):
+                values[name] = [None] + [text for text in texts if text is not None]
+        return values
+
+    def render(self, nodes, i, values, prefix, budget):
+        """
+        Texts of nodes[i:] after prefix, taking at most budget choices other than the preferred one.
+        :return: generator of (text, budget left)
+        """
+        if i == len(nodes):
+            yield prefix, budget
+            return
+        node = nodes[i]
+        kind = node[0]
+        if kind == 'text':
+            yield from self.render(nodes, i + 1, values, prefix + node[1], budget)
+            return
+        if kind == 'group':
+            name = node[1]
+            if name not in values:
+                for p, b in self.render(node[2], 0, values, prefix, budget):
+                    yield from self.render(nodes, i + 1, values, p, b)
+                return
+            texts = []
+            for text in values[name]:
+                if text is None:
+                    if node[3]:
+                        texts.append('')
+                else:
+                    texts.append(text[0] if isinstance(text, tuple) else text)
+            for j, text in enumerate(texts[:budget + 1]):
+                if text is True:
+                    for p, b in self.render(node[2], 0, values, prefix, budget - (j > 0)):
+                        yield from self.render(nodes, i + 1, values, p, b)
+                else:
+                    yield from self.render(nodes, i + 1, values, prefix + text, budget - (j > 0))
+        elif kind == 'branch':
+            # branches whose groups have a value first
+            branches = sorted(node[1], key=lambda branch: -self.wanted(node_names(branch), values))
+            for j, branch in enumerate(branches[:budget + 1]):
+                for p, b in self.render(branch, 0, values, prefix, budget - (j > 0)):
+                    yield from self.render(nodes, i + 1, values, p, b)
+        else:
+            _, min_, max_, sub_nodes, names, literal = node
+            if min_ > 0:
+                counts = [min_]
+            elif names:
+                # nvdisasm prints all the optional operands ending an instruction or none of them, like P0, !PT
+                counts = [1, 0] if self.wanted(self.trailing_names(nodes, i) or names, values) else [0, 1]
+            elif literal == '|':
+                # close an opened |
+                counts = [1, 0] if prefix.count('|') % 2 else [0, 1]
+            elif literal == '+':
+                counts = [0, 1] if prefix.endswith('[') else [1, 0]
+            elif literal == ',':
+                # a separator of the DEPBAR barrier list, when a group after it has a value
+                counts = [1, 0] if prefix[-1:].isalnum() and self.wanted(node_names(nodes[i + 1:]), values) else [0, 1]
+            else:
+                counts = [0, 1]
+            for j, count in enumerate(counts[:budget + 1]):
+                for p, b in self.repeat(sub_nodes, count, values, prefix, budget - (j > 0)):
+                    yield from self.render(nodes, i + 1, values, p, b)
+
+    def repeat(self, nodes, count, values, prefix, budget):
+        if count == 0:
+            yield prefix, budget
+            return
+        for p, b in self.render(nodes, 0, values, prefix, budget):
+            yield from self.repeat(nodes, count - 1, values, p, b)
+
+    @staticmethod
+    def trailing_names(nodes, i):
+        """
+        :return: names of the groups of the optional operands ending the rule, when nodes[i] is one of them
+        """
+        def optional(node):
+            # (, operand)? and not a suffix like (.H0)?
+            return node[0] == 'repeat' and node[1] == 0 and node[4] and node[3][0][0] == 'group' \
+                and node[3][0][2][:1] == [('text', ',')]
+
+        if not optional(nodes[i]):
+            return set()
+        end = i + 1
+        while end < len(nodes) and optional(nodes[end]):
+            end += 1
+        if nodes[end:] != [('text', ';')]:
+            return set()
+        begin = i
+        while begin > 0 and optional(nodes[begin - 1]):
+            begin -= 1
+        return set().union(*(node[4] for node in nodes[begin:end]))
+
+    @staticmethod
+    def wanted(names, values):
+        # number of groups inside with a value to print
+        return sum(values[name][0] is not None for name in names if name in values)
+
+    def texts(self, values):
+        # texts with fewer choices other than the preferred one first
+        for budget in range(self.max_budget + 1):
+            for text, b in self.render(self.nodes, 0, values, '', budget):
+                if b == 0:
+                    yield text
+
+    def decode(self, code, addr, instr, ctrl_code):
+        """
+        :param ctrl_code: the 21 control bits, reuse included, of code
+        :return: (op, rest) assembling back to code, None if no text of this rule does.
+        """
+        values = self.group_values(code, addr, (ctrl_code >> 17) & 0xf)
+        matcher = get_decode_matcher(self.arch)
+        for n, text in enumerate(self.texts(values)):
+            if n >= self.max_tries:
+                break
+            if not text.startswith(self.op):
+                continue
+            rest = text[len(self.op):]
+            gram, captured_dict = matcher.match(self.op, rest)
+            if gram is None:
+                continue
+            ctrl, code_test = encode_instruction(self.op, gram, captured_dict, instr, self.arch)
+            if ctrl == ctrl_code and code_test == code & self.code_mask:
+                target = values.get(self.jump_operand)
+                if isinstance(target, list) and isinstance(target[0], tuple):
+                    rel, abs_ = target[0]
+                    if rest.endswith(f'{rel};'):
+                        rest = f'{rest[:-len(rel) - 1]}{abs_};'
+                return self.op, rest
+        return None
+
+
+class OpcodeIndex:
+    """
+    Decision tree over the fixed opcode bits of the rules of one arch. A node looks up the bits fixed in all of its
+    rules, or in most of them with the other rules in a subtree of their own, so identifying a code takes a few dict
+    lookups instead of trying every rule.
+    """
+
+    def __init__(self, decoders):
+        # decoders in order of preference
+        self.decoders = decoders
+        self.code_mask = decoders[0].code_mask
+        self.root = self.build(list(enumerate(decoders)), 0)
+
+    def build(self, entries, tested):
+        """
+        :param entries: (rank, decoder)
+        :param tested: bits looked up by the parent nodes
+        :return: (mask, {code & mask: node}, node of the rules not fixing all of mask or None), or a leaf list of
+                 entries
+        """
+        if len(entries) < 2:
+            return entries
+        mask = self.code_mask & ~tested
+        for _, decoder in entries:
+            mask &= decoder.fixed_mask
+        others = []
+        if not mask:
+            # bits fixed in most rules
+            for i in range(self.code_mask.bit_length()):
+                bit = 1 << i
+                if not tested & bit and sum(bool(d.fixed_mask & bit) for _, d in entries) * 2 > len(entries):
+                    mask |= bit
+            others = [e for e in entries if e[1].fixed_mask & mask != mask]
+            if not mask or len(others) == len(entries):
+                return entries
+        children = {}
+        for entry in entries:
+            if entry[1].fixed_mask & mask == mask:
+                children.setdefault(entry[1].fixed & mask, []).append(entry)
+        children = {value: self.build(child, tested | mask) for value, child in children.items()}
+        return mask, children, self.build(others, tested) if others else None
+
+    def lookup(self, code):
+        """
+        :return: decoders whose fixed bits match code, in order of preference
+        """
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            if isinstance(node, tuple):
+                mask, children, others = node
+                nodes.append(others)
+                nodes.append(children.get(code & mask))
+            else:
+                found += [entry for entry in node if not (code ^ entry[1].fixed) & entry[1].fixed_mask]
+        if len(found) > 1:
+            found.sort(key=lambda entry: entry[0])
+        return [decoder for _, decoder in found]
+
+    def overlaps(self):
+        """
+        Pairs of rules whose fixed bits both match some code.
+        :return: [(kind, preferred decoder, other decoder)], kind 'same' for the same fixed bits, 'shadowed' when the
+                 fixed bits of other are a subset of the ones of preferred, else 'ambiguous'
+        """
+        result = []
+        for i, a in enumerate(self.decoders):
+            for b in self.decoders[i + 1:]:
+                if (a.fixed ^ b.fixed) & a.fixed_mask & b.fixed_mask:
+                    continue
+                if a.fixed_mask == b.fixed_mask:
+                    kind = 'same'
+                elif b.fixed_mask & ~a.fixed_mask == 0:
+                    kind = 'shadowed'
+                else:
+                    kind = 'ambiguous'
+                result.append((kind, a, b))
+        return result
+
+
+# flags key: RuleDecoders, most fixed bits first
+arch_decoders = {}
+# flags key: OpcodeIndex
+arch_indexes = {}
+# 61 or 75: GrammarMatcher
+decode_matchers = {}
+
+
+def get_decoders(arch):
+    key = 61 if arch < 70 else 75 if arch < 80 else 86
+    if key not in arch_decoders:
+        grammar = grammar_61 if arch < 70 else grammar_75
+        decoders = [RuleDecoder(op, gram, arch) for op, rules in grammar.items() for gram in rules]
+        decoders.sort(key=lambda d: -bin(d.fixed_mask).count('1'))
+        arch_decoders[key] = decoders
+    return arch_decoders[key]
+
+
+def get_decode_matcher(arch):
+    """
+    Get the matcher checking candidate texts of grammar_61 (arch < 70) or grammar_75. It is kept apart from
+    get_matcher so that the texts tried while decoding neither fill match_cache nor count in rule_profile.
+    """
+    key = 61 if arch < 70 else 75
+    if key not in decode_matchers:
+        decode_matchers[key] = GrammarMatcher(grammar_61 if key == 61 else grammar_75, name=f'{key}')
+    return decode_matchers[key]
+
+
+def get_opcode_index(arch):
+    key = 61 if arch < 70 else 75 if arch < 80 else 86
+    if key not in arch_indexes:
+        arch_indexes[key] = OpcodeIndex(get_decoders(arch))
+    return arch_indexes[key]
+
+
+def check_opcode_index(arch):
+    """
+    Print the grammar rules of arch whose encodings overlap.
+    :return: number of overlapping pairs
+    """
+    grammar = grammar_61 if arch < 70 else grammar_75
+
+    def rule_name(decoder):
+        i = next(i for i, gram in enumerate(grammar[decoder.op]) if gram is decoder.gram)
+        return f'{decoder.op}[{i}]'
+
+    overlaps = get_opcode_index(arch).overlaps()
+    for kind, a, b in overlaps:
+        if kind == 'same':
+            print(f'Warning: {rule_name(a)} and {rule_name(b)} have the same opcode bits '
+                  f'{a.fixed:#x}/{a.fixed_mask:#x}.')
+        elif kind == 'shadowed':
+            print(f'Warning: {rule_name(b)} overlaps {rule_name(a)}, tried after it, '
+                  f'bits {a.fixed_mask & ~b.fixed_mask:#x} tell them apart.')
+        else:
+            print(f'Warning: {rule_name(a)} and {rule_name(b)} are ambiguous, '
+                  f'bits {a.fixed_mask & ~b.fixed_mask:#x} and {b.fixed_mask & ~a.fixed_mask:#x} are only fixed '
+                  f'in one of them.')
+    rules = len(get_decoders(arch))
+    print(f'sm_{arch}: {rules} rules, {len(overlaps)} overlapping pairs.')
+    return len(overlaps)
+
+
+def decode_instruction(code, addr, arch, ctrl_code=0):
+    """
+    Decode one 128-bit Volta+ instruction, or one 64-bit Maxwell/Pascal instruction, without nvdisasm.
+    :param ctrl_code: Maxwell/Pascal only, the 21 bits of code in its group header (see decode_ctrls)
+    :return: instr dict as Kernel.disassemble makes it from nvdisasm output (without line_num and label),
+             None if no grammar rule assembles to code.
+    """
+    if arch < 70:
+        p = (code >> 16) & 0xf
+        code_str = f'{code:#018x}'
+    else:
+        p = (code >> 12) & 0xf
+        ctrl_code = code >> 105
+        code_str = f'{code:#034x}'
+    pred_not = '!' if p & 0x8 else None
+    if p == 7:
+        pred, pred_reg = '', None
+    else:
+        pred_reg = 'PT' if p & 0x7 == 7 else f'P{p & 0x7}'
+        pred = f'@{pred_not or ""}{pred_reg}'
+    for decoder in get_opcode_index(arch).lookup(code):
+        ctrl = decode_ctrl(ctrl_code) if arch < 70 else decode_sass_ctrl(code, decoder.op, arch)
+        if decoder.no_pred:
+            instr = {'ctrl': print_ctrl(ctrl), 'pred': '', 'pred_reg': None, 'pred_not': None}
+        else:
+            instr = {'ctrl': print_ctrl(ctrl), 'pred': pred, 'pred_reg': pred_reg, 'pred_not': pred_not}
+        result = decoder.decode(code, addr, instr, ctrl_code)
+        if result:
+            op, rest = result
+            return {'ctrl': print_ctrl(ctrl), **ctrl, 'addr': f'{addr:04x}', 'pred': instr['pred'],
+                    'pred_not': instr['pred_not'], 'pred_reg': instr['pred_reg'], 'op': op, 'rest': rest,
+                    'code': code_str}
+    return None
+
+
+def disassemble_native(binary, arch):
+    """
+    In-process counterpart of disassemble_nv, decoding binary with the grammar tables.
+    :return: instr dicts of Kernel.disassemble
+    """
+    if arch >= 90:
+        raise Exception(f'Native decoder does not support arch {arch}.')
+    words = []
+    if arch < 70:
+        # a group header of 3 control codes, then its 3 instructions
+        for group_addr in range(0, len(binary) - len(binary) % 32, 32):
+            ctrls = unpack_from('<Q', binary, group_addr)[0]
+            for i, code in enumerate(unpack_from('<3Q', binary, group_addr + 8)):
+                words.append((group_addr + (i + 1) * 8, code, (ctrls >> (21 * i)) & 0x1fffff))
+    else:
+        for addr in range(0, len(binary) - len(binary) % 16, 16):
+            lo, hi = unpack_from('<QQ', binary, addr)
+            words.append((addr, hi << 64 | lo, 0))
+    instrs = []
+    for addr, code, ctrl_code in words:
+        instr = decode_instruction(code, addr, arch, ctrl_code)
+        if instr is None:
+            code_str = f'{code:#018x}' if arch < 70 else f'{code:#034x}'
+            raise Exception(f'Native decoder cannot decode /*{addr:04x}*/ {code_str}, try --decoder nvdisasm.')
+        instrs.append({'line_num': len(instrs), 'label': '', **instr})
+    return instrs
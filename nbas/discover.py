@@ -0,0 +1,319 @@
+import sqlite3
+
+from .cubin import *
+
+# kind of an operand token, checked in order
+OPERAND_KINDS = [
+    ('up', r'^U?PT$|^UP\d+$'),
+    ('p', r'^P[T\d]$'),
+    ('ur', r'^UR[Z\d]+'),
+    ('r', r'^R[Z\d]+'),
+    ('c', r'^c\['),
+    ('mem', r'^\['),
+    ('b', r'^B\d+$'),
+    ('i', r'^[+\-]?(0x[0-9a-f]+|\d+(\.\d*)?(e[+\-]?\d+)?|INF|QNAN)$'),
+]
+
+
+def split_instr(instr):
+    """
+    :return: op, guard, flags (the .XXX after op), operand tokens of a sass instr
+    """
+    m = re.search(r'^((?:\.\w+)*)\s*(.*?)\s*;?$', instr['rest'])
+    tokens = [o.strip() for o in m.group(2).split(',')] if m.group(2) else []
+    return instr['op'], instr['pred'], m.group(1), tokens
+
+
+def operand_kind(token):
+    # modifiers (neg, not, abs, reuse) do not change the kind
+    token = re.sub(r'\.reuse$', '', token.lstrip('-~!|').rstrip('|'))
+    for kind, pattern in OPERAND_KINDS:
+        if re.search(pattern, token):
+            return kind
+    return 'other'
+
+
+def classify_bit(base, variant):
+    """
+    What flipping one bit did to the disassembly of base.
+    :return: (kind, operand index or -1), kind is unused, opcode, guard, flag, modifier or an OPERAND_KINDS kind
+    """
+    if isinstance(variant, Warning):
+        return 'opcode', -1
+    op, pred, flags, tokens = split_instr(base)
+    op_, pred_, flags_, tokens_ = split_instr(variant)
+    if op != op_ or len(tokens) != len(tokens_):
+        return 'opcode', -1
+    if pred != pred_:
+        return 'guard', -1
+    if flags != flags_:
+        return 'flag', -1
+    changed = [i for i, (a, b) in enumerate(zip(tokens, tokens_)) if a != b]
+    if not changed:
+        return 'unused', -1
+    if len(changed) > 1:
+        return 'other', -1
+    i = changed[0]
+    a, b = tokens[i], tokens_[i]
+    if re.sub(r'[\-~!|]', '', a) == re.sub(r'[\-~!|]', '', b):
+        return 'modifier', i
+    return operand_kind(b), i
+
+
+def bit_fields(bits):
+    """
+    Group consecutive bits of the same kind and operand.
+    :param bits: {bit: (kind, operand)}
+    :return: [(kind, operand, start, width)]
+    """
+    fields = []
+    for bit in sorted(bits):
+        kind, operand = bits[bit]
+        if kind == 'unused':
+            continue
+        if fields and fields[-1][:2] == (kind, operand) and sum(fields[-1][2:]) == bit:
+            kind, operand, start, width = fields[-1]
+            fields[-1] = (kind, operand, start, width + 1)
+        else:
+            fields.append((kind, operand, bit, 1))
+    return fields
+
+
+class Discovery:
+    """
+    Sweeps the bits of seed instructions through nvdisasm and classifies them into opcode, flag, register,
+    predicate and immediate fields. Every disassembled code and the results are kept in a SQLite database, so runs
+    can be repeated (replay=True) without nvdisasm.
+    """
+
+    def __init__(self, db_path, arch, jobs=1, replay=False):
+        self.arch = arch
+        self.jobs = jobs
+        self.replay = replay
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS observations (
+                arch INTEGER, code TEXT, op TEXT, pred TEXT, rest TEXT, error TEXT, PRIMARY KEY (arch, code));
+            CREATE TABLE IF NOT EXISTS bits (
+                arch INTEGER, seed TEXT, op TEXT, bit INTEGER, kind TEXT, operand INTEGER,
+                PRIMARY KEY (arch, seed, bit));
+            CREATE TABLE IF NOT EXISTS flags (
+                arch INTEGER, seed TEXT, op TEXT, start INTEGER, width INTEGER, value INTEGER, text TEXT,
+                PRIMARY KEY (arch, seed, start, value));
+        ''')
+        # bits of the guard predicate and of the control codes are known
+        if arch < 70:
+            self.bits = [i for i in range(64) if not 16 <= i < 20]
+        else:
+            self.bits = [i for i in range(105) if not 12 <= i < 16]
+
+    def disassemble(self, codes):
+        """
+        Disassemble codes, from the observations when recorded.
+        :return: [instr, or Warning]
+        """
+        width = 18 if self.arch < 70 else 34
+        keys = [f'{code:#0{width}x}' for code in codes]
+        known = {}
+        for key in set(keys):
+            row = self.db.execute('SELECT op, pred, rest, error FROM observations WHERE arch = ? AND code = ?',
+                                  (self.arch, key)).fetchone()
+            if row:
+                known[key] = Warning(row[3]) if row[3] is not None else {'op': row[0], 'pred': row[1], 'rest': row[2]}
+        missing = sorted(set(keys) - set(known))
+        if missing:
+            if self.replay:
+                raise Exception(f'{len(missing)} codes not recorded in the database, run without --replay.')
+            _, nop_group = detect_code(0, self.arch)
+            instrs = disassemble_variants([int(key, base=0) for key in missing], self.arch, nop_group, self.jobs)
+            for key, instr in zip(missing, instrs):
+                if isinstance(instr, Warning):
+                    row = (self.arch, key, None, None, None, f'{instr}')
+                else:
+                    row = (self.arch, key, instr['op'], instr['pred'], instr['rest'], None)
+                self.db.execute('INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?, ?)', row)
+                known[key] = instr
+            self.db.commit()
+        return [known[key] for key in keys]
+
+    def sweep(self, seed):
+        """
+        Classify every bit of seed, then enumerate the values of its flag fields.
+        :return: base instr, [(kind, operand, start, width)], [(order, flag start, {value << start: flag text})]
+        """
+        code, _ = detect_code(seed, self.arch)
+        base, *variants = self.disassemble([code] + [code ^ (1 << bit) for bit in self.bits])
+        if isinstance(base, Warning):
+            raise Exception(f'Cannot disassemble seed {seed:#x}: {base}')
+        bits = {bit: classify_bit(base, variant) for bit, variant in zip(self.bits, variants)}
+        key = f'{seed:#x}'
+        self.db.executemany('INSERT OR REPLACE INTO bits VALUES (?, ?, ?, ?, ?, ?)',
+                            [(self.arch, key, base['op'], bit, kind, operand) for bit, (kind, operand) in bits.items()])
+
+        fields = []
+        # flag fields are swept over all their values, 8 bits at most
+        for kind, operand, start, width in bit_fields(bits):
+            while kind == 'flag' and width > 8:
+                fields.append((kind, operand, start, 8))
+                start, width = start + 8, width - 8
+            fields.append((kind, operand, start, width))
+        flags = []
+        for kind, operand, start, width in fields:
+            if kind != 'flag':
+                continue
+            mask = ((1 << width) - 1) << start
+            values = list(range(1 << width))
+            instrs = self.disassemble([code & ~mask | value << start for value in values])
+            # flags printed for every value come from other fields
+            tokens = {value: re.findall(r'\.\w+', split_instr(instr)[2]) for value, instr in zip(values, instrs)
+                      if not isinstance(instr, Warning) and instr['op'] == base['op']}
+            common = set.intersection(*(set(t) for t in tokens.values())) if tokens else set()
+            tokens = {value: [token for token in t if token not in common] for value, t in tokens.items()}
+            self.db.executemany('INSERT OR REPLACE INTO flags VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [(self.arch, key, base['op'], start, width, value, ''.join(t))
+                                 for value, t in tokens.items()])
+            # flags of one field keep the order nvdisasm prints them in
+            position = {}
+            for t in tokens.values():
+                for i, token in enumerate(t):
+                    position[token] = min(position.get(token, i), i)
+            for offset, texts in split_flag_field(tokens, width):
+                order = min((position[re.findall(r'\.\w+', text)[0]] for text in texts.values() if text), default=0)
+                flags.append(((start, order), start + offset, {value << start: text for value, text in texts.items()}))
+        self.db.commit()
+        return base, fields, flags
+
+    def rule(self, seed, base, fields, flags):
+        """
+        Candidate grammar entry and flags_str blocks of a swept seed.
+        :return: rule line, flags_str text, operand names missing from operands
+        """
+        op, _, _, operands_ = split_instr(base)
+        variable = 0
+        for kind, operand, start, width in fields:
+            if kind not in ('opcode', 'other'):
+                variable |= ((1 << width) - 1) << start
+        code = seed & ~variable & ((1 << (64 if self.arch < 70 else 105)) - 1)
+        if self.arch < 70:
+            code &= ~(0xf << 16)
+        else:
+            code &= ~(0xf << 12)
+
+        # flags named after their only flag when there is one
+        flag_rules = ''
+        flags_str = ''
+        for _, start, values in sorted(flags, key=lambda flag: flag[0]):
+            texts = {value: text for value, text in values.items() if text}
+            if not texts:
+                continue
+            names = sorted(set(texts.values()))
+            name = names[0].strip('.').replace('.', '_') if len(names) == 1 else f'f{start}'
+            pattern = '|'.join(re.escape(text) for text in names)
+            # a flag printed for value 0 is always there
+            flag_rules += f'(?P<{name}>{pattern})' + ('' if 0 in texts else '?')
+            flags_str += f'\n{op}: {name}\n'
+            for value, text in sorted(texts.items()):
+                flags_str += f'{value:#0{18 if self.arch < 70 else 34}x} {text}\n'
+
+        missing = []
+        rule_operands = []
+        for i, token in enumerate(operands_):
+            names = [operand_name(kind, start, width) for kind, operand, start, width in fields if operand == i
+                     and kind not in ('modifier', 'opcode', 'other', 'flag', 'guard')]
+            if not names:
+                rule_operands.append(re.escape(token))
+                continue
+            if names[0] not in operands:
+                missing.append(names[0])
+            rule_operands.append(f'{{{names[0]}}}')
+        rule = f"{op}{flag_rules} {', '.join(rule_operands)};" if rule_operands else f'{op}{flag_rules};'
+        width = 18 if self.arch < 70 else 34
+        line = f"        {{'type': 'x32', 'code': {code:#x}, 'rule': rf'{rule}'}},  # seed {seed:#0{width}x}"
+        return line, flags_str, missing
+
+
+def split_flag_field(tokens, width):
+    """
+    Split a swept flag field into single bit flags (a flag printed exactly when its bit is set) and the rest.
+    :param tokens: {value: [flags printed]}
+    :return: [(offset of the lowest bit, {value: flag text})], values relative to the field
+    """
+    fields = []
+    rest = dict(tokens)
+    all_tokens = sorted(set(token for t in tokens.values() for token in t))
+    for bit in range(width):
+        for token in all_tokens:
+            if all((token in t) == bool(value >> bit & 1) for value, t in tokens.items()):
+                fields.append((bit, {1 << bit: token}))
+                rest = {value: t for value, t in rest.items() if not value >> bit & 1}
+                break
+    single = [bit for bit, _ in fields]
+    if len(single) < width:
+        offset = min(bit for bit in range(width) if bit not in single)
+        fields.append((offset, {value: ''.join(t) for value, t in rest.items()}))
+    return fields
+
+
+def operand_name(kind, start, width):
+    """
+    Name of the operands entry (and grammar pattern) for a field, like r24 or i32w32.
+    """
+    if kind == 'i':
+        return f'i{start}' if f'i{start}' in operands else f'i{start}w{width}'
+    if kind in ('p', 'up', 'r', 'ur', 'b', 'c'):
+        return f'{kind}{start}'
+    return f'{kind}{start}w{width}'
+
+
+def seeds_from_cubin(cubin_path, arch, all_ops=False):
+    """
+    One code per op and operand kinds of the kernels of a cubin, for ops without grammar rules unless all_ops.
+    """
+    cubin = Cubin()
+    cubin.load(cubin_path)
+    grammar = grammar_61 if arch < 70 else grammar_75
+    seeds = {}
+    for kernel in cubin.kernel_dict.values():
+        kernel.disassemble()
+        for instr in kernel.instrs:
+            op, _, _, operands_ = split_instr(instr)
+            if grammar.get(op) and not all_ops:
+                continue
+            code = int(instr['code'], base=0)
+            if arch >= 70:
+                code &= CODE_MASK
+            seeds.setdefault((op, tuple(operand_kind(token) for token in operands_)), code)
+    return list(seeds.values())
+
+
+def discover(seeds, arch, db_path, cubin_path='', jobs=1, replay=False, all_ops=False, output=''):
+    """
+    Sweep seed codes (and the instructions of cubin_path) and print candidate grammar rules and flags_str blocks.
+    """
+    if cubin_path:
+        seeds = seeds + seeds_from_cubin(cubin_path, arch, all_ops)
+    discovery = Discovery(db_path, arch, jobs, replay)
+    grammar_name = 'grammar_61' if arch < 70 else 'grammar_75'
+    rules = {}
+    flags_str = ''
+    for seed in seeds:
+        base, fields, flags = discovery.sweep(seed)
+        line, flag_block, missing = discovery.rule(seed, base, fields, flags)
+        if missing:
+            line += f'  # TODO: no operand {", ".join(sorted(set(missing)))}'
+        rules.setdefault(base['op'], []).append(line)
+        flags_str += flag_block
+        print(f'{seed:#x} {print_instr(base)}')
+        for kind, operand, start, width in fields:
+            print(f'    {start:3d}:{start + width - 1:<3d} {kind:<8s} {operand if operand >= 0 else ""}')
+
+    text = f'# {grammar_name} candidates, sm_{arch}\n'
+    for op, lines in rules.items():
+        text += f"    '{op}': [\n" + '\n'.join(lines) + '\n    ],\n'
+    if flags_str:
+        text += f'\n# flags_str candidates\n{flags_str}'
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    else:
+        print(text, end='')
@@ -1,4 +1,9 @@
-from struct import unpack, pack
+import mmap
+import os
+import stat
+import sys
+from contextlib import nullcontext
+from struct import Struct, unpack, pack, pack_into, error as StructError
 
 
 def align_offset(offset, align):
@@ -7,7 +12,133 @@ def align_offset(offset, align):
     return offset
 
 
+def read_file(path):
+    """
+    Map a regular file with mmap, read pipes, process substitutions and other files that cannot be mapped.
+    :param path: file path, - for stdin
+    """
+    if path == '-':
+        return sys.stdin.buffer.read()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            try:
+                # the mapping outlives the file descriptor
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+        return f.read()
+
+
+def pack_fields(struct, buffer, offset, *values):
+    """
+    pack values, or pack them into buffer at offset if there is a buffer.
+    """
+    if buffer is None:
+        return struct.pack(*values)
+    struct.pack_into(buffer, offset, *values)
+
+
+def read_string(data, offset):
+    """
+    :return: the NUL terminated string at offset of data
+    """
+    end = data.find(b'\0', offset)
+    return data[offset:end if end >= 0 else len(data)]
+
+
+def read_leb128(data, offset, signed=False):
+    """
+    :return: value, offset after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    if signed and byte & 0x40:
+        value -= 1 << shift
+    return value, offset
+
+
+def decode_debug_line(data):
+    """
+    Run the DWARF line number programs of a .debug_line like section (.nv_debug_line_sass maps SASS addresses to
+    PTX lines). Only the line program headers of DWARF 2 to 4 are read.
+    :return: [(offset of the DW_LNE_set_address operand the address is relative to, address, line)], raises Warning
+             for other versions
+    """
+    rows = []
+    offset = 0
+    while offset < len(data):
+        unit_length, = unpack('<I', data[offset:offset + 4])
+        offset += 4
+        offset_size = 4
+        if unit_length == 0xffffffff:
+            unit_length, = unpack('<Q', data[offset:offset + 8])
+            offset += 8
+            offset_size = 8
+        unit_end = offset + unit_length
+        version, = unpack('<H', data[offset:offset + 2])
+        if not 2 <= version <= 4:
+            # DWARF 5 adds address and segment selector sizes and directory/file entry formats to the header
+            raise Warning(f'unsupported DWARF line program version {version}')
+        offset += 2
+        header_length, = unpack('<I' if offset_size == 4 else '<Q', data[offset:offset + offset_size])
+        offset += offset_size
+        program = offset + header_length
+        min_inst_length = data[offset]
+        offset += 2 if version >= 4 else 1  # maximum_operations_per_instruction
+        line_base, line_range, opcode_base = unpack('<bBB', data[offset + 1:offset + 4])
+        std_opcode_lengths = data[offset + 4:offset + 4 + opcode_base - 1]
+
+        offset = program
+        base, address, line = -1, 0, 1
+        while offset < unit_end:
+            opcode = data[offset]
+            offset += 1
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                address += adjusted // line_range * min_inst_length
+                line += line_base + adjusted % line_range
+                rows.append((base, address, line))
+            elif opcode == 0:
+                length, offset = read_leb128(data, offset)
+                end = offset + length
+                sub_opcode = data[offset]
+                if sub_opcode == 1:  # DW_LNE_end_sequence
+                    base, address, line = -1, 0, 1
+                elif sub_opcode == 2:  # DW_LNE_set_address
+                    base = offset + 1
+                    address = int.from_bytes(data[offset + 1:end], 'little')
+                offset = end
+            elif opcode == 1:  # DW_LNS_copy
+                rows.append((base, address, line))
+            elif opcode == 2:  # DW_LNS_advance_pc
+                advance, offset = read_leb128(data, offset)
+                address += advance * min_inst_length
+            elif opcode == 3:  # DW_LNS_advance_line
+                advance, offset = read_leb128(data, offset, signed=True)
+                line += advance
+            elif opcode == 8:  # DW_LNS_const_add_pc
+                address += (255 - opcode_base) // line_range * min_inst_length
+            elif opcode == 9:  # DW_LNS_fixed_advance_pc
+                address += unpack('<H', data[offset:offset + 2])[0]
+                offset += 2
+            else:
+                # set_file, set_column, negate_stmt... operands skipped
+                for _ in range(std_opcode_lengths[opcode - 1]):
+                    _, offset = read_leb128(data, offset)
+        offset = unit_end
+    return rows
+
+
 class Header:
+    HEADER_STRUCT = Struct('<16sHHIQQQIHHHHHH')
     ELFMAG = b'\x7fELF'
     ELFCLASS64 = 2
     ELFDATA2LSB = 1
@@ -147,16 +278,17 @@ class Header:
         self.virtual_arch = (self.e_flags & self.EF_CUDA_VIRTUAL_SM) >> 16
         self.address_size = 64 if self.e_flags & self.EF_CUDA_64BIT_ADDRESS else 32
 
-    def pack_header(self):
+    def pack_header(self, buffer=None, offset=0):
         # ELF 64-bit, little endian, version01, ABI33, ABI version7, zero padding
         ident = b'\x7fELF' + b'\x02' + b'\x01' + b'\x01' + b'\x33' + b'\7' + b'\0' * 7
-        return pack('<16sHHIQQQIHHHHHH', ident, self.e_type, self.e_machine, self.e_version,
-                    self.e_entry, self.e_phoff, self.e_shoff, self.e_flags,
-                    self.e_ehsize, self.e_phentsize, self.e_phnum,
-                    self.e_shentsize, self.e_shnum, self.e_shstrndx)
+        return pack_fields(self.HEADER_STRUCT, buffer, offset, ident, self.e_type, self.e_machine, self.e_version,
+                           self.e_entry, self.e_phoff, self.e_shoff, self.e_flags,
+                           self.e_ehsize, self.e_phentsize, self.e_phnum,
+                           self.e_shentsize, self.e_shnum, self.e_shstrndx)
 
 
 class Section:
+    HEADER_STRUCT = Struct('<IIQQQQIIQQ')
     SHT_STR = {0: 'NULL', 1: 'PROGBITS', 2: 'SYMTAB', 3: 'STRTAB', 4: 'RELA', 8: 'NOBITS', 9: 'REL',
                0x70000000: 'CUDA_INFO', 0x70000003: 'CUDA_RESOLVED_RELA', 0x7000000B: 'CUDA_RELOCINFO'}
     # todo: CUDA_RELOCINFO 不知道如何生成
@@ -242,12 +374,14 @@ class Section:
         self.data = b''
         self.symbols = []
 
-    def pack_header(self):
-        return pack('<IIQQQQIIQQ', self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, self.sh_offset,
-                    self.sh_size, self.sh_link, self.sh_info, self.sh_addralign, self.sh_entsize)
+    def pack_header(self, buffer=None, offset=0):
+        return pack_fields(self.HEADER_STRUCT, buffer, offset, self.sh_name, self.sh_type, self.sh_flags,
+                           self.sh_addr, self.sh_offset, self.sh_size, self.sh_link, self.sh_info, self.sh_addralign,
+                           self.sh_entsize)
 
 
 class Symbol:
+    ENTRY_STRUCT = Struct('<IBBHQQ')
     STT_STR = {0: 'NOTYPE', 1: 'OBJECT', 2: 'FUNC', 3: 'SECTION', 10: 'CUDA_TEXTURE'}
     STT_VAL = {val: key for (key, val) in STT_STR.items()}
     STB_STR = {0: 'LOCAL', 1: 'GLOBAL', 2: 'WEAK'}
@@ -306,12 +440,13 @@ class Symbol:
         assert (self.bind in self.STB_STR)
         assert (self.st_other in self.STV_STR)
 
-    def pack_entry(self):
-        return pack('<IBBHQQ', self.st_name,
-                    self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size)
+    def pack_entry(self, buffer=None, offset=0):
+        return pack_fields(self.ENTRY_STRUCT, buffer, offset, self.st_name,
+                           self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size)
 
 
 class Relocation:
+    ENTRY_STRUCT = Struct('<QQ')
     R_TYPE_61 = {43: '32@lo', 44: '32@hi'}
     R_TYPE_75 = {56: '32@lo', 57: '32@hi', 58: '32@fn'}
     R_TYPE = {**R_TYPE_61, **R_TYPE_75}
@@ -343,11 +478,12 @@ class Relocation:
         self.type = self.r_info & 0xffffffff
         assert self.type in self.R_TYPE
 
-    def pack_entry(self):
-        return pack('<QQ', self.r_offset, self.r_info)
+    def pack_entry(self, buffer=None, offset=0):
+        return pack_fields(self.ENTRY_STRUCT, buffer, offset, self.r_offset, self.r_info)
 
 
 class RelocationAdd:
+    ENTRY_STRUCT = Struct('<QQq')
     R_TYPE_61 = {43: '32@lo', 44: '32@hi'}
     R_TYPE_75 = {56: '32@lo', 57: '32@hi'}
     R_TYPE = {**R_TYPE_61, **R_TYPE_75}
@@ -378,11 +514,12 @@ class RelocationAdd:
         self.type = self.r_info & 0xffffffff
         assert self.type in self.R_TYPE
 
-    def pack_entry(self):
-        return pack('<QQq', self.r_offset, self.r_info, self.r_addend)
+    def pack_entry(self, buffer=None, offset=0):
+        return pack_fields(self.ENTRY_STRUCT, buffer, offset, self.r_offset, self.r_info, self.r_addend)
 
 
 class Program:
+    HEADER_STRUCT = Struct('<IIQQQQQQ')
     PT_STR = {1: 'LOAD', 6: 'PHDR'}
     SHT_VAL = {val: key for (key, val) in PT_STR.items()}
     PF_STR = {4: 'R', 2: 'W', 1: 'X'}
@@ -424,14 +561,16 @@ class Program:
         assert (self.p_paddr == 0)
         assert (self.p_align == 8)
 
-    def pack_header(self):
-        return pack('<IIQQQQQQ', self.p_type, self.p_flags, self.p_offset,
-                    self.p_vaddr, self.p_paddr, self.p_filesz, self.p_memsz, self.p_align)
+    def pack_header(self, buffer=None, offset=0):
+        return pack_fields(self.HEADER_STRUCT, buffer, offset, self.p_type, self.p_flags, self.p_offset,
+                           self.p_vaddr, self.p_paddr, self.p_filesz, self.p_memsz, self.p_align)
 
 
 class ELF:
     def __init__(self, iterable=(), **kwargs):
         self.path = ''
+        # content of the loaded file, mapped or read from stdin
+        self.data = b''
         self.header = None
         self.programs = []
         self.sections = []
@@ -450,10 +589,18 @@ class ELF:
               f'Symbols:{[n.decode() for n in self.symbol_dict.keys()]}'
         return msg
 
-    def load(self, path):
+    def load(self, path, data=None):
+        """
+        A regular file is mapped with mmap (see read_file), section data (and the symbols, relocations, kernels and data
+        read from it) are memoryview slices of the mapping, not copies.
+        :param path: ELF file, - for stdin
+        :param data: content of the file, instead of reading path
+        """
         self.path = path
-        with open(path, 'rb') as f:
-            data = f.read()
+        if data is None:
+            data = read_file(path)
+        self.data = data
+        view = memoryview(data)
 
         # Read in ELF Headers
         self.header = Header()
@@ -464,11 +611,11 @@ class ELF:
             section = Section(index=i)
             begin = self.header.e_shoff + i * self.header.e_shentsize
             end = begin + self.header.e_shentsize
-            section.unpack_binary(data[begin:end])
+            section.unpack_binary(view[begin:end])
             self.sections.append(section)
 
             if section.sh_size and section.sh_type != Section.SHT_VAL['NOBITS']:
-                section.data = data[section.sh_offset:section.sh_offset + section.sh_size]
+                section.data = view[section.sh_offset:section.sh_offset + section.sh_size]
 
             # Read in symbols
             if section.sh_type == Section.SHT_VAL['SYMTAB']:
@@ -480,15 +627,16 @@ class ELF:
                     self.symbols.append(symbol)
 
         # Update section headers with their names.
-        sh_string_table = self.sections[self.header.e_shstrndx].data
+        # names are read from data, slices of which are bytes
+        sh_string_table = self.sections[self.header.e_shstrndx].sh_offset
         for section in self.sections:
-            section.name = sh_string_table[section.sh_name:].split(b'\0', 1)[0]
+            section.name = read_string(data, sh_string_table + section.sh_name)
             self.section_dict[section.name] = section
 
         # Update symbols with their names
-        symbol_string_table = self.section_dict[b'.strtab'].data
+        symbol_string_table = self.section_dict[b'.strtab'].sh_offset
         for symbol in self.symbols:
-            symbol.name = symbol_string_table[symbol.st_name:].split(b'\0', 1)[0]
+            symbol.name = read_string(data, symbol_string_table + symbol.st_name)
             self.symbol_dict[symbol.name] = symbol
 
             # Attach symbol to section
@@ -500,7 +648,7 @@ class ELF:
             program = Program()
             begin = self.header.e_phoff + i * self.header.e_phentsize
             end = begin + self.header.e_phentsize
-            program.unpack_binary(data[begin:end])
+            program.unpack_binary(view[begin:end])
             for section in self.sections:
                 if program.p_offset <= section.sh_offset < (program.p_offset + program.p_memsz):
                     program.section_mapping.append(section.name)
@@ -516,23 +664,45 @@ class ELF:
                4. shdrs.
                5. phdrs.
         """
-        with open(path, 'wb') as file:
-            offset = 0
-            header_data = self.header.pack_header()
-            offset += file.write(header_data)
-            for sec in self.sections:
-                begin = align_offset(offset, sec.sh_addralign)
-                if begin > offset:
-                    offset += file.write(b'\0' * (begin - offset))
-                offset += file.write(sec.data)
-
-            begin = align_offset(offset, 8)
-            if begin > offset:
-                offset += file.write(b'\0' * (begin - offset))
-            for sec in self.sections:
-                header_data = sec.pack_header()
-                offset += file.write(header_data)
-            for pro in self.programs:
-                offset += file.write(pro.pack_header())
-            ph_end = self.header.e_phoff + self.header.e_phnum * self.header.e_phentsize
-            assert offset == ph_end
+        with nullcontext(sys.stdout.buffer) if path == '-' else open(path, 'wb') as file:
+            self.write_file(file)
+
+    def write_file(self, file):
+        file.write(self.pack_binary())
+
+    def layout(self):
+        """
+        File layout of write: sections data one after the other from the ELF header, each aligned, then the section
+        headers (8-byte aligned) and the program headers.
+        :return: [file offset of each section data], offset of the section headers, file size
+        """
+        offset = 64  # elf header size
+        data_offsets = []
+        for sec in self.sections:
+            offset = align_offset(offset, sec.sh_addralign)
+            data_offsets.append(offset)
+            offset += len(sec.data)
+        sh_offset = align_offset(offset, 8)
+        size = sh_offset + len(self.sections) * self.header.e_shentsize + len(self.programs) * self.header.e_phentsize
+        return data_offsets, sh_offset, size
+
+    def pack_binary(self):
+        """
+        The ELF file in a single buffer, filled with pack_into at the offsets of layout.
+        """
+        data_offsets, sh_offset, size = self.layout()
+        ph_end = self.header.e_phoff + self.header.e_phnum * self.header.e_phentsize
+        assert size == ph_end
+
+        buffer = bytearray(size)
+        self.header.pack_header(buffer, 0)
+        for sec, offset in zip(self.sections, data_offsets):
+            buffer[offset:offset + len(sec.data)] = sec.data
+        offset = sh_offset
+        for sec in self.sections:
+            sec.pack_header(buffer, offset)
+            offset += self.header.e_shentsize
+        for pro in self.programs:
+            pro.pack_header(buffer, offset)
+            offset += self.header.e_phentsize
+        return buffer
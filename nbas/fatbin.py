@@ -0,0 +1,201 @@
+from .cubin import *
+
+
+def decompress_lz4(data, size):
+    """
+    Decompress a compressed fatbin entry, LZ4 blocks without the frame format.
+    :param size: decompressed size
+    """
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        token = data[pos]
+        pos += 1
+        length = token >> 4
+        if length == 15:
+            while True:
+                pos += 1
+                length += data[pos - 1]
+                if data[pos - 1] != 255:
+                    break
+        out += data[pos:pos + length]
+        pos += length
+        if pos >= len(data) or len(out) >= size:
+            break
+
+        match_offset = data[pos] | data[pos + 1] << 8
+        pos += 2
+        length = (token & 15) + 4
+        if length == 19:
+            while True:
+                pos += 1
+                length += data[pos - 1]
+                if data[pos - 1] != 255:
+                    break
+        start = len(out) - match_offset
+        if start < 0 or match_offset == 0:
+            raise Exception(f'Bad LZ4 match offset {match_offset} at {pos}.')
+        if match_offset >= length:
+            out += out[start:start + length]
+        else:
+            # overlapping match, the last match_offset bytes repeated
+            out += (out[start:] * (length // match_offset + 1))[:length]
+    return bytes(out[:size])
+
+
+def find_elf_section(data, name):
+    """
+    Find a section of a 64-bit little endian host ELF (the .nv_fatbin of an executable or a shared library).
+    :return: offset, size, None if there is no such section
+    """
+    e_shoff, = unpack_from('<Q', data, 0x28)
+    e_shentsize, e_shnum, e_shstrndx = unpack_from('<HHH', data, 0x3a)
+    strtab_offset, = unpack_from('<Q', data, e_shoff + e_shstrndx * e_shentsize + 0x18)
+    for i in range(e_shnum):
+        begin = e_shoff + i * e_shentsize
+        if read_string(data, strtab_offset + unpack_from('<I', data, begin)[0]) == name:
+            return unpack_from('<QQ', data, begin + 0x18)
+    return None
+
+
+class FatbinEntry:
+    KIND_STR = {1: 'ptx', 2: 'elf'}
+    KIND_VAL = {val: key for (key, val) in KIND_STR.items()}
+    FLAG_64BIT = 0x1
+    FLAG_COMPRESSED = 0x2000
+    # kind, version, header size, size, compressed size, ..., arch, ..., flags, ..., decompressed size
+    HEADER = Struct('<HHIQIIHHIIIQQQ')
+    VERSION = 0x101
+
+    def __init__(self, iterable=(), **kwargs):
+        self.index = 0
+        self.kind = 0
+        self.arch = 0
+        # payload in the file, compressed_size bytes if compressed, size (padded) otherwise
+        self.offset = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.decompressed_size = 0
+        self.flags = 0
+
+        self.__dict__.update(iterable, **kwargs)
+
+    def __repr__(self):
+        kind = self.KIND_STR.get(self.kind, str(self.kind))
+        msg = f'Entry:{self.index}, Kind:{kind}, Arch:sm_{self.arch}, Offset:{self.offset:#0x}, Size:{self.size}'
+        if self.flags & self.FLAG_COMPRESSED:
+            msg += f', Compressed:{self.compressed_size}->{self.decompressed_size}'
+        return msg
+
+    def unpack_binary(self, data, offset):
+        """
+        :return: offset of the next entry
+        """
+        [self.kind, _, header_size, self.size, self.compressed_size, _, _, _, self.arch, _, _, self.flags, _,
+         self.decompressed_size] = self.HEADER.unpack_from(data, offset)
+        self.offset = offset + header_size
+        return self.offset + self.size
+
+    def pack_header(self):
+        return self.HEADER.pack(self.kind, self.VERSION, self.HEADER.size, self.size, self.compressed_size, 0, 0, 0,
+                                self.arch, 0, 0, self.flags, 0, self.decompressed_size)
+
+    def payload(self, data):
+        """
+        :return: content of the entry, decompressed
+        """
+        if self.flags & self.FLAG_COMPRESSED:
+            return decompress_lz4(data[self.offset:self.offset + self.compressed_size], self.decompressed_size)
+        return data[self.offset:self.offset + self.size]
+
+
+class Fatbin:
+    """
+    Fatbinary container: a .fatbin file, or the .nv_fatbin section of a host executable, holding cubins and PTX of
+    several archs. Entries are indexed from their headers, an entry is only read (and decompressed) by payload.
+    A bare cubin loads as bare_cubin, without entries.
+    """
+    MAGIC = 0xBA55ED50
+    # magic, version, header size, size of the entries
+    HEADER = Struct('<IHHQ')
+    VERSION = 1
+
+    def __init__(self, iterable=(), **kwargs):
+        self.path = ''
+        self.data = b''
+        self.entries = []
+        self.bare_cubin = False
+
+        self.__dict__.update(iterable, **kwargs)
+
+    def __repr__(self):
+        return f'Path:{self.path}, Entries:{len(self.entries)}'
+
+    def load(self, path, data=None):
+        """
+        :param path: fatbin, executable or cubin, - for stdin
+        :param data: content of the file, instead of reading path
+        """
+        self.path = path
+        if data is None:
+            data = read_file(path)
+        self.data = data
+
+        begin, end = 0, len(data)
+        if data[:4] == Header.ELFMAG:
+            if data[7] == Header.ELFOSABI_CUDA:
+                self.bare_cubin = True
+                return
+            section = find_elf_section(data, b'.nv_fatbin')
+            if section is None:
+                raise Exception(f'{path} is neither a cubin nor a fatbin, and has no .nv_fatbin section.')
+            begin, size = section
+            end = begin + size
+
+        # .nv_fatbin holds one container per translation unit, each 8-byte aligned
+        offset = begin
+        while offset + self.HEADER.size <= end:
+            magic, _, header_size, fat_size = self.HEADER.unpack_from(data, offset)
+            if magic != self.MAGIC:
+                if offset == begin:
+                    raise Exception(f'Bad fatbin magic {magic:#x} in {path}.')
+                break
+            entry_offset = offset + header_size
+            offset = entry_offset + fat_size
+            while entry_offset < offset:
+                entry = FatbinEntry(index=len(self.entries))
+                entry_offset = entry.unpack_binary(data, entry_offset)
+                self.entries.append(entry)
+            offset = align_offset(offset, 8)
+
+    def cubins(self, archs=()):
+        """
+        :param archs: sm of the cubins, all if empty
+        :return: cubin entries
+        """
+        return [entry for entry in self.entries
+                if entry.kind == FatbinEntry.KIND_VAL['elf'] and (not archs or entry.arch in archs)]
+
+    def add_cubin(self, binary, arch):
+        """
+        Append an uncompressed cubin entry, written by write.
+        """
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        entry = FatbinEntry(index=len(self.entries), kind=FatbinEntry.KIND_VAL['elf'], arch=arch,
+                            offset=len(self.data), size=align_offset(len(binary), 8), flags=FatbinEntry.FLAG_64BIT)
+        self.data += binary
+        self.data += bytes(entry.size - len(binary))
+        self.entries.append(entry)
+
+    def write(self, path):
+        """
+        Write the entries added by add_cubin as a single container.
+        """
+        parts = [b'']
+        for entry in self.entries:
+            parts.append(entry.pack_header())
+            parts.append(self.data[entry.offset:entry.offset + entry.size])
+        parts[0] = self.HEADER.pack(self.MAGIC, self.VERSION, self.HEADER.size, sum(len(part) for part in parts))
+        with nullcontext(sys.stdout.buffer) if path == '-' else open(path, 'wb') as file:
+            file.write(b''.join(parts))
@@ -1,11 +1,30 @@
+import json
+import marshal
 import os
 import re
+import sys
+import zlib
+from collections import OrderedDict
+from tempfile import mkstemp
+from types import MappingProxyType
+
+try:
+    import re._constants as sre_constants
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
 
 
 # include nested files
-def process_include(str_, asm_path, define_dict):
+def process_include(str_, asm_path, define_dict, python=True):
+    """
+    :param python: also run included .py files, otherwise they are left for a later pass
+    """
     def include_file(x):
         path = os.path.join(os.path.dirname(asm_path), x.group('file'))
+        if path.endswith('.py') and not python:
+            return x.group(0)
         with open(path, 'r') as fd:
             source = fd.read()
         define_dict['out'] = ''
@@ -758,6 +777,8 @@ i54w4 = fr'(?P<i54w4>{immed})'
 c38 = fr'(?P<c40neg>\-)?(?P<c40abs>\|)?c\[((?P<c54>{hexx})|(?P<ur24>{ureg}))\]\s*\[{i38w16}\]\|?'
 c40 = fr'(?P<c40neg>\-)?(?P<c40abs>\|)?c\[((?P<c54>{hexx})|(?P<ur24>{ureg}))\]\s*\[(?P<c40>{hexx})\]\|?'
 uc40 = fr'(?P<c40neg>\-)?(?P<c40abs>\|)?c\[(?P<c54>{hexx})\]\s*\[(?P<ur24>{ureg})(?:\s*\+\s*(?P<c40>{hexx}))?\]\|?'
+# c40 without the uniform bank register, for instructions which already use ur24 as an operand
+bc40 = fr'(?P<c40neg>\-)?(?P<c40abs>\|)?c\[(?P<c54>{hexx})\]\s*\[(?P<c40>{hexx})\]\|?'
 
 UP = fr'UP[0-7T]'
 
@@ -935,7 +956,7 @@ grammar_75 = {
     ],
     'IMMA': [  # Integer Matrix Multiply and Accumulate
         {'type': 'x32', 'code': 0x4000000000000000237,
-         'rule': rf'IMMA{imma_shape}{imma_atp}{imma_btp}{sat} {r16}, {r24}\.ROW, {r32}\.COL, {r64}(, {up87})?'},
+         'rule': rf'IMMA{imma_shape}{imma_atp}{imma_btp}{sat} {r16}, {r24}\.ROW, {r32}\.COL, {r64}(, {up87})?;'},
     ],
     'IMNMX': [  # Integer Minimum/Maximum
         {'type': 'x32', 'code': 0x217, 'rule': rf'IMNMX{u32} {r16}, {r24}, {r32}, {p87};'},
@@ -1191,7 +1212,7 @@ grammar_75 = {
         {'type': 'x32', 'code': 0x892,
          'rule': rf'ULOP3\.LUT{tpand} ({up81}, )?{ur16}, {ur24}, {i32}, {ur64}, {i72w8}, {up87};'},
         {'type': 'x32', 'code': 0xa92,
-         'rule': rf'ULOP3\.LUT{tpand} ({up81}, )?{ur16}, {ur24}, {c40}, {ur64}, {i72w8}, {up87};'},
+         'rule': rf'ULOP3\.LUT{tpand} ({up81}, )?{ur16}, {ur24}, {bc40}, {ur64}, {i72w8}, {up87};'},
     ],
     'ULOP32I': [],  # Logic Operation
     'UMOV': [  # Uniform Move
@@ -2582,7 +2603,8 @@ ULOP3, UISETP, USEL, IMMA: up87not
 0x00000000040000000000000000000000 !
 '''
 
-flags_str_86 = flags_str_75 + '''
+# sm_86 flags on top of flags_str_75
+flags_str_86_ex = '''
 LD, LDG: ur32
 0x00000000000010000000000000000000 ALL
 
@@ -2650,14 +2672,17 @@ LDS: U
 0x00000000000000000000000000000000 .U
 '''
 
+flags_str_86 = flags_str_75 + flags_str_86_ex
 
-def format_flags(flag_str, gram):
+
+def format_flags(flag_str, gram, base=None):
     flag_str = strip_space(flag_str)
 
     # Create flag dict
     flag_dict = {}
     for key in gram.keys():
-        flag_dict[key] = {}
+        # A flag section replaces its dict instead of updating it, so the base dicts can be shared.
+        flag_dict[key] = dict(base[key]) if base else {}
 
     ops = []
     names = []
@@ -2679,9 +2704,460 @@ def format_flags(flag_str, gram):
     return flag_dict
 
 
-flags_61: dict = format_flags(flags_str_61, grammar_61)
-flags_75: dict = format_flags(flags_str_75, grammar_75)
-flags_86: dict = format_flags(flags_str_86, grammar_75)
+def grammar_hash():
+    """
+    Version of the tables built from this file, used to key the on-disk caches.
+    """
+    global grammar_version
+    if not grammar_version:
+        with open(__file__, 'rb') as f:
+            grammar_version = f'{zlib.crc32(f.read()):08x}'
+    return grammar_version
+
+
+grammar_version = ''
+cache_dir = os.environ.get('NBAS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'nbas'))
+
+
+def load_table(name):
+    path = os.path.join(cache_dir, f'{name}-{sys.implementation.cache_tag}-{grammar_hash()}.marshal')
+    try:
+        with open(path, 'rb') as f:
+            return marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def save_table(name, table):
+    # write then rename, concurrent nbasm processes may save the same table
+    path = os.path.join(cache_dir, f'{name}-{sys.implementation.cache_tag}-{grammar_hash()}.marshal')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(table, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+arch_flags = {}
+
+
+def get_flags(arch):
+    """
+    Get flags_61 (arch < 70), flags_75 (arch < 80) or flags_86, parsed on first use only.
+    Parsed tables are cached on disk under NBAS_CACHE_DIR (default ~/.cache/nbas).
+    """
+    key = 61 if arch < 70 else 75 if arch < 80 else 86
+    if key not in arch_flags:
+        flags = load_table(f'flags_{key}')
+        if flags is None:
+            if key == 61:
+                flags = format_flags(flags_str_61, grammar_61)
+            elif key == 75:
+                flags = format_flags(flags_str_75, grammar_75)
+            else:
+                flags = format_flags(flags_str_86_ex, grammar_75, get_flags(75))
+            save_table(f'flags_{key}', flags)
+        arch_flags[key] = flags
+    return arch_flags[key]
+
+
+def __getattr__(name):
+    # flags_61, flags_75 and flags_86 are built on first access
+    if name in ['flags_61', 'flags_75', 'flags_86']:
+        return get_flags(int(name[-2:]))
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# rule signatures model instructions as op + rest lexed into operands: operands follow the first space, are separated
+# by commas outside <...>, and the instruction ends with its only ;. The first character of an operand (after SIG_SKIP)
+# tells registers (R), uniform registers (U), predicates (P), immediates, constant banks (c) and addresses ([) apart.
+SIG_CHARS = frozenset(chr(c) for c in range(0x80))
+# skipped before the first character of an operand: spaces and -, ~, |, ! prefixes
+SIG_SKIP = ' \t\n\r\f\v-~|!'
+
+
+class SignatureUnknown(Exception):
+    pass
+
+
+def sig_charset(op, av):
+    if op is sre_constants.LITERAL:
+        return frozenset(chr(av))
+    if op is sre_constants.NOT_LITERAL:
+        return SIG_CHARS - {chr(av)}
+    if op is sre_constants.ANY:
+        return SIG_CHARS
+    if op is sre_constants.IN:
+        chars = set()
+        negate = False
+        for item_op, item_av in av:
+            if item_op is sre_constants.NEGATE:
+                negate = True
+            elif item_op is sre_constants.LITERAL:
+                chars.add(chr(item_av))
+            elif item_op is sre_constants.RANGE:
+                chars.update(chr(c) for c in range(item_av[0], item_av[1] + 1))
+            elif item_op is sre_constants.CATEGORY and item_av in SIG_CATEGORIES:
+                chars.update(c for c in SIG_CHARS if re.fullmatch(SIG_CATEGORIES[item_av], c))
+            else:
+                raise SignatureUnknown(item_op)
+        return SIG_CHARS - chars if negate else frozenset(chars)
+    raise SignatureUnknown(op)
+
+
+SIG_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+}
+
+# lexer states of rule_signature
+SIG_HEAD, SIG_END, SIG_START, SIG_IN, SIG_ANGLE = range(5)
+
+
+def sig_step(states, chars):
+    """
+    Feed one character class to the lexer states (state, first characters of the operands so far), following
+    every character of the class that changes how the text splits into operands.
+    """
+    result = set()
+    rest = chars - {';'}
+    for state, sig in states:
+        if state == SIG_END:
+            continue
+        if ';' in chars:
+            # the only ; ends the text
+            result.add((SIG_END, sig))
+        if not rest:
+            continue
+        if state == SIG_HEAD:
+            if ' ' in rest:
+                result.add((SIG_START, sig + (frozenset(),)))
+            if rest - {' '}:
+                result.add((state, sig))
+        elif state == SIG_ANGLE:
+            if '>' in rest:
+                result.add((SIG_IN, sig))
+            if rest - {'>'}:
+                result.add((state, sig))
+        else:
+            if ',' in rest:
+                result.add((SIG_START, sig + (frozenset(),)))
+            other = rest - {','}
+            if state == SIG_START:
+                if other & set(SIG_SKIP):
+                    result.add((state, sig))
+                other = other - set(SIG_SKIP)
+                sig = sig[:-1] + (sig[-1] | other,)
+            if '<' in other:
+                result.add((SIG_ANGLE, sig))
+            if other - {'<'}:
+                result.add((SIG_IN, sig))
+    if len(result) > 1024:
+        raise SignatureUnknown('states')
+    return result
+
+
+def sig_walk(pattern, states):
+    for op, av in pattern:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            states = sig_step(states, sig_charset(op, av))
+        elif op is sre_constants.SUBPATTERN:
+            states = sig_walk(av[-1], states)
+        elif op is sre_constants.BRANCH:
+            states = set().union(*[sig_walk(branch, states) for branch in av[1]])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_, max_, sub_pattern = av
+            result = set(states) if min_ == 0 else set()
+            count = 0
+            while states and (max_ == sre_constants.MAXREPEAT or count < max_):
+                states = sig_walk(sub_pattern, states)
+                count += 1
+                if count >= min_:
+                    if states <= result:
+                        break
+                    result |= states
+                if count > 16:
+                    raise SignatureUnknown('repeat')
+            states = result
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # no character consumed, matching only gets stricter
+            pass
+        else:
+            raise SignatureUnknown(op)
+    return states
+
+
+def rule_signature(rule):
+    """
+    :return: {operand count: alternatives of the possible first characters of each operand} over the texts fully
+             matched by rule (see SIG_CHARS), None if not derivable.
+    """
+    try:
+        states = sig_walk(sre_parse.parse(rule), {(SIG_HEAD, ())})
+    except SignatureUnknown:
+        return None
+    rule_sig = {}
+    for state, sig in states:
+        if state == SIG_END:
+            rule_sig.setdefault(len(sig), set()).add(tuple(first or frozenset(['']) for first in sig))
+    return {count: sig_merge(alternatives) for count, alternatives in rule_sig.items()}
+
+
+def sig_merge(alternatives):
+    # alternatives differing in one operand only are merged without losing precision
+    alternatives = list(alternatives)
+    merged = True
+    while merged:
+        merged = False
+        for i, a in enumerate(alternatives):
+            for j in range(i + 1, len(alternatives)):
+                b = alternatives[j]
+                if sum(x != y for x, y in zip(a, b)) <= 1:
+                    alternatives[i] = tuple(x | y for x, y in zip(a, b))
+                    del alternatives[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return tuple(alternatives)
+
+
+def sig_disjoint(rule_sig_a, rule_sig_b):
+    """
+    True if no text can match both rules. Unknown signatures (None) are never disjoint.
+    """
+    if rule_sig_a is None or rule_sig_b is None:
+        return False
+    for count, alternatives in rule_sig_a.items():
+        for firsts_a in alternatives:
+            for firsts_b in rule_sig_b.get(count, ()):
+                if all(a & b for a, b in zip(firsts_a, firsts_b)):
+                    return False
+    return True
+
+
+def rule_order(counts, rule_sigs):
+    """
+    Order rules by descending match count, keeping a rule behind every earlier rule it is not disjoint with, so
+    that the first matching rule is unchanged.
+    """
+    order = []
+    remaining = list(range(len(counts)))
+    while remaining:
+        ready = [i for i in remaining if all(sig_disjoint(rule_sigs[j], rule_sigs[i]) for j in remaining if j < i)]
+        best = max(ready, key=lambda i: (counts[i], -i))
+        order.append(best)
+        remaining.remove(best)
+    return tuple(order)
+
+
+class MatchCache:
+    """
+    Bounded LRU cache: (grammar, op, rest) -> (rule index, frozen captured_dict).
+    Rule index -1 records an instruction no rule matches.
+    """
+
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'Entries:{len(self.entries)}/{self.maxsize}, Hits:{self.hits}, Misses:{self.misses}'
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, index, captured_dict):
+        self.entries[key] = (index, captured_dict)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def load(self, path):
+        """
+        Load entries saved by save(), ignored if the file is missing or was written for another grammar.py.
+        """
+        try:
+            with open(path, 'rb') as f:
+                version, entries = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if version != grammar_hash():
+            return
+        self.merge(entries)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            marshal.dump((grammar_hash(), self.dump()), f)
+
+    def dump(self):
+        """
+        Entries as plain data, for save or to merge into the cache of another process.
+        """
+        return [(key, (index, dict(captured_dict) if captured_dict is not None else None))
+                for key, (index, captured_dict) in self.entries.items()]
+
+    def merge(self, entries):
+        for key, (index, captured_dict) in entries:
+            self.put(key, index, MappingProxyType(captured_dict) if captured_dict is not None else None)
+
+
+class GrammarMatcher:
+    """
+    Precompiled view of a grammar table, indexed by op. Rules are matched against the whole instruction text
+    (fullmatch), the first matching rule in list order wins.
+
+    With a MatchCache, results are memoized under (name, op, rest) and captured_dict is returned read-only.
+
+    stats ({op: [match count of each rule]}) records which rules match, orders ({op: rule indices}, see
+    rule_order) changes the order the rules of an op are tried in.
+    """
+
+    def __init__(self, grammar, name='', cache=None, stats=None, orders=None):
+        self.grammar = grammar
+        self.name = name
+        self.cache = cache
+        # op: [compiled rule or None, ...], rules are compiled on first use
+        self.patterns = {}
+        self.stats = stats
+        self.orders = orders if orders is not None else {}
+
+    def match_rules(self, op, rest):
+        if op not in self.patterns:
+            if not self.grammar.get(op):
+                return -1, None
+            self.patterns[op] = [None] * len(self.grammar[op])
+        rules = self.patterns[op]
+        text = op + rest
+        for index in self.orders.get(op, range(len(rules))):
+            pattern = rules[index]
+            if pattern is None:
+                pattern = rules[index] = re.compile(self.grammar[op][index]['rule'])
+            m = pattern.fullmatch(text)
+            if m:
+                return index, m.groupdict()
+        return -1, None
+
+    def match(self, op, rest):
+        """
+        :return: (gram, captured_dict) of the first rule matching op + rest, (None, None) if none matches.
+        """
+        if self.cache is None:
+            index, captured_dict = self.match_rules(op, rest)
+        else:
+            key = (self.name, op, rest)
+            entry = self.cache.get(key)
+            if entry is None:
+                index, captured_dict = self.match_rules(op, rest)
+                if captured_dict is not None:
+                    captured_dict = MappingProxyType(captured_dict)
+                self.cache.put(key, index, captured_dict)
+            else:
+                index, captured_dict = entry
+        if index < 0:
+            return None, None
+        if self.stats is not None:
+            if op not in self.stats or len(self.stats[op]) != len(self.grammar[op]):
+                self.stats[op] = [0] * len(self.grammar[op])
+            self.stats[op][index] += 1
+        return self.grammar[op][index], captured_dict
+
+
+def get_signatures(grammar, name):
+    """
+    rule_signature of the rules of every op with several rules in grammar, cached on disk as signatures_<name>.
+    """
+    signatures = load_table(f'signatures_{name}')
+    if signatures is None:
+        signatures = {op: [rule_signature(g['rule']) for g in grams] for op, grams in grammar.items() if len(grams) > 1}
+        save_table(f'signatures_{name}', signatures)
+    return signatures
+
+
+def get_orders(grammar, name, stats):
+    """
+    rule_order of every op of stats with several rules in grammar, ops recorded for another grammar.py are skipped.
+    """
+    signatures = get_signatures(grammar, name)
+    return {op: rule_order(counts, signatures[op]) for op, counts in stats.items()
+            if op in signatures and len(counts) == len(grammar[op])}
+
+
+class RuleProfile:
+    """
+    Match counts of the rules of each op, per grammar, saved as JSON: {grammar: {op: [count of each rule]}}.
+    Recorded with nbasm as/test --record_profile, used to order the rules with --profile.
+    """
+
+    def __init__(self, record=False):
+        self.record = record
+        self.stats = {}
+
+    def load(self, path):
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stats = json.load(f)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats, f, indent=1, sort_keys=True)
+
+    def pop(self):
+        """
+        Counts recorded since the last pop, to merge into the profile of another process.
+        """
+        stats = {}
+        for name, op_stats in self.stats.items():
+            stats[name] = {op: counts.copy() for op, counts in op_stats.items() if any(counts)}
+            for counts in op_stats.values():
+                counts[:] = [0] * len(counts)
+        return stats
+
+    def merge(self, stats):
+        for name, op_stats in stats.items():
+            self_stats = self.stats.setdefault(name, {})
+            for op, counts in op_stats.items():
+                if op not in self_stats or len(self_stats[op]) != len(counts):
+                    self_stats[op] = [0] * len(counts)
+                self_stats[op] = [a + b for a, b in zip(self_stats[op], counts)]
+
+    def apply(self, matcher):
+        if self.record:
+            matcher.stats = self.stats.setdefault(matcher.name, {})
+        elif matcher.name in self.stats:
+            matcher.orders = get_orders(matcher.grammar, matcher.name, self.stats[matcher.name])
+
+
+match_cache = MatchCache()
+rule_profile = RuleProfile()
+grammar_matchers = {}
+
+
+def get_matcher(arch):
+    """
+    Get the matcher of grammar_61 (arch < 70) or grammar_75, built on first use, sharing match_cache and
+    rule_profile.
+    """
+    key = 61 if arch < 70 else 75
+    if key not in grammar_matchers:
+        grammar_matchers[key] = GrammarMatcher(grammar_61 if key == 61 else grammar_75, name=f'{key}',
+                                               cache=match_cache)
+        rule_profile.apply(grammar_matchers[key])
+    return grammar_matchers[key]
 
 
 def encode_ctrl(asm):
@@ -2721,21 +3197,29 @@ def encode_reuse(captured_dict):
     return reuse_code << 17
 
 
-def encode_instruction(op, gram, captured_dict, instr, arch):
+def encode_pred(instr):
+    p = int(instr['pred_reg'].strip('UP')) if instr['pred_reg'] not in ['PT', 'UPT', None] else 0x7
+    if instr['pred_not']:
+        p |= 0x8
+    return p
+
+
+def encode_instruction_walk(op, gram, captured_dict, instr, arch):
+    """
+    Generic encoder walking every captured group, reference for the generated encoders.
+    """
     code = gram['code']
     if arch < 70:
-        flag = flags_61[op] if op in flags_61 else {}
+        flag = get_flags(61).get(op, {})
     elif arch < 80:
-        flag = flags_75[op] if op in flags_75 else {}
+        flag = get_flags(75).get(op, {})
     else:
-        flag = flags_86[op] if op in flags_86 else {}
+        flag = get_flags(86).get(op, {})
 
     # Process predicate.
     # 0xf0000是P寄存器，高位位1,是!PX，低3位表示P0-P6, 7表示不使用P寄存器
     if 'noPred' not in captured_dict:
-        p = int(instr['pred_reg'].strip('UP')) if instr['pred_reg'] not in ['PT', 'UPT', None] else 0x7
-        if instr['pred_not']:
-            p |= 0x8
+        p = encode_pred(instr)
         if arch < 70:
             code ^= p << 16
         else:
@@ -2773,6 +3257,70 @@ def encode_instruction(op, gram, captured_dict, instr, arch):
     return ctrl, code
 
 
+def gen_encoder(op, gram, arch):
+    """
+    Generate the encoder of one rule: opcode bits, flag tables, operand encoders and predicate/reuse/ctrl ex
+    handling are resolved here once, the generated function only touches the groups of its rule.
+    Bit-identical to encode_instruction_walk.
+    """
+    if arch < 70:
+        flag = get_flags(61).get(op, {})
+    elif arch < 80:
+        flag = get_flags(75).get(op, {})
+    else:
+        flag = get_flags(86).get(op, {})
+    names = list(re.compile(gram['rule']).groupindex)
+    env = {'encode_pred': encode_pred, 'encode_ctrl': encode_ctrl}
+    lines = ['def encode(captured_dict, instr):', f"    code = {gram['code']:#x}"]
+
+    if 'noPred' not in names:
+        lines.append(f'    code ^= encode_pred(instr) << {16 if arch < 70 else 12}')
+
+    for k in names:
+        is_flag = k in flag
+        is_operand = k in operands
+        if not is_flag and not is_operand:
+            continue
+        lines.append(f'    v = captured_dict[{k!r}]')
+        lines.append('    if v:')
+        if is_flag:
+            env[f'flag_{k}'] = flag[k]
+            lines.append(f"        code ^= flag_{k}.get(v, {flag[k].get('ALL', 0):#x})")
+        if is_operand:
+            env[f'operand_{k}'] = operands[k]
+            lines.append(f'        code ^= operand_{k}(v)')
+        if is_flag and 'DEFAULT' in flag[k]:
+            lines.append('    else:')
+            lines.append(f"        code ^= {flag[k]['DEFAULT']:#x}")
+
+    lines.append("    ctrl = encode_ctrl(instr['ctrl'])")
+    for i, name in enumerate(['reuse1', 'reuse2', 'reuse3']):
+        if name in names:
+            lines.append(f"    if captured_dict[{name!r}] == '.reuse':")
+            lines.append(f'        ctrl |= {1 << (17 + i):#x}')
+
+    if 80 <= arch < 90:
+        lines.append("    ex_str = instr['ctrl'].split(':')[0]")
+        lines.append("    ex = 0 if ex_str == '--' else int(ex_str, base=16)")
+        if op in ['LD', 'LDG', 'ST', 'STG', 'ATOM', 'ATOMG', 'RED']:
+            lines.append(f"    code |= (ex & 0x3f) << {32 if op in ['LD', 'LDG'] else 64}")
+    lines.append('    return ctrl, code')
+
+    exec('\n'.join(lines), env)
+    return env['encode']
+
+
+# (arch, id of rule dict): generated encoder
+rule_encoders = {}
+
+
+def encode_instruction(op, gram, captured_dict, instr, arch):
+    key = (arch, id(gram))
+    if key not in rule_encoders:
+        rule_encoders[key] = gen_encoder(op, gram, arch)
+    return rule_encoders[key](captured_dict, instr)
+
+
 def decode_ctrl(sub_code):
     stall = sub_code & 0xf
     yield_ = (sub_code >> 4) & 0x1
@@ -2791,6 +3339,19 @@ def decode_ctrl(sub_code):
     }
 
 
+def decode_sass_ctrl(code, op, arch):
+    """
+    Control code of a Volta+ instruction, with the sm_8x schedule of the LD, ST and ATOM like instructions.
+    """
+    ctrl = decode_ctrl((code >> 105) & 0x1fffff)
+    if 80 <= arch < 90:
+        if op in ['LD', 'LDG']:
+            ctrl['schedule'] = (code >> 32) & 0x3f
+        elif op in ['ST', 'STG', 'ATOM', 'ATOMG', 'RED']:
+            ctrl['schedule'] = (code >> 64) & 0x3f
+    return ctrl
+
+
 def decode_ctrls(code):
     ctrl1 = code & 0x1fffff
     ctrl2 = (code >> 21) & 0x1fffff
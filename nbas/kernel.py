@@ -1,5 +1,5 @@
+from .decoder import *
 from .elf import *
-from .ptx import *
 from .tool import *
 
 
@@ -701,7 +701,7 @@ class Kernel:
         assert (0 == self.max_stack_size)
 
     def store_info(self):
-        data = b''
+        data = bytearray()
 
         if self.sw_war:
             code = self.EIATTR['SW_WAR']
@@ -793,7 +793,7 @@ class Kernel:
         if self.indirect_branch_targets:
             code = self.EIATTR['INDIRECT_BRANCH_TARGETS']
             size = 0
-            tmp_data = b''
+            tmp_data = bytearray()
             for item in self.indirect_branch_targets:
                 c = len(item) - 4
                 tmp_data += pack(f'<IHHI{c}I', *item)
@@ -911,20 +911,59 @@ class Kernel:
             self.param_size = max(self.param_size, param['Size'] + param['Offset'] - self.param_base)
         self.instrs = instrs
 
-    def disassemble(self):
-        sass = disassemble_nv(self.binary, self.arch)
-
+    def disassemble(self, decoder='nvdisasm', sass=None, instrs=None):
+        """
+        :param decoder: nvdisasm, native (decode with the grammar tables, without nvdisasm) or check (nvdisasm,
+                        cross-checked instruction by instruction with the native decoder)
+        :param sass: nvdisasm output of this kernel, from Cubin.disassemble, instead of running nvdisasm
+        :param instrs: decoded instrs of a kernel with the same binary, copied instead of decoding again
+        :return: decoded instrs, without line info, for kernels with the same binary
+        """
+        if instrs is not None:
+            # mapping labels, relocations and constants rewrites instrs, each kernel has its own
+            self.instrs = [dict(instr) for instr in instrs]
+        else:
+            # check always runs both decoders, it is not cached
+            key = das_cache.key(self.binary, self.arch, decoder) if das_cache.enabled and decoder != 'check' else None
+            instrs = das_cache.get(key) if key else None
+            if instrs is None:
+                instrs = self.decode(decoder, sass)
+                if key:
+                    das_cache.put(key, instrs)
+            self.instrs = list(instrs)
+
+        # the instrs dicts may be shared, line info replaces them
+        for a, l in self.line_info.items():
+            i = addr2line_num(a, self.arch)
+            self.instrs[i] = {**self.instrs[i], 'ptx': self.cubin.ptx[l]}
+        return instrs
+
+    def decode(self, decoder='nvdisasm', sass=None):
+        if decoder == 'native':
+            return disassemble_native(self.binary, self.arch)
+        instrs = None
+        if sass is not None:
+            instrs = self.read_sass(sass)
+            if len(instrs) != addr2line_num(len(self.binary), self.arch):
+                print(f'Warning: ({self.name.decode()}) cubin disassembly has {len(instrs)} instructions, '
+                      f'disassemble the kernel alone.')
+                instrs = None
+        if instrs is None:
+            instrs = self.read_sass(disassemble_nv(self.binary, self.arch))
+        if decoder == 'check':
+            self.check_native(instrs)
+        return instrs
+
+    def read_sass(self, sass):
         # read sass lines
         instrs = []
-        i = 0
+        # lines are read as they come, sass may be a generator of nvdisasm output
+        sass = iter(sass)
         if self.arch < 70:
-            while i < len(sass):
-                line = sass[i]
-                i += 1
+            for line in sass:
                 ctrls = process_sass_ctrl_line(line)
                 for ctrl in ctrls:
-                    line = sass[i]
-                    i += 1
+                    line = next(sass)
                     instr = process_sass_line(line)
 
                     # 去掉;前的空白
@@ -935,43 +974,45 @@ class Kernel:
                     instr = {'line_num': len(instrs), 'label': '', 'ctrl': print_ctrl(ctrl), **ctrl, **instr}
                     instrs.append(instr)
         elif self.arch < 90:
-            while i < len(sass):
-                line = sass[i]
+            for line in sass:
                 instr = process_sass_line(line)
-                i += 1
                 if not instr:
                     continue
-                instr = process_sass_code(sass[i], instr)
-                i += 1
+                instr = process_sass_code(next(sass), instr)
                 if not instr:
                     raise Exception(f'process_sass_code failed: {line}')
-                ctrl_binary = (int(instr['code'], base=0) >> 105) & 0x1fffff
-                ctrl = decode_ctrl(ctrl_binary)
+                ctrl = decode_sass_ctrl(int(instr['code'], base=0), instr['op'], self.arch)
                 # 去掉;前的空白
                 instr['rest'] = re.sub(r'\s+;', ';', instr['rest'])
                 # 多个空白变成一个空格
                 instr['rest'] = re.sub(r'[ \t]+', ' ', instr['rest'])
 
-                if 80 <= self.arch < 90:
-                    op = instr['op']
-                    if op in ['LD', 'LDG']:
-                        ctrl['schedule'] = (int(instr['code'], base=0) >> 32) & 0x3f
-                    elif op in ['ST', 'STG', 'ATOM', 'ATOMG', 'RED']:
-                        ctrl['schedule'] = (int(instr['code'], base=0) >> 64) & 0x3f
-
                 instr = {'line_num': len(instrs), 'label': '', 'ctrl': print_ctrl(ctrl), **ctrl, **instr}
 
                 instrs.append(instr)
         else:
             raise Exception(f'Unsupported arch {self.arch}')
+        return instrs
 
-        for a, l in self.line_info.items():
-            i = addr2line_num(a, self.arch)
-            instrs[i]['ptx'] = self.cubin.ptx[l]
-
-        self.instrs = instrs
+    def check_native(self, instrs):
+        if self.arch >= 90:
+            print(f'Warning: native decoder does not support arch {self.arch}, not checked.')
+            return
+        for instr in instrs:
+            # Maxwell/Pascal control codes come from the group header
+            ctrl_code = encode_ctrl(instr['ctrl']) | instr['reuse'] << 17 if self.arch < 70 else 0
+            native = decode_instruction(int(instr['code'], base=0), int(instr['addr'], base=16), self.arch, ctrl_code)
+            expected = {k: v for k, v in instr.items() if k not in ['line_num', 'label']}
+            if native is None:
+                print(f'Warning: native decoder failed: /*{instr["addr"]}*/ {print_instr(instr)}')
+            elif native != expected:
+                print(f'Warning: native decoder mismatch: /*{instr["addr"]}*/ {print_instr(instr)}')
+                print(f'    native: {print_ctrl(native)} {print_instr(native)}')
 
     def decompile_ptx(self):
+        # grammar_ptx is only needed here, keep it out of the other commands' startup
+        from .ptx import ptx_ignore_instrs, ptx_matcher, ptx_ord
+
         self.pred_regs = set()
         self.upred_regs = set()
         self.reg_set = set()
@@ -1008,15 +1049,7 @@ class Kernel:
                     self.upred_regs.add(int(instr.pred_reg.strip("UP"), base=0))
                 else:
                     self.pred_regs.add(int(instr.pred_reg.strip("P"), base=0))
-            grams = grammar_ptx[op] if op in grammar_ptx else []
-            gram = None
-            captured_dict = None
-            for g in grams:
-                m = re.search(g['rule'], op + rest)
-                if m:
-                    gram = g
-                    captured_dict = m.groupdict()
-                    break
+            gram, captured_dict = ptx_matcher.match(op, rest)
             if not gram:
                 # raise Exception(f'Cannot recognize instruction {op + rest}')
                 instr.ptx = None
@@ -1083,21 +1116,14 @@ class Kernel:
         self.ctaid_offsets = []
         self.ctaidz_used = False
         codes = []
+        matcher = get_matcher(self.arch)
         for i, instr_group in enumerate(instrs):
             ctrl_group = []
             code_group = []
             for instr in instr_group:
                 op = instr['op']
                 rest = instr['rest']
-                grams = grammar_61[op]
-                gram = None
-                captured_dict = None
-                for g in grams:
-                    m = re.search(g['rule'], op + rest)
-                    if m:
-                        gram = g
-                        captured_dict = m.groupdict()
-                        break
+                gram, captured_dict = matcher.match(op, rest)
                 if not gram:
                     raise Exception(f'Cannot recognize instruction {op + rest}')
                 ctrl, code = encode_instruction(op, gram, captured_dict, instr, self.arch)
@@ -1196,18 +1222,11 @@ class Kernel:
         self.ctaid_offsets = []
         self.ctaidz_used = False
         codes = []
+        matcher = get_matcher(self.arch)
         for i, instr in enumerate(instrs):
             op = instr['op']
             rest = instr['rest']
-            grams = grammar_75[op]
-            gram = None
-            captured_dict = None
-            for g in grams:
-                m = re.search(g['rule'], op + rest)
-                if m:
-                    gram = g
-                    captured_dict = m.groupdict()
-                    break
+            gram, captured_dict = matcher.match(op, rest)
             if not gram:
                 raise Exception(f'Cannot recognize instruction {op + rest}')
             ctrl, code = encode_instruction(op, gram, captured_dict, instr, self.arch)
@@ -1308,21 +1327,15 @@ class Kernel:
 
     def check_reg_bank(self):
         reuse_history = [[-1, -1], [-1, -1], [-1, -1], [-1, -1]]
+        matcher = get_matcher(61)
         for i, instr in enumerate(self.instrs):
             op = instr['op']
             rest = instr['rest']
-            grams = grammar_61[op]
-            gram = None
-            captured_dict = None
-            for g in grams:
-                m = re.search(g['rule'], op + rest)
-                if m:
-                    gram = g
-                    captured_dict = m.groupdict()
-                    break
+            gram, captured_dict = matcher.match(op, rest)
             if not gram:
                 raise Exception(f'Cannot recognize instruction {op + rest}')
             if 'r39s20' in captured_dict:
+                captured_dict = dict(captured_dict)
                 captured_dict['r20'] = captured_dict['r39s20']
                 captured_dict['r39s20'] = ''
             banks = [[], [], [], []]
@@ -1485,15 +1498,19 @@ class Kernel:
         self.info_section = info_section
 
     def gen_rels(self, symbol_dict):
-        for rel in reversed(self.rels):
-            rel.sym = symbol_dict[rel.sym_name].index
-            rel.r_info = rel.type | (rel.sym << 32)
-            self.rel_section.data += rel.pack_entry()
         if self.rel_section:
+            entsize = self.rel_section.sh_entsize
+            self.rel_section.data = bytearray(len(self.rels) * entsize)
+            for i, rel in enumerate(reversed(self.rels)):
+                rel.sym = symbol_dict[rel.sym_name].index
+                rel.r_info = rel.type | (rel.sym << 32)
+                rel.pack_entry(self.rel_section.data, i * entsize)
             self.rel_section.sh_size = len(self.rel_section.data)
-        for rela in reversed(self.relas):
-            rela.sym = symbol_dict[rela.sym_name].index
-            rela.r_info = rela.type | (rela.sym << 32)
-            self.rela_section.data += rela.pack_entry()
         if self.rela_section:
+            entsize = self.rela_section.sh_entsize
+            self.rela_section.data = bytearray(len(self.relas) * entsize)
+            for i, rela in enumerate(reversed(self.relas)):
+                rela.sym = symbol_dict[rela.sym_name].index
+                rela.r_info = rela.type | (rela.sym << 32)
+                rela.pack_entry(self.rela_section.data, i * entsize)
             self.rela_section.sh_size = len(self.rela_section.data)
@@ -411,7 +411,7 @@ def ptx_isetp(kernel, captured_dict, instr):
         for i in reversed(kernel.instrs[:instr.line_num]):
             op = i.op
             rest = re.sub(r'\.reuse', '', i.rest)
-            if m := re.search(grammar_ptx['ISETP'][0]['rule'], op + rest):
+            if m := ptx_isetp_rule.search(op + rest):
                 cd = m.groupdict()
                 pp = ptx_p(cd, 'pp')
                 pcmp_str = cd['cmp'].lower()
@@ -1398,6 +1398,9 @@ grammar_ptx = {
 
 }
 
+ptx_matcher = GrammarMatcher(grammar_ptx)
+ptx_isetp_rule = re.compile(grammar_ptx['ISETP'][0]['rule'])
+
 # def ptx_add(f, d, a, b):
 #     if '-' in a:
 #         op = 'sub'
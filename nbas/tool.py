@@ -1,23 +1,171 @@
-from struct import pack
-from subprocess import getstatusoutput
+from itertools import repeat
+from struct import pack, unpack_from
+from subprocess import PIPE, Popen
 from operator import itemgetter
-from tempfile import mkstemp
+from tempfile import TemporaryFile, mkstemp
 
 from .grammar import *
 
 
-def load_ptx_line_info(path):
-    ret, sass = getstatusoutput(f'nvdisasm -c -novliw -ndf -gp {path}')
+class NvdisasmArchive:
+    """
+    Recorded nvdisasm runs: sha256 of (arguments, input file content) -> exit status, output, error output.
+    In record mode a recorded run is served from the archive, others run nvdisasm and are appended. In replay mode
+    nvdisasm never runs, a run not recorded raises Warning.
+    The archive is a magic followed by length prefixed zlib compressed marshal records, appended with one write
+    each, so -j workers can record into the same file.
+    """
+    MAGIC = b'NBASREC1'
+
+    def __init__(self):
+        self.path = ''
+        self.mode = ''
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'Entries:{len(self.entries)}, Hits:{self.hits}, Misses:{self.misses}'
+
+    def open(self, path, mode):
+        """
+        :param mode: record or replay
+        """
+        self.path = path
+        self.mode = mode
+        self.entries = {}
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            if mode == 'replay':
+                raise Exception(f'nvdisasm archive {path} not found.')
+            return
+        if not data.startswith(self.MAGIC):
+            raise Exception(f'{path} is not an nvdisasm archive.')
+        offset = len(self.MAGIC)
+        while offset + 4 <= len(data):
+            size, = unpack_from('<I', data, offset)
+            # a record cut short by an interrupted run is dropped
+            if offset + 4 + size > len(data):
+                break
+            key, entry = marshal.loads(zlib.decompress(data[offset + 4:offset + 4 + size]))
+            self.entries[key] = entry
+            offset += 4 + size
+
+    @staticmethod
+    def key(args, content):
+        from hashlib import sha256
+        h = sha256(content)
+        h.update('\0'.join(args).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, ret, lines, error):
+        entry = (ret, '\n'.join(lines), error)
+        self.entries[key] = entry
+        record = zlib.compress(marshal.dumps((key, entry)))
+        # O_APPEND, the header only if the file is new
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.write(fd, self.MAGIC)
+            os.write(fd, pack('<I', len(record)) + record)
+        finally:
+            os.close(fd)
+
+
+nvdisasm_archive = NvdisasmArchive()
+
+
+def nvdisasm_error(ret, count, error):
     if ret != 0:
-        raise Warning(f'{sass}')
-    sass = [line for line in sass.split('\n')]
-    if len(sass) <= 1:
-        raise Warning(f'{sass}')
+        return Warning(f'nvdisasm exited with status {ret}: {error}')
+    if count <= 1:
+        return Warning(f'nvdisasm printed no disassembly: {error}')
+    return None
+
+
+def run_nvdisasm(args, path='', binary=None):
+    """
+    Run nvdisasm and iterate over its output lines as they are printed, instead of waiting for the whole output.
+    Runs go through nvdisasm_archive when it is open.
+    :param args: nvdisasm arguments, before the input file
+    :param path: input file
+    :param binary: input content, passed in a memfd (or a temporary file) when there is no path
+    :return: generator of lines, raises Warning with the exit status and the error output if nvdisasm fails
+    """
+    key = None
+    if nvdisasm_archive.mode:
+        if binary is None:
+            with open(path, 'rb') as f:
+                binary = f.read()
+        key = nvdisasm_archive.key(args, binary)
+        entry = nvdisasm_archive.get(key)
+        if entry is None and nvdisasm_archive.mode == 'replay':
+            raise Warning(f'nvdisasm run not recorded in {nvdisasm_archive.path}: {" ".join(args)} {path}')
+        if entry is not None:
+            ret, output, error = entry
+            lines = output.split('\n') if output else []
+            yield from lines
+            if warn := nvdisasm_error(ret, len(lines), error):
+                raise warn
+            return
+
+    tmp_file = ''
+    fds = ()
+    if not path:
+        if hasattr(os, 'memfd_create'):
+            # nvdisasm opens /dev/fd/N, a new description of the memfd from offset 0
+            fd = os.memfd_create('nbas')
+            fds = (fd,)
+            path = f'/dev/fd/{fd}'
+        else:
+            fd, tmp_file = mkstemp()
+            path = tmp_file
+        with open(fd, 'wb', closefd=not fds) as f:
+            f.write(binary)
+    lines = []
+    try:
+        # stderr goes to a file, a pipe could fill up and block nvdisasm while stdout is read
+        with TemporaryFile('w+') as err:
+            try:
+                p = Popen(['nvdisasm', *args, path], stdout=PIPE, stderr=err, text=True, pass_fds=fds)
+            except OSError as e:
+                # nvdisasm not installed or not executable
+                raise Warning(f'nvdisasm failed to run: {e}')
+            with p:
+                for line in p.stdout:
+                    line = line.rstrip('\n')
+                    lines.append(line)
+                    yield line
+                ret = p.wait()
+            err.seek(0)
+            error = err.read()
+    finally:
+        for fd in fds:
+            os.close(fd)
+        if tmp_file:
+            os.remove(tmp_file)
+    if key:
+        nvdisasm_archive.put(key, ret, lines, error)
+    if warn := nvdisasm_error(ret, len(lines), error):
+        raise warn
+
+
+def load_ptx_line_info(path, binary=None):
+    sass = run_nvdisasm(['-c', '-novliw', '-ndf', '-gp'], path if path != '-' else '', binary)
     kernel_name = b''
     kernels = {}
     line_info = {}
-    for i in range(len(sass)):
-        line = sass[i]
+    for line in sass:
         if m := re.search(rf'//-+\s+\.text\.(?P<name>\w+)', line):
             if line_info and kernel_name:
                 kernels[kernel_name] = line_info
@@ -26,7 +174,7 @@ def load_ptx_line_info(path):
         elif m := re.search(rf'//##.+?line\s+(?P<line>\d+)', line):
             # 行号改为从零开始
             line_num = int(m.group('line'), base=10) - 1
-            next_line = sass[i+1]
+            next_line = next(sass, '')
             m = re.search(ADDR_RE, next_line)
             if not m:
                 raise Warning(f'ptx line info file parse error:\n  {line}\n  {next_line}')
@@ -38,31 +186,290 @@ def load_ptx_line_info(path):
 
 
 def disassemble_nv(binary, arch):
-    fd, tmp_file = mkstemp()
-    os.close(fd)
-    with open(tmp_file, 'wb') as f:
-        f.write(binary)
-    ret, sass = getstatusoutput(f'nvdisasm -b SM{arch} -hex -novliw {tmp_file}')
-    os.remove(tmp_file)
-    if ret != 0:
-        raise Warning(f'{sass}')
-    sass = [line for line in sass.split('\n')]
-    if len(sass) <= 1:
-        raise Warning(f'{sass}')
-    return sass
+    """
+    :return: generator of the nvdisasm output lines of the raw kernel binary
+    """
+    return run_nvdisasm(['-b', f'SM{arch}', '-hex', '-novliw'], binary=binary)
+
+
+# operands nvdisasm prints from the relocations of a cubin, 0x0 when disassembling the raw binary
+RELOC_OPERAND_RE = r'32@(?:lo|hi|fn)\((?:\([^()]*\)|[^()])*\)'
+
+
+def split_sass_sections(sass, arch):
+    """
+    Split the sass of a whole cubin by .text.<name> section, each in the format of disassemble_nv output: only the
+    instruction and code lines, label references back to addresses and relocated operands back to 0x0.
+    :return: {kernel name: sass lines}
+    """
+    sections = {}
+    lines = None
+    for line in sass:
+        if m := re.search(r'//-+\s+\.text\.(?P<name>\S+)', line):
+            lines = sections[m.group('name').encode()] = []
+        elif lines is not None:
+            lines.append(line)
+
+    kernels = {}
+    for name, lines in sections.items():
+        labels = {}
+        pending = []
+        sass = []
+        addr = 0
+        for line in lines:
+            if m := re.search(r'^\s*(?P<label>\.L\w+):', line):
+                pending.append(m.group('label'))
+            elif m := re.search(rf'^\s+{ADDR_RE}', line):
+                addr = int(m.group('addr'), base=16)
+                # like in the raw binary, jumps to the first instruction of a group go to the group
+                target = addr - 0x8 if arch < 70 and addr % 0x20 == 0x8 else addr
+                for label in pending:
+                    labels[label] = target
+                pending = []
+                sass.append(line)
+            elif re.search(rf'^\s+{CODE_RE}', line):
+                sass.append(line)
+        for label in pending:
+            labels[label] = addr + (0x8 if arch < 70 else 0x10)
+
+        def replace_label(m):
+            return hex(labels[m.group(1)]) if m.group(1) in labels else '0x0'
+
+        kernels[name] = [re.sub(r'`\(([^()]*)\)', replace_label, re.sub(RELOC_OPERAND_RE, '0x0', line))
+                         for line in sass]
+    return kernels
+
+
+def disassemble_nv_cubin(path, arch, binary=None):
+    """
+    Disassemble every kernel of the cubin at path (or its content binary, for -) with a single nvdisasm run.
+    :return: {kernel name: sass lines of disassemble_nv}
+    """
+    return split_sass_sections(run_nvdisasm(['-c', '-hex', '-novliw'], path if path != '-' else '', binary), arch)
+
+
+nvdisasm_versions = []
+
+
+def nvdisasm_version():
+    """
+    Version line of the nvdisasm on the PATH, empty if it cannot run.
+    """
+    if not nvdisasm_versions:
+        key = nvdisasm_archive.key(['--version'], b'')
+        # the version is always asked to nvdisasm itself when it can run, and recorded for replay
+        if nvdisasm_archive.mode == 'replay':
+            ret, output, _ = nvdisasm_archive.entries.get(key, (1, '', ''))
+        else:
+            try:
+                with Popen(['nvdisasm', '--version'], stdout=PIPE, stderr=PIPE, text=True) as p:
+                    output = p.communicate()[0].strip()
+                ret = p.returncode
+            except OSError:
+                ret, output = 1, ''
+            recorded = nvdisasm_archive.entries.get(key)
+            if nvdisasm_archive.mode == 'record' and ret == 0 and recorded != (ret, output, ''):
+                nvdisasm_archive.put(key, ret, output.split('\n'), '')
+        nvdisasm_versions.append(output.split('\n')[-1] if ret == 0 else '')
+    return nvdisasm_versions[0]
+
+
+def decoder_hash():
+    """
+    Version of decoder.py and kernel.py, which turn kernel binaries into the instrs kept by das_cache.
+    """
+    global decoder_version
+    if not decoder_version:
+        crc = 0
+        for name in ('decoder.py', 'kernel.py'):
+            with open(os.path.join(os.path.dirname(__file__), name), 'rb') as f:
+                crc = zlib.crc32(f.read(), crc)
+        decoder_version = f'{crc:08x}'
+    return decoder_version
+
+
+decoder_version = ''
+
+
+class DisassemblyCache:
+    """
+    On-disk cache of disassembled kernels: hash of (kernel binary, arch, decoder, nvdisasm version, grammar.py,
+    decoder.py and kernel.py) -> instrs, one marshal file each under NBAS_CACHE_DIR/das. Files are touched when read,
+    the least recently used are removed once the directory grows over maxsize bytes (NBAS_DAS_CACHE_SIZE MiB,
+    default 256).
+    """
+
+    def __init__(self, path=os.path.join(cache_dir, 'das'),
+                 maxsize=int(os.environ.get('NBAS_DAS_CACHE_SIZE', 256)) << 20, enabled=True):
+        self.path = path
+        self.maxsize = maxsize
+        self.enabled = enabled
+        # bytes under path, scanned on the first put
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'Hits:{self.hits}, Misses:{self.misses}, Evictions:{self.evictions}'
+
+    @staticmethod
+    def key(binary, arch, decoder):
+        from hashlib import sha256
+        version = nvdisasm_version() if decoder == 'nvdisasm' else ''
+        h = sha256(binary)
+        h.update(f'{arch}:{decoder}:{version}:{grammar_hash()}:{decoder_hash()}'.encode())
+        return h.hexdigest()
+
+    def contains(self, key):
+        return self.enabled and os.path.exists(os.path.join(self.path, f'{key}.marshal'))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = os.path.join(self.path, f'{key}.marshal')
+        try:
+            with open(path, 'rb') as f:
+                instrs = marshal.loads(f.read())
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return instrs
+
+    def put(self, key, instrs):
+        # write then rename, concurrent nbasm processes may save the same kernel
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(instrs, f)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, f'{key}.marshal'))
+        except OSError:
+            return
+        if self.size is None:
+            self.size = sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+        else:
+            self.size += size
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(self.path)
+                         if entry.is_file() and entry.name.endswith('.marshal'))
+        self.size = sum(size for _, size, _ in entries)
+        # down to 3/4 of maxsize, not to evict again on the next put
+        for _, size, path in entries:
+            if self.size <= self.maxsize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def pop(self):
+        """
+        Counts since the last pop, to merge into the cache of another process.
+        """
+        stats = self.hits, self.misses, self.evictions
+        self.hits = self.misses = self.evictions = 0
+        return stats
+
+    def merge(self, stats):
+        hits, misses, evictions = stats
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+
+das_cache = DisassemblyCache()
 
 
-def detect(code, begin, end, arch):
-    # prepare code
+def detect_variants(codes, arch, nop_group=()):
+    """
+    Disassemble code variants with a single nvdisasm run, one variant per instruction slot (per group before
+    Volta, followed by nop_group). If nvdisasm rejects the batch, it is split until the failing variants are alone.
+    :return: [instr, or the Warning of nvdisasm for a variant]
+    """
+    if arch < 70:
+        binary = b''.join(pack('<4Q', nop_group[0], code, *nop_group[1:]) for code in codes)
+    else:
+        binary = b''.join(pack('<QQ', code & 0xFFFFFFFFFFFFFFFF, code >> 64) for code in codes)
+    try:
+        sass = iter(list(disassemble_nv(binary, arch)))
+    except Warning as warn:
+        if len(codes) == 1:
+            return [warn]
+        # failing variants come in runs when opcode bits are swept, small batches go to single variants at once
+        step = 1 if len(codes) <= 8 else -(-len(codes) // 2)
+        return [instr for i in range(0, len(codes), step)
+                for instr in detect_variants(codes[i:i + step], arch, nop_group)]
+
+    # demultiplex by address: group i before Volta (instruction at +0x8), slot i after
+    size = 0x20 if arch < 70 else 0x10
+    instrs = [Warning('nvdisasm printed nothing for the variant.') for _ in codes]
+    for line in sass:
+        instr = process_sass_line(line)
+        if not instr:
+            continue
+        if arch >= 70:
+            instr = process_sass_code(next(sass, ''), instr)
+        addr = int(instr['addr'], base=16) if instr else -1
+        if addr % size != (0x8 if arch < 70 else 0) or not 0 <= addr // size < len(codes):
+            continue
+        # relative jump targets as if the variant was disassembled alone at the start of the binary
+        if instr['op'] in (rel_jump_op_61 if arch < 70 else rel_jump_op_75):
+            offset = addr - addr % size
+            instr['rest'] = re.sub(rf'{i20w24}(?=\s*;)',
+                                   lambda m: hex(int(m.group('i20w24'), base=0) - offset), instr['rest'])
+        instrs[addr // size] = instr
+    return instrs
+
+
+def detect_code(code, arch):
+    """
+    Make code a standalone instruction for nvdisasm: PT guard and a plain control code, NOPs to fill the group
+    before Volta.
+    :return: code, nop_group for detect_variants
+    """
     ctrl = encode_ctrl('-:--:-:-:-:1')
-    code_group = []
+    nop_group = ()
     if arch < 70:
         ctrls = encode_ctrls(ctrl, ctrl, ctrl)
         code |= 0x70000
-        code_group = [ctrls, code, 0x50b0000000070f00, 0x50b0000000070f00]
+        nop_group = (ctrls, 0x50b0000000070f00, 0x50b0000000070f00)
     else:
         code |= ctrl << 105
         code |= 0x7000
+    return code, nop_group
+
+
+def disassemble_variants(variants, arch, nop_group=(), jobs=1):
+    """
+    detect_variants split across jobs processes.
+    """
+    if jobs > 1 and len(variants) > 1:
+        chunk = -(-len(variants) // jobs)
+        chunks = [variants[i:i + chunk] for i in range(0, len(variants), chunk)]
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            return [instr for chunk_instrs in executor.map(detect_variants, chunks, repeat(arch), repeat(nop_group))
+                    for instr in chunk_instrs]
+    return detect_variants(variants, arch, nop_group)
+
+
+def detect(code, begin, end, arch, jobs=1):
+    """
+    Flip the bits [begin, end) of code one by one (more than 8 bits) or sweep all their values, and print what
+    nvdisasm makes of each variant. Variants are disassembled in batches, in jobs processes.
+    """
+    code, nop_group = detect_code(code, arch)
 
     codes = [{'code': code, 'info': 'O ----------'}]
 
@@ -78,22 +485,14 @@ def detect(code, begin, end, arch):
         for i in range(1 << length):
             codes.append({'code': code & (~mask) | i << begin, 'info': f'N {i:#010b}'})
 
-    for i, line in enumerate(codes):
+    instrs = disassemble_variants([line['code'] for line in codes], arch, nop_group, jobs)
+
+    for i, (line, instr) in enumerate(zip(codes, instrs)):
         code = line['code']
         info = line['info']
-        if arch < 70:
-            code_group[1] = code
-            binary = pack(f'<{len(code_group)}Q', *code_group)
+        if isinstance(instr, Warning):
+            print(f'{instr}')
         else:
-            binary = pack(f'<QQ', code & 0xFFFFFFFFFFFFFFFF, code >> 64)
-
-        try:
-            sass = disassemble_nv(binary, arch)
-            if arch < 70:
-                instr = process_sass_line(sass[2])
-            else:
-                instr = process_sass_line(sass[1])
-                instr = process_sass_code(sass[2], instr)
             code_diff = codes[0]['code']
             if code_diff != code:
                 if length > 8:
@@ -104,8 +503,6 @@ def detect(code, begin, end, arch):
                 print(f'{info} {code:#018x} {code_diff:#018x} {print_instr(instr)}')
             else:
                 print(f'{info} {code:#034x} {code_diff:#034x} {print_instr(instr)}')
-        except Warning as warn:
-            print(f'{warn}')
 
         if i % 4 == 0:
             print('')
@@ -205,17 +602,12 @@ def schedule_61(instrs):
     ready = []
     schedule = []
     ordered_parent = {}
+    matcher = get_matcher(61)
     # assemble the instructions to op codes
     for instr in instrs:
         op = instr['op']
         rest = instr['rest']
-        gram = None
-        captured_dict = None
-        for g in grammar_61[op]:
-            if m := re.search(g['rule'], op + rest):
-                gram = g
-                captured_dict = m.groupdict()
-                break
+        gram, captured_dict = matcher.match(op, rest)
         if not captured_dict:
             raise Exception(f'Cannot recognize instruction {op + rest}')
         src = []
@@ -452,6 +844,7 @@ def schedule_75(instrs):
 
     schedule = []
     clock = 0
+    matcher = get_matcher(75)
 
     for block in blocks:
         reads = {}
@@ -462,15 +855,7 @@ def schedule_75(instrs):
         for instr in block:
             op = instr['op']
             rest = instr['rest']
-            grams = grammar_75[op]
-            gram = None
-            captured_dict = None
-            for g in grams:
-                m = re.search(g['rule'], op + rest)
-                if m:
-                    gram = g
-                    captured_dict = m.groupdict()
-                    break
+            gram, captured_dict = matcher.match(op, rest)
             if not gram:
                 raise Exception(f'Cannot recognize instruction {op + rest}')
 
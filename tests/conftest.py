@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from nbas.__main__ import assemble_cubin, gen_cubin
+from nbas.cubin import Cubin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def cubin_path(tmp_path_factory):
+    """
+    global_run.s assembled to a cubin.
+    """
+    cubin = Cubin()
+    assemble_cubin(cubin, os.path.join(ROOT, 'global_run.s'), {}, False)
+    gen_cubin(cubin)
+    path = str(tmp_path_factory.mktemp('cubin') / 'global_run.cubin')
+    cubin.write(path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def multi_cubin_path(tmp_path_factory):
+    """
+    The kernel of global_run.s repeated as kTest0..kTest3, for -j.
+    """
+    with open(os.path.join(ROOT, 'global_run.s')) as f:
+        header, kernel = f.read().split('.kernel: kTest')
+    asm_path = str(tmp_path_factory.mktemp('cubin') / 'multi.s')
+    with open(asm_path, 'w') as f:
+        f.write(header + ''.join(f'.kernel: kTest{i}' + kernel for i in range(4)))
+    cubin = Cubin()
+    assemble_cubin(cubin, asm_path, {}, False)
+    gen_cubin(cubin)
+    path = asm_path[:-2] + '.cubin'
+    cubin.write(path)
+    return path
+
+
+def run_nbas(*args):
+    """
+    nbasm in a new process, for the commands starting worker processes.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-m', 'nbas', *args], env=env, cwd=ROOT, check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
@@ -0,0 +1,91 @@
+import random
+from struct import pack
+
+import pytest
+
+import nbas.tool
+from nbas.decoder import disassemble_native, get_decoders, get_opcode_index
+from nbas.kernel import Kernel
+from nbas.tool import NvdisasmArchive
+
+# words and the text nvdisasm prints for them, from the disassembly of global_run.s (relocated operands are 0x0
+# when disassembling a raw binary) and of the README
+WORDS_75 = [
+    (0x000fc40000000f00, 0x00000a0000017a02, 'MOV R1, c[0x0][0x28]'),
+    (0x000fe40000000000, 0x0000000000047882, 'UMOV UR4, 0x0'),
+    (0x000ea2000c1ee900, 0x00000004ff007981, 'LDG.E.SYS R0, [UR4]'),
+    (0x000ea2000c1ee900, 0x00001808ff027981, 'LDG.E.SYS R2, [UR8+0x18]'),
+    (0x004fd00007ffe000, 0x0000000302007210, 'IADD3 R0, R2, R3, R0'),
+    (0x000fe2000c10e904, 0x00000000ff007986, 'STG.E.SYS [UR4], R0'),
+    (0x000fea0003800000, 0x000000000000794d, 'EXIT'),
+    (0x000fc0000383ffff, 0xfffffff000007947, 'BRA 0x70'),
+]
+# instructions printed the same for sm_86
+WORDS_86 = [WORDS_75[i] for i in (0, 1, 4, 6, 7)]
+WORDS_86[-1] = WORDS_86[-1][:2] + ('BRA 0x40',)
+# Maxwell/Pascal groups: control codes, then 3 instructions
+GROUPS_61 = [
+    (0x001fc400fe2007f6, [(0x4c98078000870001, 'MOV R1, c[0x0][0x20]'),
+                          (0xf0c8000002170000, 'S2R R0, SR_TID.X'),
+                          (0x50b0000000070f00, 'NOP')]),
+    (0x001f8000fc0007ff, [(0xe30000000007000f, 'EXIT'),
+                          (0xe2400fffff87000f, 'BRA 0x30'),
+                          (0x50b0000000070f00, 'NOP')]),
+]
+# nvdisasm prints IMAD by a power of 2 as IMAD.SHL, the native decoder has no such aliases
+ALIASES_75 = [
+    (0x000fd000078e00ff, 0x000000020202e824, '@!P6 IMAD.SHL.U32 R2, R2, 0x2, RZ'),
+]
+
+
+def sass_75(words):
+    binary = b''.join(pack('<QQ', lo, hi) for hi, lo, _ in words)
+    lines = ['']
+    for i, (hi, lo, text) in enumerate(words):
+        lines.append(f'        /*{i * 16:04x}*/                   {text} ;  /* {lo:#018x} */')
+        lines.append(f'                                                   /* {hi:#018x} */')
+    return binary, lines
+
+
+def sass_61(groups):
+    binary = b''
+    lines = ['']
+    for ctrls, instrs in groups:
+        binary += pack('<4Q', ctrls, *(code for code, _ in instrs))
+        lines.append(f'                                                   /* {ctrls:#018x} */')
+        for code, text in instrs:
+            lines.append(f'        /*{len(binary) - 32 + (len(lines) % 4) * 8:04x}*/                   {text} ;'
+                         f'  /* {code:#018x} */')
+    return binary, lines
+
+
+@pytest.mark.parametrize('arch, words', [(75, WORDS_75), (86, WORDS_86), (61, GROUPS_61),
+                                         pytest.param(75, ALIASES_75, marks=pytest.mark.xfail(strict=True))])
+def test_native_parity(arch, words, tmp_path, monkeypatch):
+    binary, lines = sass_61(words) if arch < 70 else sass_75(words)
+    # a recording of what nvdisasm prints for binary, replayed as the nvdisasm decoder runs
+    archive_path = str(tmp_path / 'nvdisasm.rec')
+    archive = NvdisasmArchive()
+    archive.open(archive_path, 'record')
+    archive.put(archive.key(['-b', f'SM{arch}', '-hex', '-novliw'], binary), 0, lines, '')
+    monkeypatch.setattr(nbas.tool, 'nvdisasm_archive', NvdisasmArchive())
+    nbas.tool.nvdisasm_archive.open(archive_path, 'replay')
+
+    kernel = Kernel(name=b'kTest', arch=arch, binary=binary)
+    expected = kernel.decode('nvdisasm')
+    native = disassemble_native(binary, arch)
+    assert len(native) == len(expected) == len(binary) // (16 if arch >= 70 else 32) * (1 if arch >= 70 else 3)
+    for a, b in zip(native, expected):
+        assert (a['pred'], a['op'], a['rest'], a['ctrl']) == (b['pred'], b['op'], b['rest'], b['ctrl'])
+
+
+@pytest.mark.parametrize('arch', [61, 75, 86])
+def test_opcode_index(arch):
+    decoders = get_decoders(arch)
+    index = get_opcode_index(arch)
+    rng = random.Random(arch)
+    # codes of each rule with random operands, and random codes
+    codes = [decoder.fixed | rng.getrandbits(128) & ~decoder.fixed_mask & decoder.code_mask for decoder in decoders]
+    codes += [rng.getrandbits(128) & decoders[0].code_mask for _ in range(1000)]
+    for code in codes:
+        assert index.lookup(code) == [d for d in decoders if not (code ^ d.fixed) & d.fixed_mask]
@@ -0,0 +1,71 @@
+import pytest
+
+import nbas.discover
+from nbas.discover import Discovery, bit_fields, classify_bit, split_flag_field, split_instr
+
+
+def sass(rest, op='IADD3', pred=''):
+    return {'op': op, 'pred': pred, 'rest': rest}
+
+
+def test_split_instr():
+    assert split_instr(sass('.X R1, R2, -R3, RZ ;', pred='@P0')) == ('IADD3', '@P0', '.X', ['R1', 'R2', '-R3', 'RZ'])
+    assert split_instr(sass('.E.SYS R2, [R2+0x10] ;', op='LDG')) == ('LDG', '', '.E.SYS', ['R2', '[R2+0x10]'])
+    assert split_instr(sass(' ;', op='EXIT')) == ('EXIT', '', '', [])
+
+
+def test_classify_bit():
+    base = sass(' R1, R2, R3, RZ ;')
+    assert classify_bit(base, Warning('illegal instruction')) == ('opcode', -1)
+    assert classify_bit(base, sass(' R1, R2, R3, RZ ;', op='IADD3X')) == ('opcode', -1)
+    assert classify_bit(base, sass(' R1, R2, R3 ;')) == ('opcode', -1)
+    assert classify_bit(base, sass(' R1, R2, R3, RZ ;', pred='@P1')) == ('guard', -1)
+    assert classify_bit(base, sass('.X R1, R2, R3, RZ ;')) == ('flag', -1)
+    assert classify_bit(base, sass(' R1, R2, R3, RZ ;')) == ('unused', -1)
+    assert classify_bit(base, sass(' R1, R6, R7, RZ ;')) == ('other', -1)
+    assert classify_bit(base, sass(' R1, R2, -R3, RZ ;')) == ('modifier', 2)
+    assert classify_bit(base, sass(' R1, R2, R3, R4 ;')) == ('r', 3)
+    assert classify_bit(base, sass(' R1, R2, 0x8, RZ ;')) == ('i', 2)
+    assert classify_bit(base, sass(' R1, R2, c[0x0][0x160], RZ ;')) == ('c', 2)
+
+
+def test_bit_fields():
+    bits = {0: ('r', 0), 1: ('r', 0), 2: ('unused', -1), 3: ('flag', -1), 4: ('flag', -1), 5: ('r', 1),
+            6: ('r', 1), 8: ('r', 1)}
+    assert bit_fields(bits) == [('r', 0, 0, 2), ('flag', -1, 3, 2), ('r', 1, 5, 2), ('r', 1, 8, 1)]
+
+
+def test_split_flag_field():
+    # .X and .LO printed exactly when their bit is set
+    tokens = {0: [], 1: ['.X'], 2: ['.LO'], 3: ['.X', '.LO']}
+    assert split_flag_field(tokens, 2) == [(0, {1: '.X'}), (1, {2: '.LO'})]
+    # a 2-bit enum next to .SAT
+    types = ['.F32', '.F16', '.BF16', '.TF32']
+    tokens = {value: [types[value & 3]] + (['.SAT'] if value & 4 else []) for value in range(8)}
+    assert split_flag_field(tokens, 3) == [(2, {4: '.SAT'}), (0, dict(enumerate(types)))]
+
+
+def test_discovery_db(monkeypatch):
+    runs = []
+
+    def disassemble_variants(codes, arch, nop_group, jobs):
+        runs.append(codes)
+        return [Warning('illegal instruction') if code & 1 else sass(f' R{code >> 1}, RZ, RZ, RZ ;')
+                for code in codes]
+
+    monkeypatch.setattr(nbas.discover, 'disassemble_variants', disassemble_variants)
+    discovery = Discovery(':memory:', 75)
+    codes = [4, 5, 6, 4]
+    instrs = discovery.disassemble(codes)
+    assert runs == [[4, 5, 6]]
+    assert isinstance(instrs[1], Warning)
+
+    # read back from the observations, without nvdisasm
+    discovery.replay = True
+    replayed = discovery.disassemble(codes)
+    assert runs == [[4, 5, 6]]
+    assert replayed[0] == replayed[3] == instrs[0] == sass(' R2, RZ, RZ, RZ ;')
+    assert replayed[2] == instrs[2]
+    assert isinstance(replayed[1], Warning) and str(replayed[1]) == str(instrs[1])
+    with pytest.raises(Exception, match='1 codes not recorded'):
+        discovery.disassemble([8])
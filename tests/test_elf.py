@@ -0,0 +1,68 @@
+import os
+import threading
+from struct import pack
+
+import pytest
+
+import nbas.cubin
+from nbas.cubin import Cubin
+from nbas.elf import Section, decode_debug_line
+
+
+def write_fifo(tmp_path, data):
+    path = str(tmp_path / 'fifo')
+    os.mkfifo(path)
+
+    def write():
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    threading.Thread(target=write, daemon=True).start()
+    return path
+
+
+def test_load_pipe(cubin_path, tmp_path):
+    with open(cubin_path, 'rb') as f:
+        data = f.read()
+    expected = Cubin()
+    expected.load(cubin_path)
+
+    cubin = Cubin()
+    cubin.load(write_fifo(tmp_path, data))
+    assert bytes(cubin.data) == data
+    assert list(cubin.kernel_dict) == list(expected.kernel_dict)
+    assert [bytes(s.data) for s in cubin.sections] == [bytes(s.data) for s in expected.sections]
+
+
+def debug_line_unit(version):
+    # min_inst_length, (max_ops), default_is_stmt, line_base, line_range, opcode_base, standard_opcode_lengths,
+    # empty include_directories and file_names
+    header = bytes([16]) + (b'\1' if version >= 4 else b'') + pack('<BbBB', 1, -5, 14, 10) + bytes(9) + b'\0\0'
+    if version >= 5:
+        # address_size, segment_selector_size
+        fields = pack('<HBBI', version, 8, 0, len(header))
+    else:
+        fields = pack('<HI', version, len(header))
+    # DW_LNE_set_address 0x20, DW_LNS_copy
+    program = b'\0\x09\2' + pack('<Q', 0x20) + b'\1'
+    unit = fields + header + program
+    return pack('<I', len(unit)) + unit
+
+
+def test_decode_debug_line():
+    for version in [2, 3, 4]:
+        data = debug_line_unit(version)
+        # relative to the set_address operand, before DW_LNS_copy
+        assert decode_debug_line(data) == [(len(data) - 9, 0x20, 1)]
+    with pytest.raises(Warning):
+        decode_debug_line(debug_line_unit(5))
+
+
+def test_debug_line_fallback(monkeypatch):
+    # line info of a DWARF 5 .nv_debug_line_sass comes from nvdisasm -gp
+    ptx_line_info = {b'kTest': {0x20: 0}}
+    monkeypatch.setattr(nbas.cubin, 'load_ptx_line_info', lambda path, data: ptx_line_info)
+    cubin = Cubin()
+    cubin.section_dict[b'.nv_debug_ptx_txt'] = Section(data=b'ret;\0')
+    cubin.section_dict[b'.nv_debug_line_sass'] = Section(data=debug_line_unit(5))
+    assert cubin.load_line_info() == ptx_line_info
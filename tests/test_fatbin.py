@@ -0,0 +1,138 @@
+import os
+import struct
+
+import pytest
+from conftest import ROOT, run_nbas
+
+from nbas.__main__ import assemble_cubin, gen_cubin
+from nbas.cubin import Cubin
+from nbas.fatbin import Fatbin, decompress_lz4
+
+
+def lz4_length(length):
+    # extra length bytes after a nibble of 15
+    return bytes([255] * ((length - 15) // 255) + [(length - 15) % 255]) if length >= 15 else b''
+
+
+def lz4_literals(data):
+    # a valid LZ4 block with a single literal run
+    return bytes([min(len(data), 15) << 4]) + lz4_length(len(data)) + data
+
+
+def fatbin_entry(kind, arch, payload, compressed=False):
+    flags = 0x11
+    compressed_size = decompressed_size = 0
+    if compressed:
+        decompressed_size = len(payload)
+        payload = lz4_literals(payload)
+        compressed_size = len(payload)
+        flags |= 0x2000
+    payload += bytes(-len(payload) % 8)
+    header = struct.pack('<HHIQIIHHIIIQQQ', kind, 0x101, 64, len(payload), compressed_size, 0, 4, 1, arch, 0, 0,
+                         flags, 0, decompressed_size)
+    return header + payload
+
+
+def fatbin_container(*entries):
+    body = b''.join(entries)
+    return struct.pack('<IHHQ', 0xBA55ED50, 1, 16, len(body)) + body
+
+
+def host_elf(section, name=b'.nv_fatbin'):
+    # 64-bit little endian ELF with .shstrtab and section only
+    names = b'\0.shstrtab\0' + name + b'\0'
+    section_offset = 64 + len(names) + (-len(names) % 8)
+    sh_offset = section_offset + len(section)
+    header = struct.pack('<4sBBBBB7xHHIQQQIHHHHHH', b'\x7fELF', 2, 1, 1, 0, 0, 2, 62, 1, 0, 0, sh_offset, 0, 64,
+                         0, 0, 64, 3, 1)
+    section_headers = (bytes(64) +
+                       struct.pack('<IIQQQQIIQQ', 1, 3, 0, 0, 64, len(names), 0, 0, 1, 0) +
+                       struct.pack('<IIQQQQIIQQ', 11, 1, 0, 0, section_offset, len(section), 0, 0, 8, 0))
+    return header + names + bytes(section_offset - 64 - len(names)) + section + section_headers
+
+
+def test_load_compressed(cubin_path, tmp_path):
+    with open(cubin_path, 'rb') as f:
+        cubin = f.read()
+    path = str(tmp_path / 'test.fatbin')
+    with open(path, 'wb') as f:
+        f.write(fatbin_container(fatbin_entry(2, 75, cubin),
+                                 fatbin_entry(1, 75, b'.version 7.0\n\0'),
+                                 fatbin_entry(2, 86, cubin, compressed=True)))
+
+    fatbin = Fatbin()
+    fatbin.load(path)
+    assert not fatbin.bare_cubin
+    assert [(entry.kind, entry.arch) for entry in fatbin.entries] == [(2, 75), (1, 75), (2, 86)]
+    assert [entry.index for entry in fatbin.cubins([86])] == [2]
+    assert fatbin.entries[2].compressed_size > fatbin.entries[2].decompressed_size == len(cubin)
+    for entry in fatbin.cubins():
+        assert entry.payload(fatbin.data) == cubin
+
+
+def test_lz4_overlapping_match():
+    # ab, then a match of 10 bytes 2 back, then a match of 20 bytes 1 back, ending with literals
+    block = (bytes([2 << 4 | 6]) + b'ab' + struct.pack('<H', 2) +
+             bytes([1 << 4 | 15]) + b'c' + struct.pack('<H', 1) + bytes([1]) +
+             lz4_literals(b'end'))
+    assert decompress_lz4(block, 36) == b'ab' * 6 + b'c' * 21 + b'end'
+
+    with pytest.raises(Exception, match='Bad LZ4 match offset'):
+        decompress_lz4(bytes([1 << 4]) + b'a' + struct.pack('<H', 2), 8)
+
+
+def test_bad_magic(tmp_path):
+    path = str(tmp_path / 'bad.fatbin')
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHQ', 0xBA55ED51, 1, 16, 0))
+    with pytest.raises(Exception, match='Bad fatbin magic 0xba55ed51'):
+        Fatbin().load(path)
+
+
+def test_host_elf(cubin_path, tmp_path):
+    with open(cubin_path, 'rb') as f:
+        cubin = f.read()
+    # one container per translation unit in .nv_fatbin
+    section = (fatbin_container(fatbin_entry(2, 61, b'\0' * 12)) +
+               fatbin_container(fatbin_entry(2, 75, cubin, compressed=True)))
+    path = str(tmp_path / 'host')
+    with open(path, 'wb') as f:
+        f.write(host_elf(section))
+
+    fatbin = Fatbin()
+    fatbin.load(path)
+    assert [(entry.index, entry.arch) for entry in fatbin.cubins()] == [(0, 61), (1, 75)]
+    assert fatbin.entries[1].payload(fatbin.data) == cubin
+
+    with open(path, 'wb') as f:
+        f.write(host_elf(section, b'.nv_fatbin_'))
+    with pytest.raises(Exception, match='no .nv_fatbin section'):
+        Fatbin().load(path)
+
+
+def test_assemble_archs(tmp_path):
+    with open(os.path.join(ROOT, 'global_run.s')) as f:
+        asm = f.read().replace('.compute_75\n.sm_75\n', '.compute_{arch}\n.sm_{arch}\n')
+    asm_path = str(tmp_path / 'archs.s')
+    with open(asm_path, 'w') as f:
+        f.write(asm)
+    run_nbas('as', asm_path, '-o', str(tmp_path / 'archs.cubin'), '-a', '75,86')
+
+    fatbin = Fatbin()
+    fatbin.load(str(tmp_path / 'archs.fatbin'))
+    assert [(entry.index, entry.arch) for entry in fatbin.cubins()] == [(0, 75), (1, 86)]
+    for entry in fatbin.entries:
+        # the same asm assembled for this arch alone
+        single_path = str(tmp_path / f'single_{entry.arch}.s')
+        with open(single_path, 'w') as f:
+            f.write(asm.replace('{arch}', str(entry.arch)))
+        cubin = Cubin()
+        assemble_cubin(cubin, single_path, {}, False)
+        gen_cubin(cubin)
+        cubin.write(single_path[:-2] + '.cubin')
+        with open(single_path[:-2] + '.cubin', 'rb') as f:
+            binary = f.read()
+        assert entry.payload(fatbin.data)[:len(binary)] == binary
+        assert not any(entry.payload(fatbin.data)[len(binary):])
+        with open(str(tmp_path / f'archs.sm_{entry.arch}.cubin'), 'rb') as f:
+            assert f.read() == binary
@@ -0,0 +1,40 @@
+import json
+import shutil
+
+from conftest import run_nbas
+
+from nbas.fatbin import Fatbin
+
+
+def test_record_profile_jobs(multi_cubin_path, tmp_path):
+    # an existing profile, loaded with -p and recorded into
+    base_path = str(tmp_path / 'base.json')
+    run_nbas('test', multi_cubin_path, '--decoder', 'native', '--record_profile', base_path)
+
+    profiles = []
+    for jobs in ['1', '2']:
+        path = str(tmp_path / f'profile_{jobs}.json')
+        shutil.copy(base_path, path)
+        run_nbas('test', multi_cubin_path, '--decoder', 'native', '-j', jobs, '-p', path, '--record_profile', path)
+        with open(path) as f:
+            profiles.append(json.load(f))
+    assert profiles[0] == profiles[1]
+
+
+def test_record_profile_fatbin(multi_cubin_path, tmp_path):
+    fatbin = Fatbin()
+    with open(multi_cubin_path, 'rb') as f:
+        fatbin.add_cubin(f.read(), 75)
+    fatbin_path = str(tmp_path / 'multi.fatbin')
+    fatbin.write(fatbin_path)
+    base_path = str(tmp_path / 'base.json')
+    run_nbas('test', multi_cubin_path, '--decoder', 'native', '--record_profile', base_path)
+
+    profiles = []
+    for path in [multi_cubin_path, fatbin_path]:
+        profile_path = path + '.json'
+        shutil.copy(base_path, profile_path)
+        run_nbas('test', path, '--decoder', 'native', '-p', profile_path, '--record_profile', profile_path)
+        with open(profile_path) as f:
+            profiles.append(json.load(f))
+    assert profiles[0] == profiles[1]
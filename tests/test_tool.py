@@ -0,0 +1,71 @@
+import marshal
+import os
+
+import pytest
+
+import nbas.tool
+from nbas.tool import DisassemblyCache, NvdisasmArchive, run_nvdisasm
+
+
+def cache_instrs(i):
+    return [{'op': 'NOP', 'rest': ' ;', 'ctrl': f'B------:R-:W-:-:S{i:02d}'}] * 16
+
+
+def test_das_cache_key_change(tmp_path, monkeypatch):
+    cache = DisassemblyCache(str(tmp_path))
+    binary = bytes(range(32))
+    key = cache.key(binary, 75, 'native')
+    cache.put(key, cache_instrs(0))
+    assert cache.get(cache.key(binary, 75, 'native')) == cache_instrs(0)
+
+    # a change of decoder.py or kernel.py
+    monkeypatch.setattr(nbas.tool, 'decoder_version', 'changed')
+    new_key = cache.key(binary, 75, 'native')
+    assert new_key != key
+    assert cache.get(new_key) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_das_cache_eviction(tmp_path):
+    path = str(tmp_path)
+    size = len(marshal.dumps(cache_instrs(0)))
+    cache = DisassemblyCache(path, maxsize=size * 7 // 2)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, cache_instrs(i))
+        os.utime(os.path.join(path, f'{key}.marshal'), (i + 1, i + 1))
+    assert cache.evictions == 0
+    # a is now the most recently used
+    assert cache.get('a') == cache_instrs(0)
+
+    # over maxsize, the least recently used go until 3/4 of it is left
+    cache.put('d', cache_instrs(3))
+    assert cache.evictions == 2
+    assert sorted(os.listdir(path)) == ['a.marshal', 'd.marshal']
+    assert cache.size <= cache.maxsize * 3 // 4
+
+
+def test_nvdisasm_archive(tmp_path, monkeypatch):
+    # a stand-in for nvdisasm, printing its arguments and the size of its input
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    with open(bin_path / 'nvdisasm', 'w') as f:
+        f.write('#!/bin/sh\necho "args $1 $2"\nwc -c < "$3"\necho "        /*0000*/  NOP ;"\n')
+    os.chmod(bin_path / 'nvdisasm', 0o755)
+    monkeypatch.setenv('PATH', str(bin_path) + os.pathsep + os.environ.get('PATH', ''))
+    archive_path = str(tmp_path / 'nvdisasm.rec')
+    binary = bytes(48)
+
+    monkeypatch.setattr(nbas.tool, 'nvdisasm_archive', NvdisasmArchive())
+    nbas.tool.nvdisasm_archive.open(archive_path, 'record')
+    recorded = list(run_nvdisasm(['-b', 'SM75'], binary=binary))
+    assert [line.strip() for line in recorded] == ['args -b SM75', '48', '/*0000*/  NOP ;']
+
+    # nvdisasm is gone, the run comes from the archive
+    os.remove(bin_path / 'nvdisasm')
+    monkeypatch.setenv('PATH', str(bin_path))
+    monkeypatch.setattr(nbas.tool, 'nvdisasm_archive', NvdisasmArchive())
+    nbas.tool.nvdisasm_archive.open(archive_path, 'replay')
+    assert list(run_nvdisasm(['-b', 'SM75'], binary=binary)) == recorded
+    assert (nbas.tool.nvdisasm_archive.hits, nbas.tool.nvdisasm_archive.misses) == (1, 0)
+    with pytest.raises(Warning, match='not recorded'):
+        list(run_nvdisasm(['-b', 'SM86'], binary=binary))